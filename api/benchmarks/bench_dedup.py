@@ -0,0 +1,96 @@
+"""Benchmark de NearDuplicateIndex (MinHash/LSH) à 10k / 100k / 1M questions.
+
+Usage (depuis api/) :
+    python benchmarks/bench_dedup.py            # 10k, 100k, 1M
+    python benchmarks/bench_dedup.py 10000 50000
+
+Pour chaque taille : temps de construction, latence moyenne / p99 d'une recherche, rappel sur des
+paraphrases (un mot remplacé, rappel mesuré sur celles dont la similarité de Jaccard exacte atteint le
+seuil) et taux de faux positifs sur des questions inédites.
+"""
+import sys
+import time
+import random
+import pathlib
+import resource
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main  # noqa: E402
+
+
+def _vocabulary(n: int, rng: random.Random):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return ["".join(rng.choice(letters) for _ in range(rng.randint(4, 9))) for _ in range(n)]
+
+
+def _question(words, rng: random.Random):
+    return "Quelle est " + " ".join(rng.choice(words) for _ in range(rng.randint(8, 14))) + " ?"
+
+
+def _paraphrase(question: str, words, rng: random.Random):
+    tokens = question.split()
+    pos = rng.randrange(2, len(tokens) - 1)
+    tokens[pos] = rng.choice(words)
+    return " ".join(tokens).upper()
+
+
+def _jaccard(a: str, b: str) -> float:
+    sa = main.NearDuplicateIndex.shingles(a)
+    sb = main.NearDuplicateIndex.shingles(b)
+    return len(sa & sb) / len(sa | sb)
+
+
+def bench(size: int, queries: int = 2000, seed: int = 42):
+    rng = random.Random(seed)
+    words = _vocabulary(20000, rng)
+    corpus = [_question(words, rng) for _ in range(size)]
+    index = main.NearDuplicateIndex(threshold=main.DEDUP_THRESHOLD)
+
+    start = time.perf_counter()
+    for i, q in enumerate(corpus):
+        index.add(i, q)
+    build = time.perf_counter() - start
+
+    near = []
+    while len(near) < queries // 2:
+        original = corpus[rng.randrange(size)]
+        candidate = _paraphrase(original, words, rng)
+        if _jaccard(original, candidate) >= index.threshold:
+            near.append(candidate)
+    fresh = [_question(words, rng) for _ in range(queries // 2)]
+    timings = []
+    hits_near = 0
+    hits_fresh = 0
+    for q in near:
+        t0 = time.perf_counter()
+        hits_near += index.find(q) is not None
+        timings.append(time.perf_counter() - t0)
+    for q in fresh:
+        t0 = time.perf_counter()
+        hits_fresh += index.find(q) is not None
+        timings.append(time.perf_counter() - t0)
+    timings.sort()
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "size": size,
+        "build_s": build,
+        "lookup_avg_us": sum(timings) / len(timings) * 1e6,
+        "lookup_p99_us": timings[int(len(timings) * 0.99)] * 1e6,
+        "recall": hits_near / len(near),
+        "false_pos": hits_fresh / len(fresh),
+        "max_rss_mb": rss_mb,
+    }
+
+
+def main_cli(argv):
+    sizes = [int(a) for a in argv] or [10_000, 100_000, 1_000_000]
+    print(f"{'size':>9} {'build(s)':>9} {'avg(us)':>8} {'p99(us)':>8} {'recall':>7} {'fp':>6} {'rss(MB)':>8}")
+    for size in sizes:
+        r = bench(size)
+        print(f"{r['size']:>9} {r['build_s']:>9.1f} {r['lookup_avg_us']:>8.1f} {r['lookup_p99_us']:>8.1f} "
+              f"{r['recall']:>7.2%} {r['false_pos']:>6.2%} {r['max_rss_mb']:>8.0f}")
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -0,0 +1,49 @@
+"""Benchmark de la pagination par clé du store mémoire (MemoryQcmStore.page) selon la profondeur.
+
+Usage (depuis api/) :
+    python benchmarks/bench_history.py            # historiques de 20k et 200k QCM
+    python benchmarks/bench_history.py 50000
+
+Pour chaque taille : latence moyenne / p99 d'une page de 20 lignes en tête, au milieu et au fond de
+l'historique ; une pagination par clé garde un coût indépendant de la profondeur.
+"""
+import sys
+import time
+import uuid
+import pathlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main  # noqa: E402
+
+
+def bench(size: int, page_size: int = 20, rounds: int = 2000):
+    user_id = "bench-history"
+    store = main.MemoryQcmStore(max_entries=0, max_bytes=0)
+    keys = []
+    for i in range(size):
+        qid, created_at = str(uuid.uuid4()), f"2024-01-01T{i // 3600000:02d}:{i // 60000 % 60:02d}:{i // 1000 % 60:02d}.{i % 1000:06d}"
+        store.put(qid, user_id, None, b'{"items":[]}', None, created_at)
+        keys.append((created_at, qid))
+    results = {}
+    for label, position in (("head", size - 1), ("middle", size // 2), ("tail", page_size * 2)):
+        timings = []
+        for _ in range(rounds):
+            t0 = time.perf_counter()
+            store.page(user_id, page_size + 1, keys[position])
+            timings.append(time.perf_counter() - t0)
+        timings.sort()
+        results[label] = (sum(timings) / len(timings) * 1e6, timings[int(len(timings) * 0.99)] * 1e6)
+    return results
+
+
+def main_cli(argv):
+    sizes = [int(a) for a in argv] or [20_000, 200_000]
+    print(f"{'size':>9} {'position':>9} {'avg(us)':>8} {'p99(us)':>8}")
+    for size in sizes:
+        for label, (avg, p99) in bench(size).items():
+            print(f"{size:>9} {label:>9} {avg:>8.1f} {p99:>8.1f}")
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -0,0 +1,53 @@
+"""Taux de parse et coût du parseur JSON tolérant sur le corpus de sorties LLM malformées.
+
+Usage (depuis api/) :
+    python benchmarks/bench_json_repair.py
+    python benchmarks/bench_json_repair.py 200     # répétitions pour la mesure de temps
+
+Corpus : tests/fixtures/llm_outputs (manifest.json = nombre d'éléments complets attendus, null si irrécupérable).
+Compare le parse strict historique (_extract_json_strict) et _extract_json (strict puis réparation locale).
+"""
+import sys
+import json
+import time
+import pathlib
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main  # noqa: E402
+
+FIXTURES = pathlib.Path(__file__).parent.parent / "tests" / "fixtures" / "llm_outputs"
+
+
+def _items(data):
+    return data["items"] if isinstance(data, dict) else data
+
+
+def bench(parse, corpus, repeat: int):
+    ok = 0
+    start = time.perf_counter()
+    for _ in range(repeat):
+        ok = 0
+        for text, expected in corpus:
+            try:
+                ok += expected is not None and len(_items(parse(text))) == expected
+            except ValueError:
+                pass
+    per_doc = (time.perf_counter() - start) / repeat / len(corpus) * 1e6
+    return ok, per_doc
+
+
+def main_cli(argv):
+    repeat = int(argv[0]) if argv else 50
+    manifest = json.loads((FIXTURES / "manifest.json").read_text(encoding="utf-8"))
+    corpus = [((FIXTURES / name).read_text(encoding="utf-8"), expected) for name, expected in manifest.items()]
+    recoverable = sum(1 for _, e in corpus if e is not None)
+    print(f"corpus : {len(corpus)} sorties, {recoverable} récupérables")
+    print(f"{'parseur':>10} {'succès':>8} {'taux':>7} {'us/doc':>8}")
+    for label, parse in (("strict", main._extract_json_strict), ("tolérant", main._extract_json)):
+        ok, us = bench(parse, corpus, repeat)
+        print(f"{label:>10} {ok:>8} {ok / recoverable:>7.0%} {us:>8.1f}")
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -0,0 +1,88 @@
+"""Benchmark sérialisation + compression des réponses volumineuses (QCM de 10 / 50 questions, historique de 1000 lignes).
+
+Usage (depuis api/) :
+    python benchmarks/bench_serialization.py
+    python benchmarks/bench_serialization.py 2000     # nombre de répétitions par mesure
+
+Pour chaque charge : temps moyen de sérialisation (json standard, comme JSONResponse, puis _json_dumps de
+l'API, orjson si installé) et, pour chaque encodage (aucun, gzip, br si brotli est installé), temps
+sérialisation + compression et octets envoyés sur le réseau.
+"""
+import sys
+import json
+import time
+import pathlib
+from datetime import datetime, timedelta
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main  # noqa: E402
+
+
+def _qcm(count: int) -> dict:
+    items = []
+    for i in range(count):
+        items.append({
+            "id": str(i + 1),
+            "question": f"Dans le cadre d'une architecture orientée services, quelle stratégie de déploiement permet de "
+                        f"limiter l'impact d'une régression sur le service n°{i} tout en conservant un retour rapide ?",
+            "choices": [
+                "Un déploiement progressif (canary) avec surveillance des métriques et retour arrière automatisé",
+                "Une mise à jour simultanée de toutes les instances pendant une fenêtre de maintenance",
+                "La désactivation des tests d'intégration afin d'accélérer la livraison en production",
+                "Le redémarrage manuel de chaque serveur après copie des fichiers modifiés",
+            ],
+            "answer_index": i % 4,
+            "skill": "devops",
+            "explanation": "Le déploiement canary expose d'abord une petite fraction du trafic à la nouvelle version ; "
+                           "les indicateurs d'erreur et de latence décident de la généralisation ou du retour arrière. "
+                           "Les autres réponses augmentent le risque ou le temps de rétablissement.",
+        })
+    return {"name": f"QCM DevOps ({count} questions)", "items": items}
+
+
+def _history(rows: int) -> list:
+    start = datetime(2025, 1, 1)
+    return [
+        {"id": f"{i:08d}-0000-4000-8000-000000000000", "user_id": "5f0c1a2b-3c4d-4e5f-8a9b-0c1d2e3f4a5b",
+         "name": f"Entraînement entretien n°{i}", "score": i % 11, "created_at": (start + timedelta(minutes=i)).isoformat()}
+        for i in range(rows)
+    ]
+
+
+def _stdlib(obj) -> bytes:
+    # Rendu de starlette.responses.JSONResponse
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def _timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def bench(label: str, payload, repeat: int):
+    serializers = [("json", _stdlib), ("api", main._json_dumps)]
+    encodings = [None, "gzip"] + (["br"] if main.brotli is not None else [])
+    rows = []
+    for name, dumps in serializers:
+        rows.append((label, name, "-", _timed(lambda: dumps(payload), repeat), len(dumps(payload))))
+        for enc in encodings[1:]:
+            us = _timed(lambda: main._compress(dumps(payload), enc), repeat)
+            rows.append((label, name, enc, us, len(main._compress(dumps(payload), enc))))
+    return rows
+
+
+def main_cli(argv):
+    repeat = int(argv[0]) if argv else 500
+    print(f"serializer api = {'orjson' if main.orjson is not None else 'json'} ; brotli {'installé' if main.brotli is not None else 'absent'}")
+    print(f"{'charge':>14} {'sérial.':>8} {'encod.':>7} {'temps(us)':>10} {'octets':>9}")
+    payloads = [("qcm-10", _qcm(10)), ("qcm-50", _qcm(50)), ("history-1000", _history(1000))]
+    for label, payload in payloads:
+        for r in bench(label, payload, repeat):
+            print(f"{r[0]:>14} {r[1]:>8} {r[2]:>7} {r[3]:>10.1f} {r[4]:>9}")
+
+
+if __name__ == "__main__":
+    main_cli(sys.argv[1:])
@@ -1,12 +1,37 @@
 import os
 import json
 import uuid
-from datetime import datetime
-from typing import List, Optional, Dict, Any
+import asyncio
+import functools
+import contextvars
+import threading
+import time
+import sqlite3
+import hashlib
+import base64
+import gzip
+import unicodedata
+import email.utils
+import re
+import operator
+import heapq
+import math
+from array import array
+from bisect import bisect_left, insort
+from collections import OrderedDict, deque
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, Dict, Any, Callable, Set, Tuple, TypedDict, Union
 
-from fastapi import FastAPI, HTTPException, Depends, Header
+from fastapi import FastAPI, HTTPException, Depends, Header, Query, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
+from starlette.datastructures import Headers, MutableHeaders
+import httpx
 try:
     from dotenv import load_dotenv
 except Exception:
@@ -31,30 +56,63 @@ except Exception:  # pragma: no cover
     BaseCallbackHandler = None  # type: ignore
     print("langchain_google_genai not installed. Install deps or set GEMINI_API_KEY.")
 
-try:
-    from supabase import create_client, Client  # type: ignore
-except Exception:  # pragma: no cover
-    create_client = None  # type: ignore
-    Client = None  # type: ignore
-    print("supabase not installed. Install deps or set GEMINI_API_KEY.")
-
 try:
     import jwt  # PyJWT
 except Exception:  # pragma: no cover
     jwt = None  # type: ignore
     print("jwt not installed. Install deps or set GEMINI_API_KEY.")
 
+# Accélérateurs optionnels : sérialisation JSON (orjson) et compression brotli
+try:
+    import orjson  # type: ignore
+except Exception:  # pragma: no cover
+    orjson = None  # type: ignore
+
+try:
+    import brotli  # type: ignore
+except Exception:  # pragma: no cover
+    brotli = None  # type: ignore
+
 load_dotenv(dotenv_path=str(Path(__file__).parent / ".env"))
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 ALLOWED_ORIGINS = [o.strip() for o in os.getenv("ALLOWED_ORIGINS", "http://localhost:4200,https://auto-qcm.netlify.app").split(",") if o.strip()]
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE_KEY = os.getenv("SUPABASE_SERVICE_ROLE_KEY")
-SUPABASE_CLIENT: Optional["Client"] = None
+SUPABASE_CLIENT: Optional["SupabaseRest"] = None
+# Stockage des QCM, rôles et usages : "supabase" (défaut) ou "sqlite" (fichier local SQLITE_PATH, mono-nœud)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "supabase").strip().lower()
+# Questions stockées une seule fois dans la table questions (empreinte du contenu), référencées par les QCM
+# sauvegardés. Toujours actif en SQLite ; sur Supabase, à activer après avoir créé la table (supabase.sql)
+NORMALIZED_QUESTIONS = os.getenv("NORMALIZED_QUESTIONS", "false").lower() in ("1", "true", "yes")
+SQLITE_PATH = os.getenv("SQLITE_PATH") or str(Path(__file__).parent / "autoqcm.sqlite3")
+SQLITE_STORAGE: Optional["SqliteStorage"] = None
+SUPABASE_STORAGE: Optional["SupabaseStorage"] = None
+# Pool de connexions HTTP vers l'API REST de Supabase (requêtes simultanées max) et délais en secondes
+SUPABASE_POOL_SIZE = max(1, int(os.getenv("SUPABASE_POOL_SIZE", "20")))
+SUPABASE_TIMEOUT = float(os.getenv("SUPABASE_TIMEOUT", "10"))
+# Compression des réponses (gzip, ou brotli si installé et accepté) au-delà de COMPRESSION_MIN_SIZE octets
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() in ("1", "true", "yes")
+COMPRESSION_MIN_SIZE = max(0, int(os.getenv("COMPRESSION_MIN_SIZE", "1024")))
+COMPRESSION_GZIP_LEVEL = min(9, max(1, int(os.getenv("COMPRESSION_GZIP_LEVEL", "6"))))
+COMPRESSION_BROTLI_QUALITY = min(11, max(0, int(os.getenv("COMPRESSION_BROTLI_QUALITY", "4"))))
+# Métriques Prometheus sur GET /metrics (METRICS_TOKEN : jeton Bearer exigé pour la collecte, si défini)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+SUPABASE_CONNECT_TIMEOUT = float(os.getenv("SUPABASE_CONNECT_TIMEOUT", "5"))
 DEV_MODE = os.getenv("DEV_MODE", "false").lower() in ("1", "true", "yes")
 # UUID spécial utilisé uniquement en mode développement pour les opérations sans auth
 DEV_USER_ID = os.getenv("DEV_USER_ID", "00000000-0000-0000-0000-000000000001")
-# In-memory fallback store for dev/testing when Supabase is not configured
-STORE: Dict[str, Dict[str, Any]] = {}
+# Store mémoire (dev / staging / tests de charge sans Supabase) : plafonds en entrées et en octets (0 = aucun),
+# et instantané disque optionnel rechargé au démarrage (écrit à l'arrêt et toutes les STORE_SNAPSHOT_INTERVAL s)
+STORE_MAX_ENTRIES = max(0, int(os.getenv("STORE_MAX_ENTRIES", "50000")))
+STORE_MAX_BYTES = max(0, int(os.getenv("STORE_MAX_BYTES", str(256 * 1024 * 1024))))
+STORE_SNAPSHOT_PATH = os.getenv("STORE_SNAPSHOT_PATH") or None
+STORE_SNAPSHOT_INTERVAL = float(os.getenv("STORE_SNAPSHOT_INTERVAL", "0"))
+# Pagination de /history : taille de page par défaut (0 = historique complet) et maximale
+HISTORY_DEFAULT_LIMIT = max(0, int(os.getenv("HISTORY_DEFAULT_LIMIT", "0")))
+HISTORY_MAX_LIMIT = max(1, int(os.getenv("HISTORY_MAX_LIMIT", "200")))
+# Nombre max de QCM par appel de /save_qcm/batch et /qcm/batch_delete
+BATCH_MAX_ITEMS = max(1, int(os.getenv("BATCH_MAX_ITEMS", "200")))
 ROLE_LIMITS = {
     "user": 10,
     "user_plus": 100,
@@ -63,15 +121,407 @@ ROLE_LIMITS = {
     "dev": None,
 }
 DEFAULT_ROLE = "user"
+# Pool de threads borné dédié aux appels LLM (bloquants) pour ne pas geler la boucle asyncio
+LLM_MAX_WORKERS = max(1, int(os.getenv("LLM_MAX_WORKERS", "8")))
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=LLM_MAX_WORKERS, thread_name_prefix="autoqcm-llm")
+# Appels Gemini simultanés, tous chemins confondus (lots en parallèle, compléments, remplacement des doublons,
+# flux, pré-génération) : l'admission borne des requêtes, dont chacune peut lancer plusieurs appels
+LLM_MAX_CONCURRENT_CALLS = max(1, min(LLM_MAX_WORKERS, int(os.getenv("LLM_MAX_CONCURRENT_CALLS", str(LLM_MAX_WORKERS)))))
+# Fan-out : taille de lot par défaut, lots simultanés max par requête, relances par lot en échec,
+# et nombre de questions à partir duquel le découpage en lots est automatique (0 = jamais)
+FANOUT_CHUNK_SIZE = max(1, int(os.getenv("FANOUT_CHUNK_SIZE", "10")))
+FANOUT_MAX_CONCURRENCY = max(1, int(os.getenv("FANOUT_MAX_CONCURRENCY", "4")))
+FANOUT_RETRIES = max(0, int(os.getenv("FANOUT_RETRIES", "1")))
+FANOUT_AUTO_MIN_COUNT = int(os.getenv("FANOUT_AUTO_MIN_COUNT", "0"))
+# Admission des générations : au plus ADMISSION_MAX_CONCURRENCY en cours, ADMISSION_MAX_PER_USER par utilisateur
+# (0 = sans limite) ; au-delà, file d'attente bornée servie par rôle (ROLE_LIMITS) : file pleine = 429,
+# attente de plus de ADMISSION_QUEUE_TIMEOUT secondes = 503, avec Retry-After dans les deux cas
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() in ("1", "true", "yes")
+ADMISSION_MAX_CONCURRENCY = max(1, int(os.getenv("ADMISSION_MAX_CONCURRENCY", str(LLM_MAX_WORKERS))))
+ADMISSION_MAX_PER_USER = max(0, int(os.getenv("ADMISSION_MAX_PER_USER", "2")))
+ADMISSION_QUEUE_MAX = max(0, int(os.getenv("ADMISSION_QUEUE_MAX", "64")))
+ADMISSION_QUEUE_TIMEOUT = float(os.getenv("ADMISSION_QUEUE_TIMEOUT", "30"))
+# Tâches de génération asynchrones (/generate_qcm/jobs) : JOBS_WORKERS exécutées à la fois, au plus JOBS_QUEUE_MAX
+# en attente et JOBS_MAX_PER_USER actives par utilisateur ; les tâches terminées sont gardées JOBS_TTL secondes
+# (JOBS_MAX_FINISHED au plus, les plus anciennes évincées d'abord)
+JOBS_WORKERS = max(1, int(os.getenv("JOBS_WORKERS", "4")))
+JOBS_QUEUE_MAX = max(0, int(os.getenv("JOBS_QUEUE_MAX", "100")))
+JOBS_MAX_PER_USER = max(1, int(os.getenv("JOBS_MAX_PER_USER", "5")))
+JOBS_TTL = float(os.getenv("JOBS_TTL", "3600"))
+JOBS_MAX_FINISHED = max(1, int(os.getenv("JOBS_MAX_FINISHED", "1000")))
+# Pré-génération en période creuse (WARMER_ENABLED) : les WARMER_TOP_KEYS combinaisons (compétences, difficulté)
+# vues au moins WARMER_MIN_REQUESTS fois sur WARMER_WINDOW secondes sont pré-générées par lots de WARMER_BATCH_SIZE
+# questions, un lot toutes les WARMER_INTERVAL secondes au plus, jusqu'à WARMER_POOL_SIZE questions prêtes par
+# combinaison et WARMER_MAX_CALLS_PER_HOUR appels LLM par heure. Pause dès qu'une génération est en cours ou
+# qu'une demande est arrivée depuis moins de WARMER_IDLE_SECONDS secondes ; questions jetées après WARMER_POOL_TTL s
+WARMER_ENABLED = os.getenv("WARMER_ENABLED", "false").lower() in ("1", "true", "yes")
+WARMER_INTERVAL = max(1.0, float(os.getenv("WARMER_INTERVAL", "30")))
+WARMER_WINDOW = float(os.getenv("WARMER_WINDOW", "3600"))
+WARMER_MIN_REQUESTS = max(1, int(os.getenv("WARMER_MIN_REQUESTS", "3")))
+WARMER_TOP_KEYS = max(1, int(os.getenv("WARMER_TOP_KEYS", "5")))
+WARMER_POOL_SIZE = max(0, int(os.getenv("WARMER_POOL_SIZE", "30")))
+WARMER_BATCH_SIZE = max(1, int(os.getenv("WARMER_BATCH_SIZE", "10")))
+WARMER_MAX_CALLS_PER_HOUR = max(0, int(os.getenv("WARMER_MAX_CALLS_PER_HOUR", "20")))
+WARMER_IDLE_SECONDS = float(os.getenv("WARMER_IDLE_SECONDS", "10"))
+WARMER_POOL_TTL = float(os.getenv("WARMER_POOL_TTL", "86400"))
+# Coalescence (single-flight) : les demandes identiques simultanées partagent un seul appel LLM, rejoignable
+# pendant COALESCE_WINDOW secondes après son lancement ; un résultat terminé n'est jamais resservi
+COALESCE_ENABLED = os.getenv("COALESCE_ENABLED", "true").lower() in ("1", "true", "yes")
+COALESCE_WINDOW = float(os.getenv("COALESCE_WINDOW", "10"))
+# Questions invalides écartées : appels complémentaires pour le seul manque (au plus LLM_TOPUP_ATTEMPTS,
+# aucun nouvel appel après LLM_TOPUP_BUDGET secondes depuis le début de la génération)
+LLM_TOPUP_ATTEMPTS = max(0, int(os.getenv("LLM_TOPUP_ATTEMPTS", "2")))
+LLM_TOPUP_BUDGET = float(os.getenv("LLM_TOPUP_BUDGET", "30"))
+# Budget max_output_tokens adaptatif : (surcoût + count x tokens/question estimés) x marge, borné, plus le budget
+# de réflexion ; l'estimation par (modèle, difficulté) suit les usages observés et augmente après une réponse tronquée.
+# Désactivé par défaut : sur gemini-2.5-*, la réflexion compte dans max_output_tokens et n'est bornée que par
+# LLM_THINKING_BUDGET (tokens, 0 = sans réflexion ; vide = choix dynamique du modèle)
+LLM_ADAPTIVE_MAX_TOKENS = os.getenv("LLM_ADAPTIVE_MAX_TOKENS", "false").lower() in ("1", "true", "yes")
+LLM_THINKING_BUDGET = int(os.getenv("LLM_THINKING_BUDGET")) if os.getenv("LLM_THINKING_BUDGET") else None
+LLM_TOKENS_PER_ITEM = float(os.getenv("LLM_TOKENS_PER_ITEM", "200"))
+LLM_OUTPUT_TOKENS_OVERHEAD = max(0, int(os.getenv("LLM_OUTPUT_TOKENS_OVERHEAD", "512")))
+LLM_TOKEN_BUDGET_MARGIN = max(1.0, float(os.getenv("LLM_TOKEN_BUDGET_MARGIN", "1.5")))
+LLM_MIN_OUTPUT_TOKENS = max(1, int(os.getenv("LLM_MIN_OUTPUT_TOKENS", "1024")))
+LLM_MAX_OUTPUT_TOKENS = max(LLM_MIN_OUTPUT_TOKENS, int(os.getenv("LLM_MAX_OUTPUT_TOKENS", "16384")))
+# Prompt compact (structure abrégée, explications d'une phrase) jusqu'à ce nombre de questions (0 = jamais)
+LLM_COMPACT_PROMPT_MAX_COUNT = max(0, int(os.getenv("LLM_COMPACT_PROMPT_MAX_COUNT", "10")))
+# Télémétrie de génération en mémoire : utilisateurs suivis et dernières requêtes gardées par utilisateur
+TELEMETRY_MAX_USERS = max(1, int(os.getenv("TELEMETRY_MAX_USERS", "10000")))
+TELEMETRY_RECENT_REQUESTS = max(0, int(os.getenv("TELEMETRY_RECENT_REQUESTS", "20")))
+# Banque de questions locale (SQLite) servie avant Gemini ; désactivée par défaut
+QUESTION_BANK_ENABLED = os.getenv("QUESTION_BANK_ENABLED", "false").lower() in ("1", "true", "yes")
+QUESTION_BANK_PATH = os.getenv("QUESTION_BANK_PATH", str(Path(__file__).parent / "question_bank.sqlite3"))
+QUESTION_BANK_MAX_ITEMS = max(1, int(os.getenv("QUESTION_BANK_MAX_ITEMS", "20000")))
+QUESTION_BANK_MAX_PER_KEY = max(1, int(os.getenv("QUESTION_BANK_MAX_PER_KEY", "500")))
+QUESTION_BANK_TTL_SECONDS = int(os.getenv("QUESTION_BANK_TTL_SECONDS", str(30 * 24 * 3600)))
+QUESTION_BANK: Optional["QuestionBank"] = None
+# Détection de quasi-doublons (MinHash/LSH) entre questions générées et QCM sauvegardés de l'utilisateur
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "false").lower() in ("1", "true", "yes")
+DEDUP_THRESHOLD = float(os.getenv("DEDUP_THRESHOLD", "0.7"))
+DEDUP_REPLACE = os.getenv("DEDUP_REPLACE", "true").lower() in ("1", "true", "yes")
+DEDUP_MAX_USERS = max(1, int(os.getenv("DEDUP_MAX_USERS", "1000")))
+# Nombre de QCM sauvegardés (les plus récents) lus pour construire l'index d'un utilisateur
+DEDUP_HISTORY_LIMIT = max(1, int(os.getenv("DEDUP_HISTORY_LIMIT", "50")))
+DEDUP_INDEXES: "OrderedDict[str, NearDuplicateIndex]" = OrderedDict()
+DEDUP_LOADING: Dict[str, "asyncio.Task[NearDuplicateIndex]"] = {}
+# Comptage d'usage : tampon write-behind optionnel, vidé par lots toutes les USAGE_FLUSH_INTERVAL secondes
+USAGE_WRITE_BEHIND = os.getenv("USAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+USAGE_FLUSH_INTERVAL = float(os.getenv("USAGE_FLUSH_INTERVAL", "5"))
+# Cache mémoire des rôles et totaux d'usage utilisés par le contrôle de quota
+ROLE_CACHE_TTL = float(os.getenv("ROLE_CACHE_TTL", "300"))
+USAGE_CACHE_TTL = float(os.getenv("USAGE_CACHE_TTL", "60"))
+QUOTA_CACHE_MAX_ENTRIES = max(1, int(os.getenv("QUOTA_CACHE_MAX_ENTRIES", "10000")))
+# Cache mémoire des QCM lus par /qcm/{qid} (invalidé à la suppression ; QCM_CACHE_TTL borne l'écart entre workers)
+QCM_CACHE_TTL = float(os.getenv("QCM_CACHE_TTL", "300"))
+QCM_CACHE_MAX_ENTRIES = max(1, int(os.getenv("QCM_CACHE_MAX_ENTRIES", "1000")))
+# Vérification de signature des JWT Supabase : secret partagé (HS256) et/ou JWKS du projet, mis en cache
+JWT_VERIFY = os.getenv("JWT_VERIFY", "false").lower() in ("1", "true", "yes")
+SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
+SUPABASE_JWKS_URL = os.getenv("SUPABASE_JWKS_URL") or (
+    f"{SUPABASE_URL.rstrip('/')}/auth/v1/.well-known/jwks.json" if SUPABASE_URL else None
+)
+JWT_AUDIENCE = os.getenv("JWT_AUDIENCE", "authenticated")
+JWT_LEEWAY = float(os.getenv("JWT_LEEWAY", "30"))
+JWKS_REFRESH_INTERVAL = float(os.getenv("JWKS_REFRESH_INTERVAL", "600"))
+JWKS_MIN_REFRESH_INTERVAL = float(os.getenv("JWKS_MIN_REFRESH_INTERVAL", "30"))
+JWKS_FAILURE_BACKOFF = float(os.getenv("JWKS_FAILURE_BACKOFF", "2"))
+TOKEN_CACHE_MAX_ENTRIES = max(1, int(os.getenv("TOKEN_CACHE_MAX_ENTRIES", "10000")))
+GEMINI_TEMPERATURE = float(os.getenv("GEMINI_TEMPERATURE", "0.7"))
+# Sortie structurée : le modèle reçoit le schéma JSON attendu (QcmItem) et répond en application/json
+LLM_STRUCTURED_OUTPUT = os.getenv("LLM_STRUCTURED_OUTPUT", "true").lower() in ("1", "true", "yes")
+# Au démarrage, construit les clients LLM (et, si LLM_WARMUP_PING=true, ouvre la connexion par un mini appel)
+LLM_WARMUP = os.getenv("LLM_WARMUP", "true").lower() in ("1", "true", "yes")
+LLM_WARMUP_PING = os.getenv("LLM_WARMUP_PING", "false").lower() in ("1", "true", "yes")
+
+
+@asynccontextmanager
+async def _lifespan(_app: FastAPI):
+    await _on_startup()
+    try:
+        yield
+    finally:
+        await _on_shutdown()
+
+
+# ---------- HTTP responses ----------
+def _json_dumps(obj: Any) -> bytes:
+    """JSON compact en UTF-8 (orjson si disponible, sinon json de la bibliothèque standard)."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+    return json.dumps(obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """Classe de réponse par défaut de l'API : même contrat que JSONResponse, sérialisée par _json_dumps."""
+
+    def render(self, content: Any) -> bytes:
+        return _json_dumps(content)
+
+
+def _accepted_encoding(accept_encoding: str) -> Optional[str]:
+    """Encodage retenu pour l'en-tête Accept-Encoding : br (si brotli est installé), puis gzip, sinon None."""
+    weights: Dict[str, float] = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip()] = q
+    candidates = (["br"] if brotli is not None else []) + ["gzip"]
+    best = max(candidates, key=lambda enc: weights.get(enc, weights.get("*", 0.0)))
+    return best if weights.get(best, weights.get("*", 0.0)) > 0 else None
+
+
+def _compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        return brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+class CompressionMiddleware:
+    """Compresse les réponses d'un seul bloc au-delà de minimum_size ; les flux (NDJSON, SSE) passent tels quels."""
+
+    UNCOMPRESSED_TYPES = ("text/event-stream", "application/x-ndjson")
+
+    def __init__(self, app: Any, minimum_size: int = 1024) -> None:
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        encoding = _accepted_encoding(Headers(scope=scope).get("accept-encoding", ""))
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start: Dict[str, Any] = {}
+        passthrough = False
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal passthrough
+            if message["type"] == "http.response.start":
+                start.update(message)
+                return
+            if message["type"] != "http.response.body" or passthrough:
+                await send(message)
+                return
+            body = message.get("body", b"")
+            headers = MutableHeaders(raw=start["headers"])
+            if (
+                message.get("more_body", False)
+                or len(body) < self.minimum_size
+                or "content-encoding" in headers
+                or headers.get("content-type", "").startswith(self.UNCOMPRESSED_TYPES)
+            ):
+                passthrough = True
+                await send(start)
+                await send(message)
+                return
+            body = _compress(body, encoding)
+            headers["Content-Encoding"] = encoding
+            headers["Content-Length"] = str(len(body))
+            headers.add_vary_header("Accept-Encoding")
+            start["headers"] = headers.raw
+            await send(start)
+            await send({"type": "http.response.body", "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+
+# ---------- Metrics ----------
+# Bornes (secondes) des histogrammes de latence, de la requête mémoire à l'appel LLM long
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricCounter:
+    """Compteur Prometheus par jeu de labels (tuple de valeurs dans l'ordre de labelnames) ; thread-safe."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels: Tuple[str, ...] = (), amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, labels: Tuple[str, ...] = ()) -> float:
+        return self._values.get(labels, 0.0)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = sorted(self._values.items())
+        lines.extend(f"{self.name}{_format_labels(self.labelnames, labels)} {value:g}" for labels, value in samples)
+        return lines
+
+
+class MetricHistogram:
+    """Histogramme Prometheus : compte par intervalle (cumulé au rendu), somme et nombre d'observations."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        # Par jeu de labels : [n(<= b0), n(b0 < v <= b1), ..., n(> dernière borne), somme]
+        self._values: Dict[Tuple[str, ...], List[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels: Tuple[str, ...], value: float) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[index] += 1
+            row[-1] += value
+
+    def count(self, labels: Tuple[str, ...] = ()) -> int:
+        row = self._values.get(labels)
+        return int(sum(row[:-1])) if row else 0
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            samples = sorted((labels, list(row)) for labels, row in self._values.items())
+        for labels, row in samples:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), row[:-1]):
+                cumulative += n
+                le = 'le="%s"' % ("+Inf" if bound == float("inf") else f"{bound:g}")
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative:g}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {row[-1]:g}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative:g}")
+        return lines
+
+
+HTTP_REQUESTS = MetricCounter("autoqcm_http_requests_total", "Requêtes HTTP traitées par route et statut.", ("method", "route", "status"))
+HTTP_LATENCY = MetricHistogram("autoqcm_http_request_duration_seconds", "Durée des requêtes HTTP par route et statut.", ("method", "route", "status"))
+STAGE_LATENCY = MetricHistogram("autoqcm_stage_duration_seconds", "Durée des étapes internes (auth, quota, llm, extract, usage_write).", ("stage",))
+SUPABASE_LATENCY = MetricHistogram("autoqcm_supabase_query_duration_seconds", "Durée des requêtes Supabase par table.", ("table", "method"))
+GENERATION_FAILURES = MetricCounter("autoqcm_generation_failures_total", "Générations en échec par cause.", ("cause",))
+ITEMS_REQUESTED = MetricCounter("autoqcm_items_requested_total", "Questions demandées par point d'entrée.", ("endpoint",))
+ITEMS_RETURNED = MetricCounter("autoqcm_items_returned_total", "Questions renvoyées par point d'entrée.", ("endpoint",))
+METRICS = (HTTP_REQUESTS, HTTP_LATENCY, STAGE_LATENCY, SUPABASE_LATENCY, GENERATION_FAILURES, ITEMS_REQUESTED, ITEMS_RETURNED)
+
+
+class _StageTimer:
+    """Chronomètre d'une étape interne : `with _stage("llm"): ...` alimente autoqcm_stage_duration_seconds."""
+
+    __slots__ = ("labels", "start")
+
+    def __init__(self, labels: Tuple[str, ...]) -> None:
+        self.labels = labels
+
+    def __enter__(self) -> "_StageTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        STAGE_LATENCY.observe(self.labels, time.perf_counter() - self.start)
+
+
+def _stage(name: str) -> _StageTimer:
+    return _StageTimer((name,))
+
+
+def _count_generation(endpoint: str, requested: int, returned: int) -> None:
+    ITEMS_REQUESTED.inc((endpoint,), requested)
+    ITEMS_RETURNED.inc((endpoint,), returned)
+
+
+def _failure_cause(exc: BaseException) -> str:
+    """Cause d'échec d'une génération, pour autoqcm_generation_failures_total."""
+    if isinstance(exc, LlmUnavailable):
+        return "unavailable"
+    if isinstance(exc, (asyncio.TimeoutError, TimeoutError, httpx.TimeoutException)):
+        return "timeout"
+    if isinstance(exc, ValueError):
+        # JSON illisible, schéma invalide ou aucune question valide
+        return "invalid_output"
+    return "llm_error"
+
 
-app = FastAPI(title="Auto QCM API", version="0.1.0")
+class MetricsMiddleware:
+    """Compte et chronomètre chaque requête HTTP ; la route est le modèle de chemin (/qcm/{qid}), pas l'URL."""
+
+    def __init__(self, app: Any) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable, send: Callable) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = 500
+
+        async def send_wrapper(message: Dict[str, Any]) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            labels = (scope["method"], getattr(route, "path", "unmatched"), str(status))
+            HTTP_REQUESTS.inc(labels)
+            HTTP_LATENCY.observe(labels, time.perf_counter() - start)
+
+
+def _render_metrics() -> str:
+    lines: List[str] = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    # Jauges lues au moment de la collecte
+    gauges = [
+        ("autoqcm_admission_running", "Générations admises en cours.", ADMISSION.running),
+        ("autoqcm_admission_queue_depth", "Générations en file d'admission.", ADMISSION.depth()),
+        ("autoqcm_jobs_queue_depth", "Tâches de génération en attente.", JOBS.depth()),
+        ("autoqcm_coalescer_in_flight", "Appels LLM partagés en cours.", COALESCER.inflight()),
+        ("autoqcm_llm_calls_in_flight", "Appels au fournisseur LLM en cours.", LLM_CALLS.inflight()),
+        ("autoqcm_llm_calls_waiting", "Appels LLM en attente d'une place (LLM_MAX_CONCURRENT_CALLS).", LLM_CALLS.waiting()),
+    ]
+    for name, documentation, value in gauges:
+        lines.extend([f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {value:g}"])
+    return "\n".join(lines) + "\n"
+
+
+app = FastAPI(title="Auto QCM API", version="0.1.0", lifespan=_lifespan, default_response_class=FastJSONResponse)
+if COMPRESSION_ENABLED:
+    app.add_middleware(CompressionMiddleware, minimum_size=COMPRESSION_MIN_SIZE)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=ALLOWED_ORIGINS or ["*"],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag", "Last-Modified"],
 )
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
 
 
 # ---------- Models ----------
@@ -80,6 +530,11 @@ class GenerateRequest(BaseModel):
     count: int = Field(10, ge=1, le=50)
     name: Optional[str] = None
     difficulty: str = "entretien"
+    # True : ignorer la banque de questions et tout demander au LLM
+    fresh_only: bool = False
+    # Génération parallèle par sous-lots : "skill" (un lot par compétence) ou "chunk" (lots de chunk_size questions)
+    split: Optional[str] = Field(None, pattern="^(skill|chunk)$")
+    chunk_size: Optional[int] = Field(None, ge=1, le=50)
 
 
 class QcmItem(BaseModel):
@@ -100,6 +555,25 @@ class SaveRequest(BaseModel):
     user_id: str
     qcm: GenerateResponse
     score: Optional[int] = None
+    # Réponse choisie pour chaque question (index dans choices, None si sans réponse)
+    answers: Optional[List[Optional[int]]] = None
+
+
+class GenerateJobRequest(GenerateRequest):
+    # True : le QCM terminé est sauvegardé comme par /save_qcm (id renvoyé dans saved_id)
+    auto_save: bool = False
+
+
+class SaveBatchRequest(BaseModel):
+    items: List[SaveRequest] = Field(..., min_length=1, max_length=BATCH_MAX_ITEMS)
+
+
+class DeleteBatchRequest(BaseModel):
+    """Suppression par liste d'ids et/ou par plage de created_at (since inclus, until exclu)."""
+    ids: Optional[List[str]] = Field(None, min_length=1, max_length=BATCH_MAX_ITEMS)
+    since: Optional[datetime] = None
+    until: Optional[datetime] = None
+    user_id: Optional[str] = None
 
 
 class HistoryItem(BaseModel):
@@ -130,21 +604,181 @@ else:
             pass
 
 
-def _supabase_client() -> Optional["Client"]:
+class SupabaseResult:
+    """Réponse PostgREST : lignes décodées dans data (même forme que la réponse du client supabase-py)."""
+
+    __slots__ = ("data", "error")
+
+    def __init__(self, data: Any) -> None:
+        self.data = data
+        self.error = None
+
+
+class SupabaseQuery:
+    """Requête PostgREST construite par chaînage (sous-ensemble de l'API supabase-py), exécutée par await execute()."""
+
+    def __init__(self, client: "SupabaseRest", path: str, method: str = "GET", body: Any = None) -> None:
+        self._client = client
+        self._path = path
+        self._method = method
+        self._body = body
+        self._params: List[Tuple[str, str]] = []
+        self._order: List[str] = []
+        self._prefer: Optional[str] = None
+
+    @staticmethod
+    def _value(value: Any) -> str:
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        if value is None:
+            return "null"
+        return str(value)
+
+    def select(self, columns: str = "*") -> "SupabaseQuery":
+        self._params.append(("select", columns))
+        return self
+
+    def insert(self, rows: Any) -> "SupabaseQuery":
+        self._method, self._body, self._prefer = "POST", rows, "return=representation"
+        return self
+
+    def upsert(self, rows: Any, on_conflict: Optional[str] = None, ignore_duplicates: bool = False) -> "SupabaseQuery":
+        self._method, self._body = "POST", rows
+        self._prefer = "resolution=ignore-duplicates,return=minimal" if ignore_duplicates else "resolution=merge-duplicates,return=minimal"
+        if on_conflict:
+            self._params.append(("on_conflict", on_conflict))
+        return self
+
+    def update(self, values: Dict[str, Any]) -> "SupabaseQuery":
+        self._method, self._body, self._prefer = "PATCH", values, "return=representation"
+        return self
+
+    def delete(self) -> "SupabaseQuery":
+        self._method, self._prefer = "DELETE", "return=representation"
+        return self
+
+    def _filter(self, column: str, op: str, value: Any) -> "SupabaseQuery":
+        self._params.append((column, f"{op}.{self._value(value)}"))
+        return self
+
+    def eq(self, column: str, value: Any) -> "SupabaseQuery":
+        return self._filter(column, "eq", value)
+
+    def gt(self, column: str, value: Any) -> "SupabaseQuery":
+        return self._filter(column, "gt", value)
+
+    def gte(self, column: str, value: Any) -> "SupabaseQuery":
+        return self._filter(column, "gte", value)
+
+    def lt(self, column: str, value: Any) -> "SupabaseQuery":
+        return self._filter(column, "lt", value)
+
+    def lte(self, column: str, value: Any) -> "SupabaseQuery":
+        return self._filter(column, "lte", value)
+
+    def in_(self, column: str, values: List[Any]) -> "SupabaseQuery":
+        quoted = ",".join('"%s"' % self._value(v).replace('"', '\\"') for v in values)
+        self._params.append((column, f"in.({quoted})"))
+        return self
+
+    def or_(self, filters: str) -> "SupabaseQuery":
+        self._params.append(("or", f"({filters})"))
+        return self
+
+    def order(self, column: str, desc: bool = False) -> "SupabaseQuery":
+        self._order.append(f"{column}.{'desc' if desc else 'asc'}")
+        return self
+
+    def limit(self, n: int) -> "SupabaseQuery":
+        self._params.append(("limit", str(int(n))))
+        return self
+
+    async def execute(self) -> SupabaseResult:
+        params = list(self._params)
+        if self._order:
+            params.append(("order", ",".join(self._order)))
+        headers = {"Prefer": self._prefer} if self._prefer else None
+        return SupabaseResult(await self._client.request(self._method, self._path, params, self._body, headers))
+
+
+class SupabaseRest:
+    """Client asynchrone de l'API REST (PostgREST) de Supabase.
+
+    Toutes les requêtes partagent un httpx.AsyncClient dont le pool de connexions keep-alive est borné
+    par pool_size : les requêtes concurrentes s'exécutent en parallèle jusqu'à cette limite. Seul PostgREST
+    est utilisé (ni auth, ni storage, ni realtime) : ce client remplace supabase-py et ses dépendances.
+    """
+
+    def __init__(self, url: str, key: str, pool_size: int = 20, timeout: float = 10.0, connect_timeout: float = 5.0) -> None:
+        self.base_url = url.rstrip("/") + "/rest/v1"
+        self.headers = {"apikey": key, "Authorization": f"Bearer {key}"}
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self._http: Optional[httpx.AsyncClient] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _client(self) -> httpx.AsyncClient:
+        # Les connexions du pool sont liées à la boucle asyncio qui les a ouvertes
+        loop = asyncio.get_running_loop()
+        if self._http is None or self._loop is not loop:
+            if self._http is not None:
+                self._retire(self._http, self._loop)
+            self._http = httpx.AsyncClient(base_url=self.base_url, headers=self.headers, limits=self.limits, timeout=self.timeout)
+            self._loop = loop
+        return self._http
+
+    @staticmethod
+    def _retire(http: httpx.AsyncClient, loop: Optional[asyncio.AbstractEventLoop]) -> None:
+        """Ferme le client d'une boucle précédente, remplacé par celui de la boucle courante."""
+        if loop is not None and loop.is_running():
+            # Boucle encore active (autre thread) : ses connexions sont fermées proprement sur celle-ci
+            asyncio.run_coroutine_threadsafe(http.aclose(), loop)
+            return
+        # Boucle arrêtée : ses transports ne peuvent plus être fermés par elle ; le client n'est plus référencé
+        # et ses sockets sont libérées avec lui
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] Dropping Supabase HTTP client of a stopped event loop")
+
+    async def request(self, method: str, path: str, params: Optional[List[Tuple[str, str]]] = None, body: Any = None, headers: Optional[Dict[str, str]] = None) -> Any:
+        start = time.perf_counter()
+        try:
+            resp = await self._client().request(method, path, params=params, json=body, headers=headers)
+        finally:
+            SUPABASE_LATENCY.observe((path.lstrip("/"), method), time.perf_counter() - start)
+        resp.raise_for_status()
+        if not resp.content:
+            return None
+        return resp.json()
+
+    def table(self, name: str) -> SupabaseQuery:
+        return SupabaseQuery(self, f"/{name}")
+
+    def rpc(self, fn: str, params: Dict[str, Any]) -> SupabaseQuery:
+        return SupabaseQuery(self, f"/rpc/{fn}", "POST", params)
+
+    async def aclose(self) -> None:
+        if self._http is not None:
+            http, self._http = self._http, None
+            try:
+                await http.aclose()
+            except RuntimeError:
+                # Boucle d'origine déjà fermée : les sockets sont libérées avec elle
+                pass
+
+
+def _supabase_client() -> Optional[SupabaseRest]:
     global SUPABASE_CLIENT
     if SUPABASE_CLIENT is not None:
         return SUPABASE_CLIENT
 
-    if not (SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY and create_client):
+    if not (SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY):
         if DEV_MODE:
-            print("[AutoQCM][DEBUG] Supabase client not created: missing config or package.")
+            print("[AutoQCM][DEBUG] Supabase client not created: missing config.")
             print("  SUPABASE_URL set:", bool(SUPABASE_URL))
             print("  SUPABASE_SERVICE_ROLE_KEY set:", bool(SUPABASE_SERVICE_ROLE_KEY))
-            print("  supabase.create_client available:", bool(create_client))
         return None
     try:
-        client = create_client(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY)
-        SUPABASE_CLIENT = client
+        SUPABASE_CLIENT = SupabaseRest(SUPABASE_URL, SUPABASE_SERVICE_ROLE_KEY, SUPABASE_POOL_SIZE, SUPABASE_TIMEOUT, SUPABASE_CONNECT_TIMEOUT)
         if DEV_MODE:
             print("[AutoQCM][DEBUG] Supabase client created successfully.")
         return SUPABASE_CLIENT
@@ -154,344 +788,3592 @@ def _supabase_client() -> Optional["Client"]:
         return None
 
 
-def _get_user_role(supa: "Client", user_id: str) -> str:
-    res = supa.table("user_roles").select("role").eq("user_id", user_id).limit(1).execute()
-    rows = getattr(res, "data", None) or []
-    if rows:
-        role = rows[0].get("role") or DEFAULT_ROLE
-        return str(role)
-    return DEFAULT_ROLE
+# ---------- In-memory store ----------
+class MemoryQcmStore:
+    """Store mémoire des QCM sauvegardés, utilisé quand Supabase n'est pas configuré.
 
+    Chaque QCM est gardé sous forme compacte : un tuple (user_id, name, score, created_at, qcm en JSON
+    compact). Un index par utilisateur, trié par (created_at, id), sert l'historique paginé. Au-delà de
+    max_entries enregistrements ou de max_bytes octets (approximatifs), les QCM les moins récemment lus
+    ou écrits sont évincés.
+    """
 
-def _get_usage(supa: "Client", user_id: str):
-    res = supa.table("qcm_usage").select("model,generated_count").eq("user_id", user_id).execute()
-    rows = getattr(res, "data", None) or []
-    per_model = []
-    total = 0
-    for it in rows:
-        model = it.get("model")
-        count = it.get("generated_count") or 0
-        if model is None:
-            continue
-        count_int = int(count)
-        per_model.append({"model": model, "count": count_int})
-        total += count_int
-    return per_model, total
+    # Coût fixe approximatif d'un enregistrement (tuple, clés d'index, entrée de dictionnaire)
+    RECORD_OVERHEAD = 320
 
+    def __init__(self, max_entries: int = 0, max_bytes: int = 0) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._records: "OrderedDict[str, Tuple[str, Optional[str], Optional[int], str, bytes]]" = OrderedDict()
+        self._by_user: Dict[str, List[Tuple[str, str]]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
 
-def _ensure_gemini():
-    if not genai:
-        raise RuntimeError("google-generativeai not installed. Install deps or set GEMINI_API_KEY.")
-    key = os.getenv("GEMINI_API_KEY")
-    if not key:
-        raise RuntimeError("GEMINI_API_KEY not set.")
-    genai.configure(api_key=key)
+    def __len__(self) -> int:
+        return len(self._records)
 
+    def __contains__(self, qid: str) -> bool:
+        return qid in self._records
 
-def _generate_via_langchain(skills: List[str], count: int, name: Optional[str], difficulty: str) -> GenerateResponse:
-    if not ChatGoogleGenerativeAI:
-        raise RuntimeError("LangChain Google GenAI provider not available")
-    api_key = os.getenv("GEMINI_API_KEY")
-    if not api_key:
-        raise RuntimeError("GEMINI_API_KEY not set")
-    # En DEV, on ajoute un callback pour logger les retries ; sinon, aucun callback explicite
-    callbacks = [RetryLoggingHandler()] if BaseCallbackHandler and DEV_MODE else None  # type: ignore
-    llm = ChatGoogleGenerativeAI(
-        model=GEMINI_MODEL,
-        google_api_key=api_key,
-        temperature=0.7,
-        callbacks=callbacks,
-    )
-    msg = (
-        "Tu génères un QCM JSON en français. Réponds UNIQUEMENT en JSON.\n"
-        "Structure attendue: {\"name\": string?, \"items\": [ { \"id\": string, \"question\": string, \"choices\": [string,string,string,string], \"answer_index\": 0..3, \"skill\": string?, \"explanation\": string? } ] }\n"
-        f"Compétences: {skills}. Nombre de questions: {count}. Niveau de difficulté / style: {difficulty}. "
-        "Règles: une seule bonne réponse, langue FR."
-    )
-    result = llm.invoke(msg)
-    if isinstance(result, str):
-        text = result
-    else:
-        content = getattr(result, "content", None)
-        if isinstance(content, str):
-            text = content
-        elif isinstance(content, list):
-            parts = []
-            for part in content:
-                if isinstance(part, dict):
-                    t = part.get("text")
-                    if t:
-                        parts.append(t)
-                else:
-                    t = getattr(part, "text", None)
-                    if t:
-                        parts.append(t)
-            text = "\n".join(parts)
-        else:
-            text = getattr(result, "text", "") or str(result)
-    if DEV_MODE:
-        print("[AutoQCM][DEBUG] LangChain Gemini raw text:", str(text)[:400])
-    data = _extract_json(text)
-    name_out = data.get("name") if isinstance(data, dict) else None
-    items_raw = data.get("items") if isinstance(data, dict) else data
-    items: List[QcmItem] = []
-    for it in items_raw[:count]:
-        items.append(QcmItem(
-            id=it.get("id") or str(uuid.uuid4()),
-            question=it["question"],
-            choices=it["choices"][:4],
-            answer_index=int(it.get("answer_index", 0)),
-            skill=it.get("skill"),
-            explanation=it.get("explanation")
-        ))
-    return GenerateResponse(name=name_out or name, items=items)
+    @property
+    def nbytes(self) -> int:
+        return self._bytes
 
+    def count(self, user_id: str) -> int:
+        return len(self._by_user.get(user_id) or ())
 
-def _extract_json(text: str) -> dict:
-    # Try to extract a JSON object even if wrapped in markdown
-    start = text.find("{")
-    end = text.rfind("}")
-    if start != -1 and end != -1 and end > start:
-        return json.loads(text[start:end + 1])
-    # Fallback to parse as array
-    start = text.find("[")
-    end = text.rfind("]")
-    if start != -1 and end != -1 and end > start:
-        return json.loads(text[start:end + 1])
-    # Last resort
-    return json.loads(text)
+    def _size(self, qid: str, rec: Tuple[str, Optional[str], Optional[int], str, bytes]) -> int:
+        return self.RECORD_OVERHEAD + len(qid) + len(rec[0]) + len(rec[1] or "") + len(rec[3]) + len(rec[4])
 
+    def put(self, qid: str, user_id: str, name: Optional[str], qcm_json: bytes, score: Optional[int], created_at: str) -> None:
+        rec = (user_id, name, score, created_at, qcm_json)
+        with self._lock:
+            self._discard(qid)
+            self._records[qid] = rec
+            self._bytes += self._size(qid, rec)
+            insort(self._by_user.setdefault(user_id, []), (created_at, qid))
+            # Le QCM tout juste écrit n'est jamais évincé, même s'il dépasse seul max_bytes
+            while len(self._records) > 1 and (
+                (self.max_entries and len(self._records) > self.max_entries)
+                or (self.max_bytes and self._bytes > self.max_bytes)
+            ):
+                self._discard(next(iter(self._records)))
+                self.evictions += 1
 
-def _generate_fallback(skills: List[str], count: int, name: Optional[str], difficulty: str) -> GenerateResponse:
-    items: List[QcmItem] = []
-    for i in range(count):
-        skill = (skills[i % len(skills)] if skills else None)
-        items.append(QcmItem(
-            id=str(uuid.uuid4()),
-            question=f"[Fallback {difficulty}] Question {i+1} sur {skill or 'Compétence'} ?",
-            choices=["Choix A", "Choix B", "Choix C", "Choix D"],
-            answer_index=0,
-            skill=skill,
-            explanation="Réponse par défaut (fallback)."
-        ))
-    return GenerateResponse(name=name, items=items)
+    def get(self, qid: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            rec = self._records.get(qid)
+            if rec is None:
+                return None
+            self._records.move_to_end(qid)
+        return {"id": qid, "user_id": rec[0], "name": rec[1], "qcm": json.loads(rec[4]), "score": rec[2], "created_at": rec[3]}
 
+    def remove(self, qid: str) -> bool:
+        with self._lock:
+            return self._discard(qid)
 
-def _qcm_to_json_dict(qcm: GenerateResponse) -> dict:
-    """Convertit un modèle GenerateResponse en dict JSON, compatible Pydantic v1/v2."""
-    # Pydantic v2
-    if hasattr(qcm, "model_dump"):
-        return qcm.model_dump()  # type: ignore[no-any-return]
-    # Pydantic v1 (ou compat)
-    if hasattr(qcm, "dict"):
-        return qcm.dict()  # type: ignore[no-any-return]
-    # Fallback très défensif
-    return json.loads(qcm.json())  # type: ignore[no-any-return]
+    def _discard(self, qid: str) -> bool:
+        rec = self._records.pop(qid, None)
+        if rec is None:
+            return False
+        self._bytes -= self._size(qid, rec)
+        keys = self._by_user.get(rec[0]) or []
+        key = (rec[3], qid)
+        pos = bisect_left(keys, key)
+        if pos < len(keys) and keys[pos] == key:
+            del keys[pos]
+        if not keys:
+            self._by_user.pop(rec[0], None)
+        return True
 
+    def delete_where(
+        self,
+        user_id: str,
+        ids: Optional[List[str]] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> List[str]:
+        """Supprime les QCM de user_id parmi ids et/ou dans [since, until) ; renvoie les ids supprimés."""
+        with self._lock:
+            if ids is not None:
+                candidates = [(self._records[qid][3], qid) for qid in dict.fromkeys(ids) if qid in self._records and self._records[qid][0] == user_id]
+            else:
+                candidates = list(self._by_user.get(user_id) or ())
+            deleted = []
+            for created_at, qid in candidates:
+                if (since and created_at < since) or (until and created_at >= until):
+                    continue
+                self._discard(qid)
+                deleted.append(qid)
+            return deleted
 
-async def _verify_and_get_user_id(authorization: Optional[str] = Header(default=None)) -> str:
-    if authorization and authorization.lower().startswith("bearer "):
-        token = authorization.split(" ", 1)[1]
-        # Best-effort decode without verification in dev. In production, verify with JWKS.
-        if jwt:
-            try:
-                payload = jwt.decode(token, options={"verify_signature": False})
-                sub = payload.get("sub") or payload.get("user_id")
-                if sub:
-                    return str(sub)
-            except Exception:
-                pass
-        # If unable to decode, but token exists, accept in DEV mode
-        if DEV_MODE:
-            return DEV_USER_ID
-        raise HTTPException(status_code=401, detail="Invalid token")
-    if DEV_MODE:
-        return DEV_USER_ID
-    raise HTTPException(status_code=401, detail="Authorization required")
+    def page(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[str, str]] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """Équivalent mémoire de _list_qcm_tests (sans la colonne qcm) : deux dichotomies puis une tranche."""
+        with self._lock:
+            keys = self._by_user.get(user_id) or []
+            hi = len(keys)
+            if after:
+                hi = bisect_left(keys, after)
+            if until:
+                hi = min(hi, bisect_left(keys, (until,)))
+            lo = bisect_left(keys, (since,)) if since else 0
+            if limit is not None:
+                lo = max(lo, hi - limit)
+            page = []
+            for created_at, qid in reversed(keys[lo:hi]):
+                rec = self._records[qid]
+                page.append({"id": qid, "user_id": rec[0], "name": rec[1], "score": rec[2], "created_at": created_at})
+            return page
 
+    def qcm_payloads(self, user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Contenu des QCM de l'utilisateur, du plus récent au plus ancien (les limit premiers si précisé)."""
+        with self._lock:
+            keys = self._by_user.get(user_id) or []
+            blobs = [self._records[qid][4] for _, qid in reversed(keys[-limit:] if limit else keys)]
+        return [json.loads(blob) for blob in blobs]
 
-# ---------- Endpoints ----------
-@app.post("/generate_qcm", response_model=GenerateResponse)
-async def generate_qcm(req: GenerateRequest, user_id: str = Depends(_verify_and_get_user_id)):
-    skills = req.skills or []
-    count = max(1, min(50, req.count or 10))
-    difficulty = (req.difficulty or "entretien").strip() or "entretien"
-    supa = _supabase_client()
-    role = DEFAULT_ROLE
-    limit = ROLE_LIMITS.get(role)
-    total_before = 0
-    if supa:
-        try:
-            role = _get_user_role(supa, user_id)
-            if role not in ROLE_LIMITS:
-                raise HTTPException(status_code=403, detail="Rôle utilisateur inconnu, génération de QCM interdite.")
-            limit = ROLE_LIMITS.get(role)
-            _, total_before = _get_usage(supa, user_id)
-        except HTTPException:
-            # Propager directement les erreurs HTTP explicites (ex: rôle inconnu)
-            raise
-        except Exception as e:
-            if DEV_MODE:
-                print("[AutoQCM][DEBUG] Failed to compute quota:", repr(e))
-            raise HTTPException(status_code=500, detail="Configuration des quotas QCM invalide. Contactez l'administrateur.")
-    if supa and limit is not None and total_before >= int(limit):
-        raise HTTPException(status_code=403, detail="Limite de génération de QCM atteinte pour votre rôle.")
+    def save_snapshot(self, path: str) -> int:
+        """Écrit tous les QCM (du moins au plus récemment utilisé) en JSON Lines, de façon atomique."""
+        with self._lock:
+            items = list(self._records.items())
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            for qid, (user_id, name, score, created_at, blob) in items:
+                meta = json.dumps({"id": qid, "user_id": user_id, "name": name, "score": score, "created_at": created_at}, separators=(",", ":"))
+                f.write(meta[:-1].encode("utf-8") + b',"qcm":' + blob + b"}\n")
+        os.replace(tmp, path)
+        return len(items)
 
-    model_name = GEMINI_MODEL
-    try:
-        if not ChatGoogleGenerativeAI:
-            raise RuntimeError("LangChain Google GenAI provider not available")
-        response = _generate_via_langchain(skills, count, req.name, difficulty)
-        model_name = GEMINI_MODEL
-    except Exception as e:
-        if DEV_MODE:
-            print("[AutoQCM][DEBUG] Gemini generation failed:", repr(e))
-        # Plus de QCM fallback : on renvoie une erreur explicite au client
-        raise HTTPException(status_code=503, detail="Service de génération de QCM indisponible ou en erreur. Veuillez réessayer plus tard.")
+    def load_snapshot(self, path: str) -> int:
+        if not os.path.exists(path):
+            return 0
+        loaded = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                qcm_json = json.dumps(row["qcm"], separators=(",", ":")).encode("utf-8")
+                self.put(row["id"], row["user_id"], row.get("name"), qcm_json, row.get("score"), row["created_at"])
+                loaded += 1
+        return loaded
 
-    if supa:
-        try:
-            res = supa.table("qcm_usage").select("generated_count").eq("user_id", user_id).eq("model", model_name).limit(1).execute()
-            rows = getattr(res, "data", None) or []
-            if rows:
-                current = (rows[0].get("generated_count") or 0) + 1
-                supa.table("qcm_usage").update({"generated_count": int(current)}).eq("user_id", user_id).eq("model", model_name).execute()
-            else:
-                supa.table("qcm_usage").insert({"user_id": user_id, "model": model_name, "generated_count": 1}).execute()
-        except Exception as e:
-            if DEV_MODE:
-                print("[AutoQCM][DEBUG] Failed to update usage:", repr(e))
 
-    return response
+STORE = MemoryQcmStore(STORE_MAX_ENTRIES, STORE_MAX_BYTES)
 
 
-@app.post("/save_qcm")
-async def save_qcm(req: SaveRequest, user_id: str = Depends(_verify_and_get_user_id)):
-    if user_id != req.user_id and not DEV_MODE:
-        raise HTTPException(status_code=403, detail="Forbidden")
+async def _snapshot_store() -> None:
+    if not STORE_SNAPSHOT_PATH:
+        return
+    try:
+        saved = await run_in_threadpool(STORE.save_snapshot, STORE_SNAPSHOT_PATH)
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] Saved", saved, "QCM to", STORE_SNAPSHOT_PATH)
+    except Exception as e:
+        print("[AutoQCM] Store snapshot failed:", repr(e))
 
-    supa = _supabase_client()
-    record_id = str(uuid.uuid4())
-    now = datetime.utcnow().isoformat()
 
-    if supa:
-        try:
-            payload = {
-                "id": record_id,
-                "user_id": req.user_id,
-                "name": req.qcm.name,
-                "qcm": _qcm_to_json_dict(req.qcm),
-                "score": req.score,
-                "created_at": now,
-            }
-            if DEV_MODE:
-                print("[AutoQCM][DEBUG] Saving QCM to Supabase with payload id=", record_id)
-            res = supa.table("qcm_tests").insert(payload).execute()
-            if getattr(res, "error", None):  # type: ignore
-                if DEV_MODE:
-                    print("[AutoQCM][DEBUG] Supabase insert error:", res.error)  # type: ignore
-                raise HTTPException(status_code=500, detail=str(res.error))  # type: ignore
-            return {"id": record_id}
-        except Exception as e:
-            if DEV_MODE:
-                print("[AutoQCM][DEBUG] Exception while saving to Supabase:", repr(e))
-            raise HTTPException(status_code=500, detail=str(e))
-    # Fallback in-memory
-    if DEV_MODE:
-        print("[AutoQCM][DEBUG] Saving QCM to in-memory STORE (Supabase client unavailable)")
-    STORE[record_id] = {
-        "id": record_id,
-        "user_id": req.user_id,
-        "name": req.qcm.name,
-        "qcm": _qcm_to_json_dict(req.qcm),
-        "score": req.score,
-        "created_at": now,
-    }
-    return {"id": record_id}
+async def _snapshot_loop() -> None:
+    while True:
+        await asyncio.sleep(STORE_SNAPSHOT_INTERVAL)
+        await _snapshot_store()
 
 
-@app.get("/history/{user_id}", response_model=List[HistoryItem])
-async def history(user_id: str, _current: str = Depends(_verify_and_get_user_id)):
-    supa = _supabase_client()
+# ---------- Repositories (qcm_tests, user_roles, qcm_usage) ----------
+class QcmTestRow(TypedDict, total=False):
+    id: str
+    user_id: str
+    name: Optional[str]
+    qcm: Dict[str, Any]
+    score: Optional[int]
+    created_at: str
+
+
+async def _execute(query: Any) -> Any:
+    """Exécute une requête : attendue directement si execute() est asynchrone, sinon dans le threadpool."""
+    if asyncio.iscoroutinefunction(query.execute):
+        return await query.execute()
+    return await run_in_threadpool(query.execute)
+
+
+def _rows(res: Any) -> List[Dict[str, Any]]:
+    return getattr(res, "data", None) or []
+
+
+# ---------- SQLite storage ----------
+class SqliteDatabase:
+    """Base embarquée (SQLite, mode WAL) alternative à Supabase pour les déploiements mono-nœud.
+
+    Le schéma reprend supabase/supabase.sql (qcm_tests, user_roles, qcm_usage et l'index
+    idx_qcm_tests_user_created) ; le contenu des QCM est stocké en JSON compact. Les requêtes sont
+    paramétrées et leurs statements préparés restent en cache sur la connexion.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+        if path != ":memory:":
+            self._conn.execute("pragma journal_mode=wal")
+            self._conn.execute("pragma synchronous=normal")
+        self._conn.executescript(
+            """
+            create table if not exists qcm_tests (
+              id text primary key,
+              user_id text not null,
+              name text,
+              qcm blob not null,
+              score integer,
+              created_at text not null
+            );
+            create table if not exists user_roles (
+              user_id text primary key,
+              role text not null default 'user'
+            );
+            create table if not exists qcm_usage (
+              user_id text not null,
+              model text not null,
+              generated_count integer not null default 0,
+              primary key (user_id, model)
+            );
+            create index if not exists idx_qcm_tests_user_created on qcm_tests(user_id, created_at desc);
+            create table if not exists questions (
+              hash text primary key,
+              item blob not null,
+              created_at text not null
+            ) without rowid;
+            """
+        )
+        self._conn.commit()
+
+    def get_user_role(self, user_id: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute("select role from user_roles where user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def set_user_role(self, user_id: str, role: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "insert into user_roles (user_id, role) values (?, ?) on conflict (user_id) do update set role = excluded.role",
+                (user_id, role),
+            )
+            self._conn.commit()
+
+    def get_usage(self, user_id: str) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self._conn.execute("select model, generated_count from qcm_usage where user_id = ?", (user_id,)).fetchall()
+
+    def increment_usage(self, rows: List[Tuple[str, str, int]]) -> None:
+        """Applique des incréments (user_id, model, delta) en une transaction (upsert, comme increment_qcm_usage)."""
+        with self._lock:
+            self._conn.executemany(
+                "insert into qcm_usage (user_id, model, generated_count) values (?, ?, ?)"
+                " on conflict (user_id, model) do update set generated_count = generated_count + excluded.generated_count",
+                rows,
+            )
+            self._conn.commit()
+
+    def insert_qcm_tests(self, rows: List[QcmTestRow], questions: Optional[Dict[str, Dict[str, Any]]] = None) -> None:
+        """Insère les QCM et, dans la même transaction, les questions qu'ils référencent (si absentes)."""
+        values = [
+            (row["id"], row["user_id"], row.get("name"), json.dumps(row.get("qcm") or {}, separators=(",", ":")).encode("utf-8"), row.get("score"), row["created_at"])
+            for row in rows
+        ]
+        now = datetime.utcnow().isoformat()
+        with self._lock:
+            if questions:
+                self._conn.executemany(
+                    "insert or ignore into questions (hash, item, created_at) values (?, ?, ?)",
+                    [(h, json.dumps(item, ensure_ascii=False, separators=(",", ":")).encode("utf-8"), now) for h, item in questions.items()],
+                )
+            self._conn.executemany("insert into qcm_tests (id, user_id, name, qcm, score, created_at) values (?, ?, ?, ?, ?, ?)", values)
+            self._conn.commit()
+
+    def fetch_questions(self, hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+        found: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                chunk = hashes[i:i + 500]
+                sql = "select hash, item from questions where hash in (%s)" % ",".join("?" * len(chunk))
+                for h, item in self._conn.execute(sql, chunk):
+                    found[h] = json.loads(item)
+        return found
+
+    def insert_qcm_test(self, row: QcmTestRow) -> None:
+        self.insert_qcm_tests([row])
+
+    def list_qcm_tests(
+        self,
+        user_id: str,
+        limit: Optional[int] = None,
+        after: Optional[Tuple[str, str]] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> List[QcmTestRow]:
+        sql = "select id, user_id, name, score, created_at from qcm_tests where user_id = ?"
+        params: List[Any] = [user_id]
+        if since:
+            sql += " and created_at >= ?"
+            params.append(since)
+        if until:
+            sql += " and created_at < ?"
+            params.append(until)
+        if after:
+            sql += " and (created_at < ? or (created_at = ? and id < ?))"
+            params += [after[0], after[0], after[1]]
+        sql += " order by created_at desc, id desc"
+        if limit is not None:
+            sql += " limit ?"
+            params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [{"id": r[0], "user_id": r[1], "name": r[2], "score": r[3], "created_at": r[4]} for r in rows]
+
+    def list_qcm_payloads(self, user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        with self._lock:
+            blobs = self._conn.execute(
+                "select qcm from qcm_tests where user_id = ? order by created_at desc, id desc limit ?",
+                (user_id, limit if limit else -1),
+            ).fetchall()
+        return [json.loads(b[0]) for b in blobs]
+
+    def get_qcm_test(self, qid: str) -> Optional[QcmTestRow]:
+        with self._lock:
+            r = self._conn.execute("select id, user_id, name, qcm, score, created_at from qcm_tests where id = ?", (qid,)).fetchone()
+        if r is None:
+            return None
+        return {"id": r[0], "user_id": r[1], "name": r[2], "qcm": json.loads(r[3]), "score": r[4], "created_at": r[5]}
+
+    def delete_qcm_test(self, qid: str) -> None:
+        with self._lock:
+            self._conn.execute("delete from qcm_tests where id = ?", (qid,))
+            self._conn.commit()
+
+    def delete_qcm_tests(
+        self,
+        user_id: str,
+        ids: Optional[List[str]] = None,
+        since: Optional[str] = None,
+        until: Optional[str] = None,
+    ) -> List[str]:
+        where = "user_id = ?"
+        params: List[Any] = [user_id]
+        if ids is not None:
+            where += " and id in (%s)" % ",".join("?" * len(ids))
+            params += ids
+        if since:
+            where += " and created_at >= ?"
+            params.append(since)
+        if until:
+            where += " and created_at < ?"
+            params.append(until)
+        with self._lock:
+            deleted = [r[0] for r in self._conn.execute(f"select id from qcm_tests where {where}", params)]
+            self._conn.execute(f"delete from qcm_tests where {where}", params)
+            self._conn.commit()
+        return deleted
+
+
+# ---------- Storage backends ----------
+class StorageBackend(ABC):
+    """Stockage des QCM sauvegardés, rôles et usages ; une implémentation par backend (STORAGE_BACKENDS).
+
+    Les QCM sont reçus et rendus tels que stockés : le découpage des questions (normalized_questions) et leur
+    réhydratation sont faits par les fonctions _insert_qcm_tests / _get_qcm_test / _list_qcm_payloads.
+    """
+
+    # Horodatages created_at comparés avec fuseau (timestamptz) ou en ISO naïf UTC
+    aware_timestamps = True
+
+    @property
+    def normalized_questions(self) -> bool:
+        """Questions stockées à part (table questions) et référencées par empreinte dans les QCM."""
+        return False
+
+    @abstractmethod
+    async def get_user_role(self, user_id: str) -> Optional[str]: ...
+
+    @abstractmethod
+    async def get_usage(self, user_id: str) -> List[Tuple[str, int]]:
+        """(modèle, nombre de générations) de l'utilisateur."""
+
+    @abstractmethod
+    async def increment_usage(self, user_id: str, model: str, delta: int) -> None:
+        """Incrément atomique ; une erreur ambiguë est propagée sans nouvel essai (l'écriture a pu être validée)."""
+
+    @abstractmethod
+    async def increment_usage_batch(self, rows: List[Dict[str, Any]], batch_id: str) -> None:
+        """Incréments {user_id, model, delta} en une écriture ; un lot déjà appliqué (même batch_id) est ignoré."""
+
+    @abstractmethod
+    async def fetch_questions(self, hashes: List[str]) -> Dict[str, Dict[str, Any]]: ...
+
+    @abstractmethod
+    async def insert_qcm_tests(self, rows: List[QcmTestRow], questions: Dict[str, Dict[str, Any]]) -> None:
+        """Insère les QCM et les questions qu'ils référencent (questions vide si non normalisées)."""
+
+    async def insert_qcm_test(self, row: QcmTestRow) -> None:
+        """Insère un QCM complet (questions non normalisées)."""
+        await self.insert_qcm_tests([row], {})
+
+    @abstractmethod
+    async def list_qcm_tests(self, user_id: str, limit: Optional[int], after: Optional[Tuple[str, str]],
+                             since: Optional[str], until: Optional[str]) -> List[QcmTestRow]: ...
+
+    @abstractmethod
+    async def list_qcm_payloads(self, user_id: str, limit: Optional[int]) -> List[Dict[str, Any]]: ...
+
+    @abstractmethod
+    async def get_qcm_test(self, qid: str) -> Optional[QcmTestRow]: ...
+
+    @abstractmethod
+    async def delete_qcm_tests(self, user_id: str, ids: Optional[List[str]], since: Optional[str],
+                               until: Optional[str]) -> List[str]: ...
+
+    @abstractmethod
+    async def delete_qcm_test(self, qid: str) -> None: ...
+
+
+class SupabaseStorage(StorageBackend):
+    """Backend Supabase : requêtes PostgREST (client SupabaseRest) et fonctions RPC de supabase/supabase.sql."""
+
+    def __init__(self, client: Any) -> None:
+        self.client = client
+
+    @property
+    def normalized_questions(self) -> bool:
+        return NORMALIZED_QUESTIONS
+
+    async def get_user_role(self, user_id: str) -> Optional[str]:
+        rows = _rows(await _execute(self.client.table("user_roles").select("role").eq("user_id", user_id).limit(1)))
+        if rows:
+            return str(rows[0].get("role") or DEFAULT_ROLE)
+        return None
+
+    async def get_usage(self, user_id: str) -> List[Tuple[str, int]]:
+        rows = _rows(await _execute(self.client.table("qcm_usage").select("model,generated_count").eq("user_id", user_id)))
+        return [(it.get("model"), int(it.get("generated_count") or 0)) for it in rows]
+
+    async def increment_usage(self, user_id: str, model: str, delta: int) -> None:
+        """Un appel RPC (increment_qcm_usage) ; repli lecture puis écriture (non atomique) si la fonction n'existe pas."""
+        try:
+            await _execute(self.client.rpc("increment_qcm_usage", {"p_user_id": user_id, "p_model": model, "p_delta": int(delta)}))
+            return
+        except Exception as e:
+            if not _rpc_missing(e):
+                raise
+            print("[AutoQCM] increment_qcm_usage RPC missing, falling back to select/update (run supabase/supabase.sql):", repr(e))
+        usage = self.client.table("qcm_usage")
+        rows = _rows(await _execute(usage.select("generated_count").eq("user_id", user_id).eq("model", model).limit(1)))
+        if rows:
+            current = (rows[0].get("generated_count") or 0) + int(delta)
+            await _execute(self.client.table("qcm_usage").update({"generated_count": int(current)}).eq("user_id", user_id).eq("model", model))
+        else:
+            await _execute(self.client.table("qcm_usage").insert({"user_id": user_id, "model": model, "generated_count": int(delta)}))
+
+    async def increment_usage_batch(self, rows: List[Dict[str, Any]], batch_id: str) -> None:
+        await _execute(self.client.rpc("increment_qcm_usage_batch", {"p_rows": rows, "p_batch_id": batch_id}))
+
+    async def fetch_questions(self, hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+        chunks = [hashes[i:i + QUESTIONS_FETCH_CHUNK] for i in range(0, len(hashes), QUESTIONS_FETCH_CHUNK)]
+        results = await asyncio.gather(*(_execute(self.client.table("questions").select("hash,item").in_("hash", chunk)) for chunk in chunks))
+        return {row["hash"]: row["item"] for res in results for row in _rows(res)}
+
+    async def insert_qcm_tests(self, rows: List[QcmTestRow], questions: Dict[str, Dict[str, Any]]) -> None:
+        if questions:
+            await _execute(self.client.table("questions").upsert([{"hash": h, "item": it} for h, it in questions.items()], on_conflict="hash", ignore_duplicates=True))
+        await _execute(self.client.table("qcm_tests").insert(rows))
+
+    async def insert_qcm_test(self, row: QcmTestRow) -> None:
+        await _execute(self.client.table("qcm_tests").insert(row))
+
+    async def list_qcm_tests(self, user_id: str, limit: Optional[int], after: Optional[Tuple[str, str]],
+                             since: Optional[str], until: Optional[str]) -> List[QcmTestRow]:
+        query = self.client.table("qcm_tests").select("id,user_id,name,score,created_at").eq("user_id", user_id)
+        if since:
+            query = query.gte("created_at", since)
+        if until:
+            query = query.lt("created_at", until)
+        if after:
+            created_at, last_id = after
+            query = query.or_(f'created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{last_id})')
+        query = query.order("created_at", desc=True).order("id", desc=True)
+        if limit is not None:
+            query = query.limit(limit)
+        return _rows(await _execute(query))  # type: ignore[return-value]
+
+    async def list_qcm_payloads(self, user_id: str, limit: Optional[int]) -> List[Dict[str, Any]]:
+        query = self.client.table("qcm_tests").select("qcm").eq("user_id", user_id).order("created_at", desc=True).order("id", desc=True)
+        if limit is not None:
+            query = query.limit(limit)
+        return [row.get("qcm") or {} for row in _rows(await _execute(query))]
+
+    async def get_qcm_test(self, qid: str) -> Optional[QcmTestRow]:
+        rows = _rows(await _execute(self.client.table("qcm_tests").select("*").eq("id", qid).limit(1)))
+        return rows[0] if rows else None  # type: ignore[return-value]
+
+    async def delete_qcm_tests(self, user_id: str, ids: Optional[List[str]], since: Optional[str],
+                               until: Optional[str]) -> List[str]:
+        query = self.client.table("qcm_tests").delete().eq("user_id", user_id)
+        if ids is not None:
+            query = query.in_("id", ids)
+        if since:
+            query = query.gte("created_at", since)
+        if until:
+            query = query.lt("created_at", until)
+        return [row["id"] for row in _rows(await _execute(query.select("id")))]
+
+    async def delete_qcm_test(self, qid: str) -> None:
+        await _execute(self.client.table("qcm_tests").delete().eq("id", qid))
+
+
+class SqliteStorage(StorageBackend):
+    """Backend SQLite : opérations de SqliteDatabase exécutées dans le threadpool ; questions toujours normalisées."""
+
+    aware_timestamps = False
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.db = SqliteDatabase(path)
+
+    @property
+    def normalized_questions(self) -> bool:
+        return True
+
+    async def get_user_role(self, user_id: str) -> Optional[str]:
+        return await run_in_threadpool(self.db.get_user_role, user_id)
+
+    async def get_usage(self, user_id: str) -> List[Tuple[str, int]]:
+        return await run_in_threadpool(self.db.get_usage, user_id)
+
+    async def increment_usage(self, user_id: str, model: str, delta: int) -> None:
+        await run_in_threadpool(self.db.increment_usage, [(user_id, model, int(delta))])
+
+    async def increment_usage_batch(self, rows: List[Dict[str, Any]], batch_id: str) -> None:
+        # Transaction locale : un échec signifie que rien n'a été écrit, le renvoi du lot ne compte pas deux fois
+        await run_in_threadpool(self.db.increment_usage, [(r["user_id"], r["model"], int(r["delta"])) for r in rows])
+
+    async def fetch_questions(self, hashes: List[str]) -> Dict[str, Dict[str, Any]]:
+        return await run_in_threadpool(self.db.fetch_questions, hashes)
+
+    async def insert_qcm_tests(self, rows: List[QcmTestRow], questions: Dict[str, Dict[str, Any]]) -> None:
+        await run_in_threadpool(self.db.insert_qcm_tests, rows, questions)
+
+    async def list_qcm_tests(self, user_id: str, limit: Optional[int], after: Optional[Tuple[str, str]],
+                             since: Optional[str], until: Optional[str]) -> List[QcmTestRow]:
+        return await run_in_threadpool(self.db.list_qcm_tests, user_id, limit, after, since, until)
+
+    async def list_qcm_payloads(self, user_id: str, limit: Optional[int]) -> List[Dict[str, Any]]:
+        return await run_in_threadpool(self.db.list_qcm_payloads, user_id, limit)
+
+    async def get_qcm_test(self, qid: str) -> Optional[QcmTestRow]:
+        return await run_in_threadpool(self.db.get_qcm_test, qid)
+
+    async def delete_qcm_tests(self, user_id: str, ids: Optional[List[str]], since: Optional[str],
+                               until: Optional[str]) -> List[str]:
+        return await run_in_threadpool(self.db.delete_qcm_tests, user_id, ids, since, until)
+
+    async def delete_qcm_test(self, qid: str) -> None:
+        await run_in_threadpool(self.db.delete_qcm_test, qid)
+
+
+def _supabase_storage() -> Optional[SupabaseStorage]:
+    global SUPABASE_STORAGE
+    client = _supabase_client()
+    if client is None:
+        return None
+    if SUPABASE_STORAGE is None or SUPABASE_STORAGE.client is not client:
+        SUPABASE_STORAGE = SupabaseStorage(client)
+    return SUPABASE_STORAGE
+
+
+def _sqlite_storage() -> SqliteStorage:
+    global SQLITE_STORAGE
+    if SQLITE_STORAGE is None or SQLITE_STORAGE.path != SQLITE_PATH:
+        SQLITE_STORAGE = SqliteStorage(SQLITE_PATH)
+    return SQLITE_STORAGE
+
+
+# Un backend de plus = une implémentation de StorageBackend et une entrée ici
+STORAGE_BACKENDS: Dict[str, Callable[[], Optional[StorageBackend]]] = {
+    "supabase": _supabase_storage,
+    "sqlite": _sqlite_storage,
+}
+Storage = StorageBackend
+
+
+def _storage() -> Optional[Storage]:
+    """Backend de stockage actif selon STORAGE_BACKEND ; None si Supabase n'est pas configuré (store mémoire)."""
+    return STORAGE_BACKENDS.get(STORAGE_BACKEND, _supabase_storage)()
+
+
+async def _get_user_role(supa: Storage, user_id: str) -> str:
+    return await supa.get_user_role(user_id) or DEFAULT_ROLE
+
+
+async def _get_usage(supa: Storage, user_id: str) -> Tuple[List[Dict[str, Any]], int]:
+    per_model = []
+    total = 0
+    for model, count in await supa.get_usage(user_id):
+        if model is None:
+            continue
+        per_model.append({"model": model, "count": int(count)})
+        total += int(count)
+    return per_model, total
+
+
+QUESTION_FIELDS = ("question", "choices", "answer_index", "skill", "explanation")
+# Nombre d'empreintes par requête de lecture de la table questions (taille de l'URL PostgREST)
+QUESTIONS_FETCH_CHUNK = 200
+
+
+def _split_questions(rows: List[QcmTestRow]) -> Tuple[List[QcmTestRow], Dict[str, Dict[str, Any]]]:
+    """Remplace les questions des QCM par leur empreinte {id, h} ; renvoie aussi {empreinte: question}."""
+    questions: Dict[str, Dict[str, Any]] = {}
+    out: List[QcmTestRow] = []
+    for row in rows:
+        doc = row.get("qcm") or {}
+        refs = []
+        for it in doc.get("items") or []:
+            h = _item_hash(it)
+            questions.setdefault(h, {k: it.get(k) for k in QUESTION_FIELDS})
+            refs.append({"id": it.get("id"), "h": h})
+        out.append({**row, "qcm": {**doc, "items": refs}})  # type: ignore[typeddict-item]
+    return out, questions
+
+
+async def _rehydrate_questions(supa: Storage, docs: List[Dict[str, Any]]) -> None:
+    """Remplace en place les références {id, h} par les questions, lues en une requête par lot d'empreintes.
+
+    Une référence dont l'empreinte est absente de la table questions est retirée (avec la réponse de la
+    tentative au même rang) : elle n'est jamais renvoyée au client comme si c'était une question.
+    """
+    hashes = list({it["h"] for doc in docs for it in doc.get("items") or [] if isinstance(it, dict) and "h" in it})
+    if not hashes:
+        return
+    found = await supa.fetch_questions(hashes)
+    missing = 0
+    for doc in docs:
+        items = doc.get("items") or []
+        answers = doc.get("answers")
+        aligned = isinstance(answers, list) and len(answers) == len(items)
+        kept_items: List[Any] = []
+        kept_answers: List[Any] = []
+        for idx, it in enumerate(items):
+            if isinstance(it, dict) and "h" in it:
+                if it["h"] not in found:
+                    missing += 1
+                    continue
+                it = {"id": it.get("id"), **found[it["h"]]}
+            kept_items.append(it)
+            if aligned:
+                kept_answers.append(answers[idx])
+        doc["items"] = kept_items
+        if aligned:
+            doc["answers"] = kept_answers
+    if missing:
+        print(f"[AutoQCM] {missing} question reference(s) missing from the questions table; dropped from the response")
+
+
+async def _insert_qcm_test(supa: Storage, row: QcmTestRow) -> None:
+    if supa.normalized_questions:
+        return await _insert_qcm_tests(supa, [row])
+    await supa.insert_qcm_test(row)
+
+
+async def _insert_qcm_tests(supa: Storage, rows: List[QcmTestRow]) -> None:
+    """Insère plusieurs QCM en une seule requête (plus une pour les questions si elles sont normalisées)."""
+    questions: Dict[str, Dict[str, Any]] = {}
+    if supa.normalized_questions:
+        rows, questions = _split_questions(rows)
+    await supa.insert_qcm_tests(rows, questions)
+
+
+async def _list_qcm_tests(
+    supa: Storage,
+    user_id: str,
+    limit: Optional[int] = None,
+    after: Optional[Tuple[str, str]] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> List[QcmTestRow]:
+    """QCM de l'utilisateur du plus récent au plus ancien, triés par (created_at desc, id desc).
+
+    after est la clé (created_at, id) de la dernière ligne de la page précédente (pagination par clé,
+    servie par l'index idx_qcm_tests_user_created) ; since / until bornent created_at (inclus / exclu).
+    """
+    return await supa.list_qcm_tests(user_id, limit, after, since, until)
+
+
+async def _list_qcm_payloads(supa: Storage, user_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+    """Contenu (colonne qcm) des QCM sauvegardés par l'utilisateur, les plus récents d'abord (limit premiers si précisé)."""
+    docs = await supa.list_qcm_payloads(user_id, limit)
+    await _rehydrate_questions(supa, docs)
+    return docs
+
+
+async def _get_qcm_test(supa: Storage, qid: str) -> Optional[QcmTestRow]:
+    row = await supa.get_qcm_test(qid)
+    if row and isinstance(row.get("qcm"), dict):
+        await _rehydrate_questions(supa, [row["qcm"]])
+    return row
+
+
+async def _delete_qcm_tests(
+    supa: Storage,
+    user_id: str,
+    ids: Optional[List[str]] = None,
+    since: Optional[str] = None,
+    until: Optional[str] = None,
+) -> List[str]:
+    """Supprime en une requête les QCM de user_id parmi ids et/ou dans [since, until) ; renvoie les ids supprimés."""
+    return await supa.delete_qcm_tests(user_id, ids, since, until)
+
+
+async def _delete_qcm_test(supa: Storage, qid: str) -> None:
+    await supa.delete_qcm_test(qid)
+
+
+class TTLCache:
+    """Cache mémoire borné et thread-safe : expiration après ttl secondes, éviction LRU au-delà de maxsize."""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Any, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: Any, value: Any, ttl: Optional[float] = None) -> None:
+        with self._lock:
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def update(self, key: Any, fn: Callable[[Any], Any]) -> bool:
+        """Applique fn à la valeur en cache (sans prolonger son TTL) ; renvoie False si la clé est absente."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                return False
+            self._data[key] = (entry[0], fn(entry[1]))
+            return True
+
+    def pop(self, key: Any) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+# user_id -> rôle ; user_id -> ({modèle: total}, total) incluant nos propres incréments (write-through)
+ROLE_CACHE = TTLCache(QUOTA_CACHE_MAX_ENTRIES, ROLE_CACHE_TTL)
+USAGE_CACHE = TTLCache(QUOTA_CACHE_MAX_ENTRIES, USAGE_CACHE_TTL)
+# qid -> CachedQcm (les QCM sauvegardés ne sont jamais modifiés, seulement supprimés)
+QCM_CACHE = TTLCache(QCM_CACHE_MAX_ENTRIES, QCM_CACHE_TTL)
+
+
+async def _cached_user_role(supa: Storage, user_id: str) -> str:
+    role = ROLE_CACHE.get(user_id)
+    if role is None:
+        role = await _get_user_role(supa, user_id)
+        ROLE_CACHE.set(user_id, role)
+    return role
+
+
+async def _cached_usage(supa: Storage, user_id: str) -> Tuple[Dict[str, int], int]:
+    """Totaux d'usage par modèle, incréments du tampon write-behind inclus ; lus dans qcm_usage si absents du cache."""
+    cached = USAGE_CACHE.get(user_id)
+    if cached is None:
+        per_model, total = await _get_usage(supa, user_id)
+        counts = {it["model"]: it["count"] for it in per_model}
+        for model, n in USAGE_BUFFER.pending_by_model(user_id).items():
+            counts[model] = counts.get(model, 0) + n
+        cached = (counts, total + USAGE_BUFFER.pending(user_id))
+        USAGE_CACHE.set(user_id, cached)
+    return cached
+
+
+def _usage_cache_add(user_id: str, model: str, delta: int = 1) -> None:
+    """Write-through : répercute un incrément d'usage sur l'entrée en cache, si elle existe."""
+    def apply(value: Tuple[Dict[str, int], int]) -> Tuple[Dict[str, int], int]:
+        counts = dict(value[0])
+        counts[model] = counts.get(model, 0) + delta
+        return counts, value[1] + delta
+    USAGE_CACHE.update(user_id, apply)
+
+
+def _invalidate_user_cache(user_id: Optional[str] = None) -> None:
+    """Oublie le rôle et l'usage en cache d'un utilisateur (ou de tous si user_id est None)."""
+    if user_id is None:
+        ROLE_CACHE.clear()
+        USAGE_CACHE.clear()
+    else:
+        ROLE_CACHE.pop(user_id)
+        USAGE_CACHE.pop(user_id)
+
+
+async def _compute_quota(supa: Storage, user_id: str) -> Tuple[str, Optional[int], int]:
+    """Retourne (rôle, limite, total déjà généré) pour l'utilisateur.
+
+    Servi depuis ROLE_CACHE / USAGE_CACHE quand c'est possible (aucun appel réseau à chaud) ;
+    le total inclut les incréments encore dans le tampon write-behind.
+    """
+    role = await _cached_user_role(supa, user_id)
+    if role not in ROLE_LIMITS:
+        raise HTTPException(status_code=403, detail="Rôle utilisateur inconnu, génération de QCM interdite.")
+    limit = ROLE_LIMITS.get(role)
+    _, total_before = await _cached_usage(supa, user_id)
+    return role, limit, total_before
+
+
+def _rpc_missing(e: Exception) -> bool:
+    """Vrai si PostgREST signale une fonction RPC absente du schéma (404 / PGRST202).
+
+    Toute autre erreur (timeout, 5xx, coupure) est ambiguë : l'appel a pu être validé côté base.
+    """
+    response = getattr(e, "response", None)
+    if not isinstance(e, httpx.HTTPStatusError) or response is None:
+        return False
+    try:
+        code = (response.json() or {}).get("code")
+    except Exception:
+        code = None
+    return response.status_code == 404 or code == "PGRST202"
+
+
+async def _increment_usage(supa: Storage, user_id: str, model_name: str, delta: int = 1) -> None:
+    """Incrémente qcm_usage de façon atomique (Supabase : un appel RPC increment_qcm_usage).
+
+    Le repli lecture puis écriture (non atomique) ne sert que si la fonction n'existe pas ; les autres
+    erreurs sont propagées sans nouvel essai, pour ne jamais compter deux fois un appel déjà validé.
+    """
+    await supa.increment_usage(user_id, model_name, int(delta))
+
+
+async def _increment_usage_batch(supa: Storage, rows: List[Dict[str, Any]], batch_id: str) -> None:
+    """Applique plusieurs incréments {user_id, model, delta} en une seule écriture (increment_qcm_usage_batch).
+
+    batch_id rend l'appel idempotent : un lot déjà appliqué (réponse perdue puis renvoi) est ignoré par la base.
+    """
+    await supa.increment_usage_batch(rows, batch_id)
+
+
+class UsageWriteBuffer:
+    """Tampon write-behind des incréments qcm_usage, regroupés par (user_id, modèle).
+
+    Chaque vidage scelle les incréments en attente dans un lot identifié, envoyé via la RPC
+    increment_qcm_usage_batch. Un lot en échec est renvoyé tel quel, avec le même identifiant, au vidage
+    suivant : s'il avait en fait été appliqué (timeout après validation), la base l'ignore.
+    """
+
+    def __init__(self) -> None:
+        self._pending: Dict[Tuple[str, str], int] = {}
+        self._unsent: "OrderedDict[str, Dict[Tuple[str, str], int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._task: Optional["asyncio.Task[None]"] = None
+
+    def add(self, user_id: str, model: str, delta: int = 1) -> None:
+        with self._lock:
+            key = (user_id, model)
+            self._pending[key] = self._pending.get(key, 0) + int(delta)
+
+    def _batches(self) -> List[Dict[Tuple[str, str], int]]:
+        return [self._pending, *self._unsent.values()]
+
+    def pending(self, user_id: str) -> int:
+        with self._lock:
+            return sum(n for batch in self._batches() for (u, _), n in batch.items() if u == user_id)
+
+    def pending_by_model(self, user_id: str) -> Dict[str, int]:
+        with self._lock:
+            counts: Dict[str, int] = {}
+            for batch in self._batches():
+                for (u, m), n in batch.items():
+                    if u == user_id:
+                        counts[m] = counts.get(m, 0) + n
+            return counts
+
+    def seal(self) -> List[Tuple[str, Dict[Tuple[str, str], int]]]:
+        """Scelle les incréments en attente dans un nouveau lot ; renvoie tous les lots à envoyer."""
+        with self._lock:
+            if self._pending:
+                self._unsent[str(uuid.uuid4())] = self._pending
+                self._pending = {}
+            return list(self._unsent.items())
+
+    async def flush(self, supa: Storage) -> int:
+        """Envoie les lots non confirmés, dans l'ordre ; renvoie le nombre de lignes envoyées.
+
+        Au premier échec, ce lot et les suivants restent en attente pour le prochain vidage.
+        """
+        sent = 0
+        for batch_id, batch in self.seal():
+            rows = [{"user_id": u, "model": m, "delta": n} for (u, m), n in batch.items()]
+            await _increment_usage_batch(supa, rows, batch_id)
+            with self._lock:
+                self._unsent.pop(batch_id, None)
+            sent += len(rows)
+        return sent
+
+    def ensure_flusher(self) -> None:
+        """Démarre (ou redémarre sur la boucle courante) la tâche de vidage périodique."""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        self._task = loop.create_task(self._flush_loop())
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(USAGE_FLUSH_INTERVAL)
+            await _flush_usage_buffer()
+
+
+USAGE_BUFFER = UsageWriteBuffer()
+
+
+async def _flush_usage_buffer() -> None:
+    supa = _storage()
+    if not supa:
+        return
+    try:
+        with _stage("usage_write"):
+            flushed = await USAGE_BUFFER.flush(supa)
+        if flushed and DEV_MODE:
+            print("[AutoQCM][DEBUG] Flushed", flushed, "usage rows")
+    except Exception as e:
+        print("[AutoQCM] Failed to flush usage buffer (batch kept for retry):", repr(e))
+
+
+# ---------- LLM telemetry ----------
+class LlmCall(TypedDict):
+    requested: int
+    items: int
+    input_tokens: int
+    output_tokens: int
+    latency_ms: float
+    max_output_tokens: Optional[int]
+
+
+# Appels LLM de la requête en cours (liste partagée avec les threads de LLM_EXECUTOR via le contexte)
+_LLM_TRACE: "contextvars.ContextVar[Optional[List[LlmCall]]]" = contextvars.ContextVar("autoqcm_llm_trace", default=None)
+
+
+def _trace_llm_call(call: LlmCall) -> None:
+    trace = _LLM_TRACE.get()
+    if trace is not None:
+        trace.append(call)
+
+
+def _llm_usage(result: Any) -> Tuple[int, int, bool]:
+    """(tokens d'entrée, tokens de sortie, réponse tronquée) d'une réponse LangChain ; zéros si absents."""
+    usage = getattr(result, "usage_metadata", None) or {}
+    meta = getattr(result, "response_metadata", None) or {}
+    truncated = str(meta.get("finish_reason", "")).upper().endswith("MAX_TOKENS")
+    if usage:
+        return int(usage.get("input_tokens") or 0), int(usage.get("output_tokens") or 0), truncated
+    raw = meta.get("usage_metadata") or {}
+    return int(raw.get("prompt_token_count") or 0), int(raw.get("candidates_token_count") or 0), truncated
+
+
+def _llm_thinking_tokens(result: Any) -> int:
+    """Tokens de réflexion inclus dans les tokens de sortie d'une réponse LangChain (0 si absents)."""
+    usage = getattr(result, "usage_metadata", None) or {}
+    details = usage.get("output_token_details") or {}
+    return int(details.get("reasoning") or 0)
+
+
+class TokenBudget:
+    """Estimation des tokens de sortie par question, par (modèle, difficulté), et max_output_tokens qui en découle."""
+
+    ALPHA = 0.2
+    TRUNCATION_BUMP = 1.25
+
+    def __init__(self, per_item: float, overhead: int, margin: float, floor: int, ceiling: int, thinking: int = 0) -> None:
+        self.per_item = per_item
+        self.overhead = overhead
+        self.margin = margin
+        self.floor = floor
+        self.ceiling = ceiling
+        # Budget de réflexion : décompté de max_output_tokens par le modèle, donc ajouté tel quel après les bornes
+        self.thinking = thinking
+        self._estimates: Dict[Tuple[str, str], float] = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, model: str, difficulty: str) -> float:
+        return self._estimates.get((model, difficulty), self.per_item)
+
+    def max_tokens(self, model: str, difficulty: str, count: int) -> int:
+        budget = (self.overhead + count * self.estimate(model, difficulty)) * self.margin
+        return int(min(self.ceiling, max(self.floor, budget))) + self.thinking
+
+    def observe(self, model: str, difficulty: str, items: int, output_tokens: int, truncated: bool) -> None:
+        key = (model, difficulty)
+        with self._lock:
+            current = self._estimates.get(key, self.per_item)
+            if truncated:
+                self._estimates[key] = current * self.TRUNCATION_BUMP
+            elif items > 0 and output_tokens > 0:
+                self._estimates[key] = current + self.ALPHA * (output_tokens / items - current)
+
+
+class GenerationTelemetry:
+    """Agrégats en mémoire par (utilisateur, modèle) et dernières requêtes de chaque utilisateur, plus un profil
+    global de latence par (modèle, difficulté, nombre de questions). Aucune écriture en base."""
+
+    MAX_PROFILE_KEYS = 1000
+    FIELDS = ("requests", "llm_calls", "items", "input_tokens", "output_tokens", "latency_ms")
+
+    def __init__(self, max_users: int, recent: int) -> None:
+        self.max_users = max_users
+        self.recent = recent
+        self._users: "OrderedDict[str, Tuple[Dict[str, Dict[str, float]], deque]]" = OrderedDict()
+        self._profile: Dict[Tuple[str, str, int], Dict[str, float]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _add(cls, totals: Dict[str, float], sample: Dict[str, float]) -> None:
+        for field in cls.FIELDS:
+            totals[field] = totals.get(field, 0) + sample[field]
+
+    def record(self, user_id: str, model: str, difficulty: str, count: int, items: int,
+               calls: List[LlmCall], latency_ms: float) -> None:
+        sample = {
+            "requests": 1,
+            "llm_calls": len(calls),
+            "items": items,
+            "input_tokens": sum(c["input_tokens"] for c in calls),
+            "output_tokens": sum(c["output_tokens"] for c in calls),
+            "latency_ms": latency_ms,
+        }
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = ({}, deque(maxlen=self.recent))
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+            self._add(entry[0].setdefault(model, {}), sample)
+            entry[1].append({
+                "at": datetime.utcnow().isoformat(), "model": model, "difficulty": difficulty, "count": count,
+                **{k: sample[k] for k in self.FIELDS if k != "requests"},
+            })
+            key = (model, difficulty, count)
+            if key in self._profile or len(self._profile) < self.MAX_PROFILE_KEYS:
+                self._add(self._profile.setdefault(key, {}), sample)
+
+    @staticmethod
+    def _summary(totals: Dict[str, float]) -> Dict[str, Any]:
+        requests = totals.get("requests") or 1
+        return {
+            **{k: int(totals.get(k, 0)) for k in ("requests", "llm_calls", "items", "input_tokens", "output_tokens")},
+            "avg_latency_ms": round(totals.get("latency_ms", 0) / requests, 1),
+        }
+
+    def user_stats(self, user_id: str) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                return {"per_model": [], "recent": []}
+            return {
+                "per_model": [{"model": m, **self._summary(t)} for m, t in entry[0].items()],
+                "recent": [dict(r, latency_ms=round(r["latency_ms"], 1)) for r in entry[1]],
+            }
+
+    def profile(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return [
+                {"model": m, "difficulty": d, "count": c, **self._summary(t)}
+                for (m, d, c), t in sorted(self._profile.items())
+            ]
+
+
+TOKEN_BUDGET = TokenBudget(LLM_TOKENS_PER_ITEM, LLM_OUTPUT_TOKENS_OVERHEAD, LLM_TOKEN_BUDGET_MARGIN, LLM_MIN_OUTPUT_TOKENS,
+                           LLM_MAX_OUTPUT_TOKENS, LLM_THINKING_BUDGET or 0)
+TELEMETRY = GenerationTelemetry(TELEMETRY_MAX_USERS, TELEMETRY_RECENT_REQUESTS)
+
+
+class LlmCallLimiter:
+    """Plafond global d'appels au fournisseur LLM en cours, pris dans les threads de LLM_EXECUTOR autour de chaque appel."""
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self._slots = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self._inflight = 0
+        self._waiting = 0
+
+    @contextmanager
+    def slot(self):
+        with self._lock:
+            self._waiting += 1
+        try:
+            self._slots.acquire()
+        finally:
+            with self._lock:
+                self._waiting -= 1
+        with self._lock:
+            self._inflight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._inflight -= 1
+            self._slots.release()
+
+    def inflight(self) -> int:
+        return self._inflight
+
+    def waiting(self) -> int:
+        return self._waiting
+
+
+LLM_CALLS = LlmCallLimiter(LLM_MAX_CONCURRENT_CALLS)
+
+
+async def _run_llm(fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    """Exécute un appel LLM bloquant dans LLM_EXECUTOR sans bloquer la boucle d'événements."""
+    loop = asyncio.get_running_loop()
+    # Le contexte (trace des appels LLM de la requête) suit l'appel dans le thread
+    ctx = contextvars.copy_context()
+    return await loop.run_in_executor(LLM_EXECUTOR, ctx.run, functools.partial(fn, *args, **kwargs))
+
+
+def _ensure_gemini():
+    if not genai:
+        raise RuntimeError("google-generativeai not installed. Install deps or set GEMINI_API_KEY.")
+    key = os.getenv("GEMINI_API_KEY")
+    if not key:
+        raise RuntimeError("GEMINI_API_KEY not set.")
+    genai.configure(api_key=key)
+
+
+# Registre process-wide des clients LLM : (modèle, température, callbacks DEV) -> (clé API, client).
+# Réutiliser la même instance garde les connexions HTTP/gRPC keep-alive ouvertes entre les requêtes.
+_LLM_CLIENTS: Dict[Tuple[str, float, bool], Tuple[str, Any]] = {}
+_LLM_CLIENTS_LOCK = threading.Lock()
+
+
+class LlmUnavailable(RuntimeError):
+    """Fournisseur LLM non installé ou non configuré."""
+
+
+def _get_llm(model: Optional[str] = None, temperature: Optional[float] = None) -> Any:
+    """Retourne le client ChatGoogleGenerativeAI partagé pour cette configuration (créé au besoin).
+
+    Le client est reconstruit si GEMINI_API_KEY a changé depuis sa création.
+    """
+    if not ChatGoogleGenerativeAI:
+        raise LlmUnavailable("LangChain Google GenAI provider not available")
+    api_key = os.getenv("GEMINI_API_KEY")
+    if not api_key:
+        raise LlmUnavailable("GEMINI_API_KEY not set")
+    with_callbacks = bool(BaseCallbackHandler and DEV_MODE)
+    key = (model or GEMINI_MODEL, float(GEMINI_TEMPERATURE if temperature is None else temperature), with_callbacks)
+    entry = _LLM_CLIENTS.get(key)
+    if entry is not None and entry[0] == api_key:
+        return entry[1]
+    with _LLM_CLIENTS_LOCK:
+        entry = _LLM_CLIENTS.get(key)
+        if entry is not None and entry[0] == api_key:
+            return entry[1]
+        if entry is not None:
+            # Rotation de clé : tous les clients construits avec l'ancienne clé sont obsolètes
+            for k in [k for k, (k_api, _) in _LLM_CLIENTS.items() if k_api != api_key]:
+                _LLM_CLIENTS.pop(k, None)
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] GEMINI_API_KEY changed, rebuilding LLM clients.")
+        # En DEV, on ajoute un callback pour logger les retries ; sinon, aucun callback explicite
+        callbacks = [RetryLoggingHandler()] if with_callbacks else None  # type: ignore
+        options: Dict[str, Any] = {}
+        if LLM_STRUCTURED_OUTPUT:
+            # Requiert langchain-google-genai >= 2.1.5 (voir requirements.txt)
+            options.update(response_mime_type="application/json", response_schema=_qcm_response_schema())
+        if LLM_THINKING_BUDGET is not None:
+            options["thinking_budget"] = LLM_THINKING_BUDGET
+        llm = ChatGoogleGenerativeAI(
+            model=key[0],
+            google_api_key=api_key,
+            temperature=key[1],
+            callbacks=callbacks,
+            **options,
+        )
+        _LLM_CLIENTS[key] = (api_key, llm)
+        return llm
+
+
+def _reset_llm_clients() -> None:
+    """Vide le registre des clients LLM (changement de configuration à chaud, tests)."""
+    with _LLM_CLIENTS_LOCK:
+        _LLM_CLIENTS.clear()
+
+
+def _warmup_llm_clients() -> None:
+    """Pré-construit le client par défaut et, si demandé, ouvre la connexion par un appel minimal."""
+    try:
+        llm = _get_llm()
+        if LLM_WARMUP_PING:
+            with LLM_CALLS.slot():
+                llm.invoke("ping")
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] LLM client warmed up for model", GEMINI_MODEL)
+    except Exception as e:
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] LLM warmup skipped:", repr(e))
+
+
+def _gemini_schema(schema: Dict[str, Any], defs: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Convertit un schéma JSON pydantic vers le sous-ensemble OpenAPI accepté par Gemini (refs résolues, nullable)."""
+    defs = schema.get("$defs", {}) if defs is None else defs
+    if "$ref" in schema:
+        return _gemini_schema(defs[schema["$ref"].rsplit("/", 1)[-1]], defs)
+    if "anyOf" in schema:
+        variants = [v for v in schema["anyOf"] if v.get("type") != "null"]
+        out = _gemini_schema(variants[0], defs) if variants else {"type": "string"}
+        if len(variants) < len(schema["anyOf"]):
+            out["nullable"] = True
+        return out
+    out = {k: schema[k] for k in ("type", "enum", "description", "format", "minItems", "maxItems", "required") if k in schema}
+    if "properties" in schema:
+        out["properties"] = {name: _gemini_schema(sub, defs) for name, sub in schema["properties"].items()}
+    if "items" in schema:
+        out["items"] = _gemini_schema(schema["items"], defs)
+    return out
+
+
+@functools.lru_cache(maxsize=1)
+def _qcm_response_schema() -> Dict[str, Any]:
+    """Schéma de réponse attendu du modèle : {"name"?, "items": [QcmItem]} (4 choix par question)."""
+    item = _gemini_schema(QcmItem.model_json_schema())
+    item["properties"]["choices"].update(minItems=4, maxItems=4)
+    return {
+        "type": "object",
+        "properties": {"name": {"type": "string", "nullable": True}, "items": {"type": "array", "items": item}},
+        "required": ["items"],
+    }
+
+
+def _build_prompt(skills: List[str], count: int, difficulty: str) -> str:
+    if count <= LLM_COMPACT_PROMPT_MAX_COUNT:
+        # Petits QCM : consigne et structure abrégées, explications courtes (moins de tokens en entrée et en sortie)
+        return (
+            "QCM JSON en français, réponds UNIQUEMENT en JSON: {\"name\"?, \"items\": [{\"id\", \"question\", \"choices\": 4 chaînes, \"answer_index\": 0..3, \"skill\"?, \"explanation\"?}]}\n"
+            f"Compétences: {skills}. Nombre de questions: {count}. Niveau: {difficulty}. "
+            "Une seule bonne réponse, explication en une phrase."
+        )
+    return (
+        "Tu génères un QCM JSON en français. Réponds UNIQUEMENT en JSON.\n"
+        "Structure attendue: {\"name\": string?, \"items\": [ { \"id\": string, \"question\": string, \"choices\": [string,string,string,string], \"answer_index\": 0..3, \"skill\": string?, \"explanation\": string? } ] }\n"
+        f"Compétences: {skills}. Nombre de questions: {count}. Niveau de difficulté / style: {difficulty}. "
+        "Règles: une seule bonne réponse, langue FR."
+    )
+
+
+def _result_text(result: Any) -> str:
+    """Extrait le texte d'une réponse (ou d'un chunk de stream) LangChain."""
+    if isinstance(result, str):
+        return result
+    content = getattr(result, "content", None)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        parts = []
+        for part in content:
+            if isinstance(part, dict):
+                t = part.get("text")
+                if t:
+                    parts.append(t)
+            else:
+                t = getattr(part, "text", None)
+                if t:
+                    parts.append(t)
+        return "\n".join(parts)
+    return getattr(result, "text", "") or str(result)
+
+
+def _answer_index(it: Dict[str, Any], choices: List[str]) -> int:
+    """Index de la bonne réponse : entier, chaîne "2" / "C", ou texte du choix (clé answer)."""
+    raw = it.get("answer_index")
+    if isinstance(raw, str):
+        raw = raw.strip().rstrip(").").upper()
+        raw = "ABCD".index(raw) if len(raw) == 1 and raw in "ABCD" else raw
+    if isinstance(raw, str) and raw.isdigit():
+        raw = int(raw)
+    if raw is None and isinstance(it.get("answer"), str) and it["answer"].strip() in [c.strip() for c in choices]:
+        raw = [c.strip() for c in choices].index(it["answer"].strip())
+    if isinstance(raw, bool) or not isinstance(raw, int) or not 0 <= raw < 4:
+        raise ValueError(f"invalid answer_index: {it.get('answer_index')!r}")
+    return raw
+
+
+def _item_from_raw(it: Dict[str, Any]) -> QcmItem:
+    """Valide un élément renvoyé par le modèle, en réparant ce qui peut l'être ; ValueError sinon."""
+    if not isinstance(it, dict):
+        raise ValueError("item is not an object")
+    question = it.get("question")
+    choices = it.get("choices")
+    if not isinstance(question, str) or not question.strip():
+        raise ValueError("missing question")
+    if not isinstance(choices, list) or len(choices) < 4 or not all(isinstance(c, (str, int, float)) for c in choices[:4]):
+        raise ValueError("expected 4 choices")
+    choices = [str(c) for c in choices[:4]]
+    return QcmItem(
+        id=str(it.get("id") or uuid.uuid4()),
+        question=question,
+        choices=choices,
+        answer_index=_answer_index(it, choices),
+        skill=it.get("skill") if isinstance(it.get("skill"), str) else None,
+        explanation=it.get("explanation") if isinstance(it.get("explanation"), str) else None,
+    )
+
+
+def _salvage_items(items_raw: Any, limit: int) -> Tuple[List[QcmItem], int]:
+    """Garde les éléments valides (au plus limit) ; renvoie aussi le nombre d'éléments écartés."""
+    items: List[QcmItem] = []
+    dropped = 0
+    for raw in items_raw if isinstance(items_raw, list) else []:
+        if len(items) >= limit:
+            break
+        try:
+            items.append(_item_from_raw(raw))
+        except (ValueError, TypeError) as e:
+            dropped += 1
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Dropping invalid item:", repr(e))
+    return items, dropped
+
+
+def _generate_via_langchain(skills: List[str], count: int, name: Optional[str], difficulty: str) -> GenerateResponse:
+    """Un appel LLM, puis des appels complémentaires pour les seules questions manquantes ou invalides.
+
+    Les compléments sont bornés par LLM_TOPUP_ATTEMPTS et LLM_TOPUP_BUDGET ; un QCM incomplet est renvoyé
+    tel quel une fois ces limites atteintes, l'échec n'est levé que si aucune question n'est valide.
+    """
+    llm = _get_llm()
+    started = time.monotonic()
+    items: List[QcmItem] = []
+    seen_ids: set = set()
+    seen_hashes: set = set()
+    name_out: Optional[str] = None
+    for attempt in range(LLM_TOPUP_ATTEMPTS + 1):
+        missing = count - len(items)
+        if missing <= 0 or (attempt and time.monotonic() - started >= LLM_TOPUP_BUDGET):
+            break
+        max_tokens = TOKEN_BUDGET.max_tokens(GEMINI_MODEL, difficulty, missing) if LLM_ADAPTIVE_MAX_TOKENS else None
+        t0 = time.perf_counter()
+        fresh: List[QcmItem] = []
+        usage = (0, 0, False)
+        thinking = 0
+        try:
+            with LLM_CALLS.slot(), _stage("llm"):
+                if max_tokens:
+                    result = llm.invoke(_build_prompt(skills, missing, difficulty), generation_config={"max_output_tokens": max_tokens})
+                else:
+                    result = llm.invoke(_build_prompt(skills, missing, difficulty))
+            usage = _llm_usage(result)
+            thinking = _llm_thinking_tokens(result)
+            text = _result_text(result)
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] LangChain Gemini raw text:", str(text)[:400])
+            with _stage("extract"):
+                data = _extract_json(text)
+                fresh, dropped = _salvage_items(data.get("items") if isinstance(data, dict) else data, missing)
+        except Exception as e:
+            # Échec du premier appel : propagé tel quel ; échec d'un complément : on garde l'acquis
+            if not items:
+                raise
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Top-up call failed:", repr(e))
+            continue
+        finally:
+            # L'estimation par question ne porte que sur la réponse : la réflexion est budgétée à part
+            TOKEN_BUDGET.observe(GEMINI_MODEL, difficulty, len(fresh), usage[1] - thinking, usage[2])
+            _trace_llm_call({
+                "requested": missing, "items": len(fresh), "input_tokens": usage[0], "output_tokens": usage[1],
+                "latency_ms": (time.perf_counter() - t0) * 1000, "max_output_tokens": max_tokens,
+            })
+        name_out = name_out or (data.get("name") if isinstance(data, dict) else None)
+        for item in fresh:
+            h = _item_hash(item)
+            if h in seen_hashes:
+                continue
+            if item.id in seen_ids:
+                item = item.model_copy(update={"id": str(uuid.uuid4())})
+            seen_hashes.add(h)
+            seen_ids.add(item.id)
+            items.append(item)
+        if DEV_MODE and (dropped or len(items) < count):
+            print(f"[AutoQCM][DEBUG] Attempt {attempt + 1}: {len(fresh)} valid, {dropped} dropped, {count - len(items)} missing")
+    if not items:
+        raise ValueError("No valid QCM item in LLM output")
+    return GenerateResponse(name=name_out or name, items=items)
+
+
+def _stream_via_langchain(skills: List[str], count: int, difficulty: str):
+    """Générateur bloquant des fragments de texte renvoyés par Gemini en streaming."""
+    llm = _get_llm()
+    t0 = time.perf_counter()
+    merged = None
+    # La place d'appel LLM est tenue pendant tout le flux et rendue à sa fermeture (fin, erreur ou consommateur parti)
+    with LLM_CALLS.slot():
+        upstream = llm.stream(_build_prompt(skills, count, difficulty))
+        try:
+            for chunk in upstream:
+                if getattr(chunk, "usage_metadata", None) or getattr(chunk, "response_metadata", None):
+                    # L'addition des chunks LangChain cumule correctement usage_metadata
+                    merged = chunk if merged is None else merged + chunk
+                text = _result_text(chunk)
+                if text:
+                    yield text
+        finally:
+            # Fermer le flux amont interrompt la réponse Gemini si le consommateur s'arrête avant la fin
+            close = getattr(upstream, "close", None)
+            if close is not None:
+                close()
+            STAGE_LATENCY.observe(("llm",), time.perf_counter() - t0)
+            usage = _llm_usage(merged) if merged is not None else (0, 0, False)
+            _trace_llm_call({
+                "requested": count, "items": 0, "input_tokens": usage[0], "output_tokens": usage[1],
+                "latency_ms": (time.perf_counter() - t0) * 1000, "max_output_tokens": None,
+            })
+
+
+class QcmStreamParser:
+    """Parseur JSON incrémental : renvoie chaque objet élément d'un tableau dès que son '}' est lu.
+
+    Couvre les deux formats attendus du modèle ({"items": [...]} ou un tableau brut), même encadrés
+    de markdown. Le contenu des chaînes (accolades, crochets échappés) est ignoré pour le comptage.
+    """
+
+    def __init__(self) -> None:
+        self._buf = ""
+        self._pos = 0
+        self._stack: List[str] = []
+        self._in_string = False
+        self._escape = False
+        self._obj_start: Optional[int] = None
+        self.text = ""
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        self.text += chunk
+        self._buf += chunk
+        out: List[Dict[str, Any]] = []
+        buf = self._buf
+        i = self._pos
+        while i < len(buf):
+            c = buf[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif c == "\\":
+                    self._escape = True
+                elif c == '"':
+                    self._in_string = False
+            elif c == '"':
+                self._in_string = bool(self._stack)
+            elif c in "{[":
+                if c == "{" and self._obj_start is None and self._stack and self._stack[-1] == "[":
+                    self._obj_start = i
+                self._stack.append(c)
+            elif c in "}]" and self._stack:
+                self._stack.pop()
+                if c == "}" and self._obj_start is not None and self._stack and self._stack[-1] == "[":
+                    try:
+                        obj = json.loads(buf[self._obj_start:i + 1])
+                        if isinstance(obj, dict):
+                            out.append(obj)
+                    except ValueError:
+                        pass
+                    self._obj_start = None
+            i += 1
+        # On ne garde que la partie utile du tampon (l'objet en cours de lecture)
+        keep_from = self._obj_start if self._obj_start is not None else i
+        self._buf = buf[keep_from:]
+        self._pos = i - keep_from
+        if self._obj_start is not None:
+            self._obj_start = 0
+        return out
+
+
+def _extract_json_strict(text: str) -> Any:
+    # Try to extract a JSON object even if wrapped in markdown
+    start = text.find("{")
+    end = text.rfind("}")
+    if start != -1 and end != -1 and end > start:
+        return json.loads(text[start:end + 1])
+    # Fallback to parse as array
+    start = text.find("[")
+    end = text.rfind("]")
+    if start != -1 and end != -1 and end > start:
+        return json.loads(text[start:end + 1])
+    # Last resort
+    return json.loads(text)
+
+
+_FENCE_RE = re.compile(r"```[a-zA-Z]*[ \t]*\n?(.*?)(?:```|$)", re.S)
+_JSON_ESCAPES = set('"\\/bfnrtu')
+
+
+def _repair_json(text: str) -> Any:
+    """Parse tolérant d'une sortie LLM : blocs markdown, JSON ré-échappé, commentaires, virgules finales,
+    échappements invalides et réponse tronquée (coupée après le dernier élément complet, crochets refermés)."""
+    fence = _FENCE_RE.search(text)
+    if fence and fence.group(1).strip():
+        text = fence.group(1)
+    text = text.strip()
+    if text.startswith(('"', '{\\"', '[{\\"')):
+        # Le JSON a été renvoyé comme chaîne échappée
+        try:
+            inner = json.loads(text if text.startswith('"') else '"' + text + '"', strict=False)
+            if isinstance(inner, str):
+                return _repair_json(inner)
+        except ValueError:
+            pass
+    starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+    if not starts:
+        raise ValueError("No JSON value found")
+    text = text[min(starts):]
+
+    out: List[str] = []
+    stack: List[str] = []
+    cut: Optional[Tuple[int, List[str]]] = None
+    in_string = escape = False
+    i, n = 0, len(text)
+
+    def close(closer: str) -> None:
+        while out and (out[-1].isspace() or out[-1] == ","):
+            out.pop()
+        out.append(closer)
+
+    while i < n:
+        c = text[i]
+        if in_string:
+            if escape:
+                escape = False
+                if c not in _JSON_ESCAPES:
+                    out.pop()  # échappement invalide (ex. \_ de markdown) : on garde le caractère seul
+            elif c == "\\":
+                escape = True
+            elif c == '"':
+                in_string = False
+            out.append(c)
+        elif c == '"':
+            in_string = True
+            out.append(c)
+        elif c == "/" and text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end == -1 else end
+            continue
+        elif c == "/" and text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end == -1 else end + 2
+            continue
+        elif c in "{[":
+            stack.append("}" if c == "{" else "]")
+            out.append(c)
+            if c == "[" and len(stack) <= 2:
+                # Tableau de premier niveau (ou "items") ouvert : vide, il reste un état valide
+                cut = (len(out), list(stack))
+        elif c in "}]":
+            if not stack:
+                break
+            close(stack.pop())
+            if not stack:
+                break
+            if stack[-1] == "]" or len(stack) == 1:
+                # Point de coupure sûr : un élément de tableau ou une propriété de premier niveau est complet
+                cut = (len(out), list(stack))
+        else:
+            out.append(c)
+        i += 1
+
+    if stack:
+        # Réponse tronquée : on abandonne l'élément incomplet et on referme les conteneurs ouverts
+        if cut is not None:
+            del out[cut[0]:]
+            stack = cut[1]
+        elif in_string:
+            out.append('"')
+        for closer in reversed(stack):
+            close(closer)
+    return json.loads("".join(out), strict=False)
+
+
+def _extract_json(text: str) -> Any:
+    """Extrait le JSON d'une réponse du modèle ; si le parse strict échoue, tente la réparation locale."""
+    try:
+        return _extract_json_strict(text)
+    except ValueError as strict_error:
+        try:
+            data = _repair_json(text)
+        except ValueError:
+            raise strict_error
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] Repaired malformed LLM JSON:", repr(strict_error))
+        return data
+
+
+def _generate_fallback(skills: List[str], count: int, name: Optional[str], difficulty: str) -> GenerateResponse:
+    items: List[QcmItem] = []
+    for i in range(count):
+        skill = (skills[i % len(skills)] if skills else None)
+        items.append(QcmItem(
+            id=str(uuid.uuid4()),
+            question=f"[Fallback {difficulty}] Question {i+1} sur {skill or 'Compétence'} ?",
+            choices=["Choix A", "Choix B", "Choix C", "Choix D"],
+            answer_index=0,
+            skill=skill,
+            explanation="Réponse par défaut (fallback)."
+        ))
+    return GenerateResponse(name=name, items=items)
+
+
+class CachedQcm(TypedDict):
+    record: Dict[str, Any]
+    body: bytes
+    etag: str
+    last_modified: Optional[str]
+
+
+def _http_date(created_at: Any) -> Optional[str]:
+    """created_at (ISO, naïf = UTC) au format HTTP-date pour Last-Modified ; None si illisible."""
+    try:
+        dt = datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return email.utils.format_datetime(dt.astimezone(timezone.utc), usegmt=True)
+
+
+def _cached_qcm_entry(record: Dict[str, Any]) -> CachedQcm:
+    body = _json_dumps(record)
+    return {
+        "record": record,
+        "body": body,
+        "etag": '"%s"' % hashlib.sha256(body).hexdigest()[:32],
+        "last_modified": _http_date(record.get("created_at")),
+    }
+
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """Comparaison faible de If-None-Match (liste d'ETags, préfixes W/ ou *)."""
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any((t[2:] if t.startswith("W/") else t) == etag for t in tags)
+
+
+def _not_modified_since(if_modified_since: str, last_modified: Optional[str]) -> bool:
+    if not last_modified:
+        return False
+    try:
+        return email.utils.parsedate_to_datetime(last_modified) <= email.utils.parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+
+
+def _parse_fields(fields: str) -> Dict[str, Any]:
+    """'name,score,qcm.items.question' -> arbre {"name": {}, "score": {}, "qcm": {"items": {"question": {}}}}."""
+    tree: Dict[str, Any] = {}
+    for path in fields.split(","):
+        parts = [p.strip() for p in path.split(".")]
+        if not all(parts):
+            raise HTTPException(status_code=400, detail="Invalid fields")
+        node = tree
+        for part in parts:
+            node = node.setdefault(part, {})
+    return tree
+
+
+def _project(value: Any, tree: Dict[str, Any]) -> Any:
+    """Garde les chemins de tree (un nœud vide garde toute la valeur) ; s'applique à chaque élément des listes."""
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [_project(v, tree) for v in value]
+    if not isinstance(value, dict):
+        return value
+    return {k: _project(value[k], sub) for k, sub in tree.items() if k in value}
+
+
+def _qcm_to_json_dict(qcm: GenerateResponse) -> dict:
+    """Convertit un modèle GenerateResponse en dict JSON, compatible Pydantic v1/v2."""
+    # Pydantic v2
+    if hasattr(qcm, "model_dump"):
+        return qcm.model_dump()  # type: ignore[no-any-return]
+    # Pydantic v1 (ou compat)
+    if hasattr(qcm, "dict"):
+        return qcm.dict()  # type: ignore[no-any-return]
+    # Fallback très défensif
+    return json.loads(qcm.json())  # type: ignore[no-any-return]
+
+
+def _saved_qcm_document(req: "SaveRequest") -> dict:
+    """Contenu de la colonne qcm : le QCM et, pour cette tentative, les réponses choisies."""
+    doc = _qcm_to_json_dict(req.qcm)
+    if req.answers is not None:
+        doc["answers"] = req.answers
+    return doc
+
+
+def _qcm_to_json_bytes(req: "SaveRequest") -> bytes:
+    """Sérialise le QCM sauvegardé en JSON compact (forme stockée par le store mémoire)."""
+    if req.answers is None and hasattr(req.qcm, "model_dump_json"):
+        return req.qcm.model_dump_json().encode("utf-8")
+    return json.dumps(_saved_qcm_document(req), separators=(",", ":")).encode("utf-8")
+
+
+def _normalize_key_part(value: Optional[str]) -> str:
+    """Normalise une compétence / difficulté pour l'indexation (casse, accents, espaces)."""
+    text = unicodedata.normalize("NFKD", value or "")
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    return " ".join(text.lower().split())
+
+
+def _item_hash(item: Union[QcmItem, Dict[str, Any]]) -> str:
+    """Empreinte du contenu d'une question (hors id), stable d'une génération à l'autre."""
+    if isinstance(item, dict):
+        question, choices, answer_index, skill, explanation = (item.get(k) for k in QUESTION_FIELDS)
+    else:
+        question, choices, answer_index, skill, explanation = item.question, item.choices, item.answer_index, item.skill, item.explanation
+    content = [" ".join(question.split()), [" ".join(c.split()) for c in choices], answer_index, skill, explanation]
+    return hashlib.sha256(json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class QuestionBank:
+    """Banque de questions persistée en SQLite, indexée par (compétence, difficulté, modèle).
+
+    Les questions déjà servies à un utilisateur ne lui sont plus proposées. Les entrées expirent après
+    ttl secondes et, au-delà de max_items (global) ou max_per_key (par clé), les moins récemment
+    servies sont évincées.
+    """
+
+    def __init__(self, path: str, max_items: int, max_per_key: int, ttl_seconds: int) -> None:
+        self.path = path
+        self.max_items = max_items
+        self.max_per_key = max_per_key
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._conn.execute("pragma journal_mode=wal")
+        self._conn.executescript(
+            """
+            create table if not exists bank_items (
+              hash text primary key,
+              skill text not null,
+              difficulty text not null,
+              model text not null,
+              item text not null,
+              created_at real not null,
+              last_used real not null
+            );
+            create index if not exists idx_bank_items_key on bank_items(skill, difficulty, model, last_used);
+            create table if not exists bank_served (
+              user_id text not null,
+              hash text not null,
+              primary key (user_id, hash)
+            );
+            """
+        )
+        self._conn.commit()
+
+    def sample(self, user_id: str, skills: List[str], difficulty: str, model: str, count: int) -> List[QcmItem]:
+        """Tire jusqu'à count questions jamais servies à cet utilisateur, réparties entre les compétences."""
+        keys = [_normalize_key_part(sk) for sk in skills] or [""]
+        wanted = [count // len(keys) + (1 if i < count % len(keys) else 0) for i in range(len(keys))]
+        diff = _normalize_key_part(difficulty)
+        now = time.time()
+        out: List[QcmItem] = []
+        with self._lock:
+            for key, n in zip(keys, wanted):
+                if n <= 0:
+                    continue
+                rows = self._conn.execute(
+                    "select hash, item from bank_items where skill = ? and difficulty = ? and model = ? and created_at >= ?"
+                    " and hash not in (select hash from bank_served where user_id = ?) order by random() limit ?",
+                    (key, diff, model, now - self.ttl_seconds, user_id, n),
+                ).fetchall()
+                for h, raw in rows:
+                    out.append(QcmItem(id=str(uuid.uuid4()), **json.loads(raw)))
+                self._mark_served(user_id, [h for h, _ in rows], now)
+            self._conn.commit()
+            self.hits += len(out)
+            self.misses += count - len(out)
+        return out
+
+    def add(self, user_id: Optional[str], items: List[QcmItem], skills: List[str], difficulty: str, model: str) -> None:
+        """Ajoute des questions générées (et les marque comme servies à user_id), puis applique l'éviction."""
+        requested = {_normalize_key_part(sk): sk for sk in skills}
+        diff = _normalize_key_part(difficulty)
+        now = time.time()
+        rows = []
+        for item in items:
+            skill_key = _normalize_key_part(item.skill) if item.skill else ""
+            if skill_key not in requested:
+                # Question hors des compétences demandées : rangée sous la seule compétence demandée, sinon en générique
+                skill_key = next(iter(requested)) if len(requested) == 1 else ""
+            payload = item.model_dump(exclude={"id"})
+            rows.append((_item_hash(item), skill_key, diff, model, json.dumps(payload, ensure_ascii=False, separators=(",", ":")), now, now))
+        with self._lock:
+            self._conn.executemany("insert or ignore into bank_items values (?, ?, ?, ?, ?, ?, ?)", rows)
+            if user_id:
+                self._mark_served(user_id, [r[0] for r in rows], now)
+            self._evict(now)
+            self._conn.commit()
+
+    def _mark_served(self, user_id: str, hashes: List[str], now: float) -> None:
+        if not hashes:
+            return
+        self._conn.executemany("insert or ignore into bank_served values (?, ?)", [(user_id, h) for h in hashes])
+        self._conn.executemany("update bank_items set last_used = ? where hash = ?", [(now, h) for h in hashes])
+
+    def _evict(self, now: float) -> None:
+        self._conn.execute("delete from bank_items where created_at < ?", (now - self.ttl_seconds,))
+        over_key = self._conn.execute(
+            "select skill, difficulty, model, count(*) - ? from bank_items group by skill, difficulty, model having count(*) > ?",
+            (self.max_per_key, self.max_per_key),
+        ).fetchall()
+        for skill, diff, model, extra in over_key:
+            self._conn.execute(
+                "delete from bank_items where hash in (select hash from bank_items where skill = ? and difficulty = ? and model = ?"
+                " order by last_used asc limit ?)",
+                (skill, diff, model, extra),
+            )
+        total = self._conn.execute("select count(*) from bank_items").fetchone()[0]
+        if total > self.max_items:
+            self._conn.execute(
+                "delete from bank_items where hash in (select hash from bank_items order by last_used asc limit ?)",
+                (total - self.max_items,),
+            )
+        self._conn.execute("delete from bank_served where hash not in (select hash from bank_items)")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            size = self._conn.execute("select count(*) from bank_items").fetchone()[0]
+        lookups = self.hits + self.misses
+        return {"size": size, "hits": self.hits, "misses": self.misses, "hit_rate": (self.hits / lookups) if lookups else 0.0}
+
+
+def _question_bank() -> Optional[QuestionBank]:
+    global QUESTION_BANK
+    if not QUESTION_BANK_ENABLED:
+        return None
+    if QUESTION_BANK is None:
+        try:
+            QUESTION_BANK = QuestionBank(QUESTION_BANK_PATH, QUESTION_BANK_MAX_ITEMS, QUESTION_BANK_MAX_PER_KEY, QUESTION_BANK_TTL_SECONDS)
+        except Exception as e:
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Question bank unavailable:", repr(e))
+            return None
+    return QUESTION_BANK
+
+
+_DEDUP_STOPWORDS = frozenset(
+    "a au aux avec ce ces cet cette d dans de des du elle en est et il l la le les leur leurs ne on ou par pas"
+    " pour qu que quel quelle quelles quels qui quoi sa se ses son sont sur un une".split()
+)
+
+
+class NearDuplicateIndex:
+    """Index MinHash/LSH d'énoncés normalisés pour repérer les paraphrases d'une même question.
+
+    Chaque énoncé est réduit à ses mots et bigrammes (hors mots vides) ; la signature tient en
+    num_perm octets issus d'un seul hash blake2b par shingle. Les signatures sont rangées dans un
+    array contigu et découpées en bandes LSH ; seuls les candidats partageant une bande sont
+    comparés, ce qui garde une recherche sous la milliseconde même avec des centaines de milliers
+    d'entrées (voir benchmarks/bench_dedup.py).
+    """
+
+    def __init__(self, threshold: float = 0.7, num_perm: int = 64, bands: int = 16) -> None:
+        if num_perm > 64 or num_perm % bands:
+            raise ValueError("num_perm must be <= 64 and divisible by bands")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self._rows = num_perm // bands
+        self._sigs = array("B")
+        self._keys: List[Any] = []
+        self._buckets: List[Dict[int, Any]] = [{} for _ in range(bands)]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    @staticmethod
+    def shingles(text: str) -> set:
+        words = re.findall(r"\w+", _normalize_key_part(text))
+        words = [w for w in words if w not in _DEDUP_STOPWORDS] or words or [""]
+        out = set(words)
+        out.update(a + " " + b for a, b in zip(words, words[1:]))
+        return out
+
+    def signature(self, text: str) -> array:
+        digests = [hashlib.blake2b(sh.encode("utf-8"), digest_size=64).digest() for sh in self.shingles(text)]
+        return array("B", map(min, zip(*digests)))[: self.num_perm]
+
+    def _band_keys(self, sig: array) -> List[int]:
+        raw = sig.tobytes()
+        rows = self._rows
+        return [int.from_bytes(raw[b * rows:(b + 1) * rows], "little") for b in range(self.bands)]
+
+    def find(self, text: Optional[str] = None, sig: Optional[array] = None) -> Optional[Any]:
+        """Renvoie la clé d'une entrée dont la similarité estimée atteint le seuil, sinon None."""
+        if sig is None:
+            sig = self.signature(text or "")
+        n = self.num_perm
+        needed = self.threshold * n
+        sigs = self._sigs
+        seen = set()
+        for bucket, band_key in zip(self._buckets, self._band_keys(sig)):
+            ids = bucket.get(band_key)
+            if ids is None:
+                continue
+            for idx in (ids if isinstance(ids, list) else (ids,)):
+                if idx in seen:
+                    continue
+                seen.add(idx)
+                if sum(map(operator.eq, sig, sigs[idx * n:(idx + 1) * n])) >= needed:
+                    return self._keys[idx]
+        return None
+
+    def add(self, key: Any, text: Optional[str] = None, sig: Optional[array] = None) -> None:
+        if sig is None:
+            sig = self.signature(text or "")
+        idx = len(self._keys)
+        self._keys.append(key)
+        self._sigs.extend(sig)
+        for bucket, band_key in zip(self._buckets, self._band_keys(sig)):
+            current = bucket.get(band_key)
+            if current is None:
+                bucket[band_key] = idx
+            elif isinstance(current, list):
+                current.append(idx)
+            else:
+                bucket[band_key] = [current, idx]
+
+
+async def _load_user_questions(user_id: str) -> List[str]:
+    """Énoncés des DEDUP_HISTORY_LIMIT derniers QCM sauvegardés par l'utilisateur (Supabase ou store mémoire)."""
+    supa = _storage()
+    if supa:
+        payloads = await _list_qcm_payloads(supa, user_id, DEDUP_HISTORY_LIMIT)
+    else:
+        payloads = STORE.qcm_payloads(user_id, DEDUP_HISTORY_LIMIT)
+    questions: List[str] = []
+    for qcm in payloads:
+        for it in (qcm.get("items") or []):
+            if isinstance(it, dict) and it.get("question"):
+                questions.append(it["question"])
+    return questions
+
+
+async def _build_dedup_index(user_id: str) -> NearDuplicateIndex:
+    """Reconstruit l'index de l'utilisateur depuis ses derniers QCM ; mis en cache seulement si le chargement réussit."""
+    index = NearDuplicateIndex(threshold=DEDUP_THRESHOLD)
+    for question in await _load_user_questions(user_id):
+        sig = index.signature(question)
+        if index.find(sig=sig) is None:
+            index.add(question, sig=sig)
+    DEDUP_INDEXES[user_id] = index
+    while len(DEDUP_INDEXES) > DEDUP_MAX_USERS:
+        DEDUP_INDEXES.popitem(last=False)
+    return index
+
+
+def _prefetch_dedup_index(user_id: str) -> "Optional[asyncio.Task[NearDuplicateIndex]]":
+    """Lance en tâche de fond la construction de l'index s'il n'est pas en cache.
+
+    Appelé dès l'arrivée de la demande : la lecture de l'historique recouvre l'appel LLM au lieu de
+    s'y ajouter, et n'occupe pas de place d'admission.
+    """
+    if user_id in DEDUP_INDEXES:
+        return None
+    task = DEDUP_LOADING.get(user_id)
+    if task is not None and task.get_loop() is asyncio.get_running_loop():
+        return task
+    task = asyncio.get_running_loop().create_task(_build_dedup_index(user_id))
+    DEDUP_LOADING[user_id] = task
+
+    def done(t: "asyncio.Task[NearDuplicateIndex]") -> None:
+        if DEDUP_LOADING.get(user_id) is t:
+            del DEDUP_LOADING[user_id]
+        if not t.cancelled() and t.exception() is not None:
+            print("[AutoQCM] Failed to rebuild dedup index:", repr(t.exception()))
+
+    task.add_done_callback(done)
+    return task
+
+
+async def _user_dedup_index(user_id: str) -> Optional[NearDuplicateIndex]:
+    """Index de quasi-doublons de l'utilisateur ; None si l'historique n'a pas pu être chargé (nouvel essai au prochain appel)."""
+    index = DEDUP_INDEXES.get(user_id)
+    if index is not None:
+        DEDUP_INDEXES.move_to_end(user_id)
+        return index
+    task = _prefetch_dedup_index(user_id)
+    if task is None:
+        return DEDUP_INDEXES.get(user_id)
+    try:
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        return None
+
+
+def _remember_saved_questions(user_id: str, qcm: "GenerateResponse") -> None:
+    """Ajoute les questions d'un QCM sauvegardé à l'index de l'utilisateur s'il est déjà chargé."""
+    index = DEDUP_INDEXES.get(user_id)
+    if index is None:
+        return
+    for item in qcm.items:
+        sig = index.signature(item.question)
+        if index.find(sig=sig) is None:
+            index.add(item.question, sig=sig)
+
+
+class JwksCache:
+    """Clés de signature publiées par Supabase (JWKS), gardées en mémoire par kid.
+
+    Les clés sont rechargées périodiquement en tâche de fond et, lors d'une rotation, dès qu'un kid
+    inconnu se présente (au plus une fois toutes les min_refresh_interval secondes après un chargement
+    réussi, toutes les failure_backoff secondes après un échec).
+    """
+
+    def __init__(self, url: str, refresh_interval: float = 600.0, min_refresh_interval: float = 30.0,
+                 failure_backoff: float = 2.0) -> None:
+        self.url = url
+        self.refresh_interval = refresh_interval
+        self.min_refresh_interval = min_refresh_interval
+        self.failure_backoff = failure_backoff
+        self.fetches = 0
+        self.failures = 0
+        self._keys: Dict[str, Any] = {}
+        self._fetched_at: Optional[float] = None
+        self._failed_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    def refresh(self, force: bool = False) -> bool:
+        """Recharge le JWKS (bloquant) ; renvoie False si un rechargement récent rend l'appel inutile."""
+        with self._lock:
+            now = time.monotonic()
+            if not force:
+                if self._fetched_at is not None and now - self._fetched_at < self.min_refresh_interval:
+                    return False
+                if self._failed_at is not None and now - self._failed_at < self.failure_backoff:
+                    return False
+            self.fetches += 1
+            try:
+                resp = httpx.get(self.url, timeout=5.0)
+                resp.raise_for_status()
+                published = resp.json().get("keys", [])
+            except Exception:
+                # Seul un chargement réussi ouvre la fenêtre min_refresh_interval : un kid tout juste publié reste
+                # accepté dès que le JWKS répond de nouveau
+                self._failed_at = time.monotonic()
+                self.failures += 1
+                raise
+            self._fetched_at = time.monotonic()
+            self._failed_at = None
+            keys: Dict[str, Any] = {}
+            for jwk in published:
+                try:
+                    key = jwt.PyJWK(jwk)
+                except Exception:
+                    # Type de clé non supporté ici (ex. RSA/EC sans le paquet cryptography)
+                    continue
+                keys[jwk.get("kid") or ""] = key
+            self._keys = keys
+            return True
+
+    async def get_key(self, kid: Optional[str]) -> Any:
+        self.ensure_refresher()
+        key = self._keys.get(kid or "")
+        if key is None:
+            await run_in_threadpool(self.refresh)
+            key = self._keys.get(kid or "")
+        if key is None:
+            raise jwt.InvalidTokenError(f"Unknown signing key: {kid}")
+        return key
+
+    def ensure_refresher(self) -> None:
+        """Démarre (ou redémarre sur la boucle courante) le rechargement périodique des clés."""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        self._task = loop.create_task(self._refresh_loop())
+
+    async def _refresh_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await run_in_threadpool(self.refresh, True)
+            except Exception as e:
+                if DEV_MODE:
+                    print("[AutoQCM][DEBUG] JWKS refresh failed:", e)
+
+
+JWKS_CACHE: Optional[JwksCache] = None
+# sha256(token) -> sub, conservé jusqu'à l'expiration du jeton
+TOKEN_CACHE = TTLCache(TOKEN_CACHE_MAX_ENTRIES, 0)
+
+
+def _jwks_cache() -> Optional[JwksCache]:
+    global JWKS_CACHE
+    if not SUPABASE_JWKS_URL:
+        return None
+    if JWKS_CACHE is None or JWKS_CACHE.url != SUPABASE_JWKS_URL:
+        JWKS_CACHE = JwksCache(SUPABASE_JWKS_URL, JWKS_REFRESH_INTERVAL, JWKS_MIN_REFRESH_INTERVAL, JWKS_FAILURE_BACKOFF)
+    return JWKS_CACHE
+
+
+async def _verified_token_subject(token: str) -> Optional[str]:
+    """Vérifie signature, expiration et audience du JWT ; les jetons déjà vérifiés sont servis depuis TOKEN_CACHE."""
+    token_hash = hashlib.sha256(token.encode("utf-8")).digest()
+    sub = TOKEN_CACHE.get(token_hash)
+    if sub is not None:
+        return sub
+
+    header = jwt.get_unverified_header(token)
+    alg = header.get("alg")
+    jwks = _jwks_cache()
+    if alg == "HS256" and SUPABASE_JWT_SECRET:
+        key, algorithms = SUPABASE_JWT_SECRET, ["HS256"]
+    elif jwks:
+        jwk = await jwks.get_key(header.get("kid"))
+        key, algorithms = jwk.key, [jwk.algorithm_name]
+    else:
+        raise jwt.InvalidTokenError("No signing key configured")
+
+    payload = jwt.decode(
+        token,
+        key,
+        algorithms=algorithms,
+        audience=JWT_AUDIENCE or None,
+        leeway=JWT_LEEWAY,
+        options={"require": ["exp", "sub"], "verify_aud": bool(JWT_AUDIENCE)},
+    )
+    sub = str(payload["sub"])
+    ttl = float(payload["exp"]) - time.time()
+    if ttl > 0:
+        TOKEN_CACHE.set(token_hash, sub, ttl=ttl)
+    return sub
+
+
+async def _verify_and_get_user_id(authorization: Optional[str] = Header(default=None)) -> str:
+    with _stage("auth"):
+        if authorization and authorization.lower().startswith("bearer "):
+            token = authorization.split(" ", 1)[1]
+            if jwt and JWT_VERIFY:
+                try:
+                    return await _verified_token_subject(token)
+                except Exception as e:
+                    if DEV_MODE:
+                        print("[AutoQCM][DEBUG] JWT rejected:", e)
+            elif jwt:
+                # Décodage sans vérification (JWT_VERIFY=false) : réservé au développement
+                try:
+                    payload = jwt.decode(token, options={"verify_signature": False})
+                    sub = payload.get("sub") or payload.get("user_id")
+                    if sub:
+                        return str(sub)
+                except Exception:
+                    pass
+            # If unable to decode, but token exists, accept in DEV mode
+            if DEV_MODE:
+                return DEV_USER_ID
+            raise HTTPException(status_code=401, detail="Invalid token")
+        if DEV_MODE:
+            return DEV_USER_ID
+        raise HTTPException(status_code=401, detail="Authorization required")
+
+
+async def _check_generation_quota(user_id: str, reserved: int = 0) -> Tuple[Optional[Storage], str]:
+    """Vérifie le rôle et le quota de l'utilisateur ; lève 403/500 si la génération est interdite. Renvoie (stockage, rôle).
+
+    reserved : générations déjà acceptées mais pas encore comptées (tâches en attente ou en cours).
+    """
+    supa = _storage()
+    role = DEFAULT_ROLE
+    limit = ROLE_LIMITS.get(role)
+    total_before = 0
+    if supa:
+        try:
+            with _stage("quota"):
+                role, limit, total_before = await _compute_quota(supa, user_id)
+        except HTTPException:
+            # Propager directement les erreurs HTTP explicites (ex: rôle inconnu)
+            raise
+        except Exception as e:
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Failed to compute quota:", repr(e))
+            raise HTTPException(status_code=500, detail="Configuration des quotas QCM invalide. Contactez l'administrateur.")
+    if supa and limit is not None and total_before + reserved >= int(limit):
+        GENERATION_FAILURES.inc(("quota",))
+        raise HTTPException(status_code=403, detail="Limite de génération de QCM atteinte pour votre rôle.")
+    return supa, role
+
+
+async def _record_generation_usage(supa: Optional[Storage], user_id: str, model_name: str) -> None:
+    if supa and USAGE_WRITE_BEHIND:
+        USAGE_BUFFER.add(user_id, model_name)
+        _usage_cache_add(user_id, model_name)
+        USAGE_BUFFER.ensure_flusher()
+        return
+    if supa:
+        try:
+            with _stage("usage_write"):
+                await _increment_usage(supa, user_id, model_name)
+            _usage_cache_add(user_id, model_name)
+        except Exception as e:
+            # Issue inconnue (l'incrément a pu être validé) : pas de nouvel essai, le total sera relu en base
+            USAGE_CACHE.pop(user_id)
+            print("[AutoQCM] Failed to update usage:", repr(e))
+
+
+async def _aiter_llm(gen_fn: Callable[..., Any], *args: Any, trace: Optional[List[LlmCall]] = None):
+    """Consomme un générateur bloquant dans LLM_EXECUTOR et en relaie les éléments de façon asynchrone.
+
+    Si le consommateur s'arrête (client déconnecté, aclose()), le thread cesse de lire entre deux fragments
+    et ferme le générateur amont : le worker de LLM_EXECUTOR est rendu sans attendre la fin du modèle.
+    """
+    loop = asyncio.get_running_loop()
+    queue: "asyncio.Queue[Tuple[str, Any]]" = asyncio.Queue()
+    stop = threading.Event()
+    ctx = contextvars.copy_context()
+    if trace is not None:
+        ctx.run(_LLM_TRACE.set, trace)
+
+    def relay(kind: str, value: Any) -> None:
+        if not loop.is_closed():
+            loop.call_soon_threadsafe(queue.put_nowait, (kind, value))
+
+    def pump() -> None:
+        parts = gen_fn(*args)
+        try:
+            for part in parts:
+                if stop.is_set():
+                    return
+                relay("data", part)
+            relay("end", None)
+        except BaseException as e:  # pragma: no cover - relayé côté asynchrone
+            relay("error", e)
+        finally:
+            close = getattr(parts, "close", None)
+            if close is not None:
+                close()
+
+    loop.run_in_executor(LLM_EXECUTOR, ctx.run, pump)
+    try:
+        while True:
+            kind, value = await queue.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise value
+            yield value
+    finally:
+        stop.set()
+
+
+# Tâches détachées de la requête (ex. : comptage d'usage après déconnexion du client), gardées jusqu'à leur fin
+_DETACHED_TASKS: Set["asyncio.Task[Any]"] = set()
+
+
+def _detach(coro: Any) -> None:
+    """Exécute coro hors de la requête courante : l'annulation de celle-ci ne l'interrompt pas."""
+    task = asyncio.get_running_loop().create_task(coro)
+    _DETACHED_TASKS.add(task)
+    task.add_done_callback(_DETACHED_TASKS.discard)
+
+
+async def _stream_qcm_events(supa: Optional[Storage], user_id: str, skills: List[str], count: int, name: Optional[str], difficulty: str):
+    """Produit les événements du flux NDJSON : un 'item' par question validée, puis 'done' (ou 'error')."""
+    parser = QcmStreamParser()
+    emitted = 0
+    trace: List[LlmCall] = []
+    started = time.perf_counter()
+    chunks = _aiter_llm(_stream_via_langchain, skills, count, difficulty, trace=trace)
+    finished = False
+    try:
+        async for chunk in chunks:
+            for raw in parser.feed(chunk):
+                if emitted >= count:
+                    break
+                try:
+                    item = _item_from_raw(raw)
+                except Exception as e:
+                    if DEV_MODE:
+                        print("[AutoQCM][DEBUG] Skipping invalid streamed item:", repr(e))
+                    continue
+                # Compté avant l'envoi : une question livrée puis abandonnée par le client reste consommée
+                emitted += 1
+                yield {"type": "item", "index": emitted - 1, "item": item.model_dump()}
+        finished = True
+    except Exception as e:
+        finished = True
+        GENERATION_FAILURES.inc((_failure_cause(e),))
+        _count_generation("generate_qcm_stream", count, emitted)
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] Gemini streaming failed:", repr(e))
+        yield {"type": "error", "detail": "Service de génération de QCM indisponible ou en erreur. Veuillez réessayer plus tard."}
+        return
+    finally:
+        # Arrête le thread de lecture même si le consommateur abandonne au milieu d'un fragment
+        await chunks.aclose()
+        if not finished and emitted:
+            # Client parti après avoir reçu des questions : la génération est consommée, elle est comptée
+            _count_generation("generate_qcm_stream", count, emitted)
+            _detach(_record_generation_usage(supa, user_id, GEMINI_MODEL))
+    _count_generation("generate_qcm_stream", count, emitted)
+    if emitted == 0:
+        GENERATION_FAILURES.inc(("invalid_output",))
+        yield {"type": "error", "detail": "Service de génération de QCM indisponible ou en erreur. Veuillez réessayer plus tard."}
+        return
+    name_out = None
+    try:
+        data = _extract_json(parser.text)
+        name_out = data.get("name") if isinstance(data, dict) else None
+    except Exception:
+        pass
+    TELEMETRY.record(user_id, GEMINI_MODEL, difficulty, count, emitted, trace, (time.perf_counter() - started) * 1000)
+    await _record_generation_usage(supa, user_id, GEMINI_MODEL)
+    yield {"type": "done", "name": name_out or name, "count": emitted, "model": GEMINI_MODEL}
+
+
+def _plan_batches(skills: List[str], count: int, split: Optional[str], chunk_size: Optional[int]) -> List[Tuple[List[str], int]]:
+    """Découpe une demande en sous-lots (compétences, nombre de questions), dans l'ordre de restitution."""
+    size = chunk_size or FANOUT_CHUNK_SIZE
+    if split == "skill" and len(skills) > 1:
+        per_skill = [count // len(skills) + (1 if i < count % len(skills) else 0) for i in range(len(skills))]
+        batches: List[Tuple[List[str], int]] = []
+        for skill, n in zip(skills, per_skill):
+            while n > 0:
+                batches.append(([skill], min(size, n)))
+                n -= size
+        return batches
+    return [(list(skills), min(size, count - start)) for start in range(0, count, size)]
+
+
+def _merge_responses(responses: List[GenerateResponse], name: Optional[str]) -> GenerateResponse:
+    """Fusionne des réponses partielles dans l'ordre des lots, en garantissant des ids uniques."""
+    items: List[QcmItem] = []
+    seen_ids = set()
+    for resp in responses:
+        for item in resp.items:
+            if item.id in seen_ids:
+                item = item.model_copy(update={"id": str(uuid.uuid4())})
+            seen_ids.add(item.id)
+            items.append(item)
+    name_out = name or next((r.name for r in responses if r.name), None)
+    return GenerateResponse(name=name_out, items=items)
+
+
+async def _generate_fanout(batches: List[Tuple[List[str], int]], name: Optional[str], difficulty: str) -> GenerateResponse:
+    """Génère les sous-lots en parallèle (au plus FANOUT_MAX_CONCURRENCY), chaque lot étant relancé seul en cas d'échec."""
+    sem = asyncio.Semaphore(FANOUT_MAX_CONCURRENCY)
+
+    async def run_batch(batch_skills: List[str], batch_count: int) -> GenerateResponse:
+        last_exc: Optional[Exception] = None
+        for attempt in range(FANOUT_RETRIES + 1):
+            try:
+                async with sem:
+                    return await _run_llm(_generate_via_langchain, batch_skills, batch_count, name, difficulty)
+            except Exception as e:
+                last_exc = e
+                if DEV_MODE:
+                    print("[AutoQCM][DEBUG] Fan-out batch failed (attempt", attempt + 1, "):", repr(e))
+        raise last_exc  # type: ignore[misc]
+
+    responses = await asyncio.gather(*[run_batch(b_skills, b_count) for b_skills, b_count in batches])
+    return _merge_responses(list(responses), name)
+
+
+def _role_priority(role: str) -> Tuple[int, int]:
+    """Rang d'admission (plus petit = servi d'abord) : rôles illimités, puis limite ROLE_LIMITS décroissante."""
+    limit = ROLE_LIMITS.get(role, ROLE_LIMITS.get(DEFAULT_ROLE))
+    return (0, 0) if limit is None else (1, -int(limit))
+
+
+class AdmissionController:
+    """Contrôle d'admission des générations : plafond global, plafond par utilisateur et file d'attente bornée.
+
+    Les demandes en attente sont servies par priorité de rôle puis par ordre d'arrivée ; une demande dont
+    l'utilisateur a déjà atteint son plafond est sautée sans bloquer les suivantes.
+    """
+
+    def __init__(self, max_concurrency: int, max_per_user: int, queue_max: int, queue_timeout: float) -> None:
+        self.max_concurrency = max_concurrency
+        self.max_per_user = max_per_user
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self.running = 0
+        self._per_user: Dict[str, int] = {}
+        # Tas de [priorité, ordre d'arrivée, user_id, future]
+        self._queue: List[List[Any]] = []
+        self._seq = 0
+        self.admitted = 0
+        self.queued = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.service_avg: Optional[float] = None
+
+    def _has_room(self, user_id: str) -> bool:
+        return not self.max_per_user or self._per_user.get(user_id, 0) < self.max_per_user
+
+    def _start(self, user_id: str) -> None:
+        self.running += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self.admitted += 1
+
+    def _dispatch(self) -> None:
+        """Accorde les places libres aux demandes en attente."""
+        skipped: List[List[Any]] = []
+        while self._queue and self.running < self.max_concurrency:
+            entry = heapq.heappop(self._queue)
+            fut = entry[3]
+            if fut.done() or fut.get_loop().is_closed():
+                continue
+            if not self._has_room(entry[2]):
+                skipped.append(entry)
+                continue
+            self._start(entry[2])
+            fut.set_result(None)
+        for entry in skipped:
+            heapq.heappush(self._queue, entry)
+
+    def _withdraw(self, entry: List[Any]) -> None:
+        entry[3].cancel()
+        if entry in self._queue:
+            self._queue.remove(entry)
+            heapq.heapify(self._queue)
+
+    def retry_after(self) -> int:
+        """Délai conseillé (secondes) : durée moyenne d'une génération x rang dans la file / places."""
+        service = self.service_avg if self.service_avg is not None else 10.0
+        return max(1, math.ceil(service * (len(self._queue) + 1) / self.max_concurrency))
+
+    async def acquire(self, user_id: str, role: str) -> float:
+        """Attend une place ; renvoie le temps passé en file (s). Lève 429 (file pleine) ou 503 (délai dépassé)."""
+        if not self._queue and self.running < self.max_concurrency and self._has_room(user_id):
+            self._start(user_id)
+            return 0.0
+        if len(self._queue) >= self.queue_max:
+            self.rejected += 1
+            GENERATION_FAILURES.inc(("admission_rejected",))
+            raise HTTPException(status_code=429, detail="Trop de générations de QCM en cours. Veuillez réessayer plus tard.",
+                                headers={"Retry-After": str(self.retry_after())})
+        fut: "asyncio.Future[None]" = asyncio.get_running_loop().create_future()
+        entry = [_role_priority(role), self._seq, user_id, fut]
+        self._seq += 1
+        heapq.heappush(self._queue, entry)
+        self.queued += 1
+        started = time.monotonic()
+        self._dispatch()
+        try:
+            await asyncio.wait_for(asyncio.shield(fut), self.queue_timeout)
+        except asyncio.TimeoutError:
+            if not fut.done():
+                self._withdraw(entry)
+                self.timed_out += 1
+                GENERATION_FAILURES.inc(("queue_timeout",))
+                raise HTTPException(status_code=503, detail="Service de génération de QCM saturé. Veuillez réessayer plus tard.",
+                                    headers={"Retry-After": str(self.retry_after())})
+        except BaseException:
+            # Appelant annulé : rendre la place si elle venait d'être accordée
+            if fut.done() and not fut.cancelled():
+                self.release(user_id, 0.0)
+            else:
+                self._withdraw(entry)
+            raise
+        waited = time.monotonic() - started
+        self.waits += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        return waited
+
+    def release(self, user_id: str, held: float) -> None:
+        self.running -= 1
+        left = self._per_user.get(user_id, 0) - 1
+        if left > 0:
+            self._per_user[user_id] = left
+        else:
+            self._per_user.pop(user_id, None)
+        if held > 0:
+            self.service_avg = held if self.service_avg is None else 0.8 * self.service_avg + 0.2 * held
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, user_id: str, role: str, patient: bool = False):
+        """Tient une place pendant le bloc (sans effet si ADMISSION_ENABLED est faux).
+
+        patient=True (tâches de fond) : après un refus (429 / 503), nouvel essai au bout de Retry-After secondes.
+        """
+        if not ADMISSION_ENABLED:
+            yield
+            return
+        while True:
+            try:
+                await self.acquire(user_id, role)
+                break
+            except HTTPException as e:
+                if not patient:
+                    raise
+                await asyncio.sleep(float((e.headers or {}).get("Retry-After", "1")))
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_id, time.monotonic() - started)
+
+    def depth(self) -> int:
+        """Demandes en file d'admission."""
+        return len(self._queue)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": ADMISSION_ENABLED,
+            "max_concurrency": self.max_concurrency,
+            "max_per_user": self.max_per_user,
+            "queue_max": self.queue_max,
+            "running": self.running,
+            "queue_depth": self.depth(),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "wait_ms_avg": round(self.wait_total / max(1, self.waits) * 1000, 1),
+            "wait_ms_max": round(self.wait_max * 1000, 1),
+            "retry_after": self.retry_after(),
+        }
+
+
+ADMISSION = AdmissionController(ADMISSION_MAX_CONCURRENCY, ADMISSION_MAX_PER_USER, ADMISSION_QUEUE_MAX, ADMISSION_QUEUE_TIMEOUT)
+
+
+@asynccontextmanager
+async def _no_slot():
+    """Pendant de ADMISSION.slot() pour une demande qui n'appellera pas le LLM."""
+    yield
+
+
+async def _admitted_events(user_id: str, role: str, events):
+    """Enveloppe un flux d'événements : la place est prise au premier événement et rendue à la fin du flux."""
+    try:
+        async with ADMISSION.slot(user_id, role):
+            async for event in events:
+                yield event
+    finally:
+        await events.aclose()
+
+
+class RequestCoalescer:
+    """Single-flight : un appel par clé à la fois ; les demandes identiques arrivées dans la fenêtre l'attendent.
+
+    L'appel tourne dans sa propre tâche : l'annulation d'un appelant (client déconnecté) ne l'interrompt pas
+    pour les autres. La clé est libérée dès la fin de l'appel (succès ou échec).
+    """
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self.calls = 0
+        self.joined = 0
+        self._inflight: Dict[Any, Tuple[float, "asyncio.Future[Any]"]] = {}
+
+    async def run(self, key: Any, factory: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Renvoie (résultat, partagé) ; partagé = True si l'appel d'un autre demandeur a été réutilisé."""
+        now = time.monotonic()
+        entry = self._inflight.get(key)
+        if entry is not None and now - entry[0] < self.window and not entry[1].done() \
+                and entry[1].get_loop() is asyncio.get_running_loop():
+            self.joined += 1
+            return await asyncio.shield(entry[1]), True
+        task = asyncio.ensure_future(factory())
+        self._inflight[key] = (now, task)
+        self.calls += 1
+
+        def release(t: "asyncio.Future[Any]") -> None:
+            if self._inflight.get(key, (0, None))[1] is t:
+                del self._inflight[key]
+
+        task.add_done_callback(release)
+        return await asyncio.shield(task), False
+
+    def inflight(self) -> int:
+        """Appels partagés en cours (encore rejoignables ou non)."""
+        return len(self._inflight)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"enabled": COALESCE_ENABLED, "calls": self.calls, "saved_calls": self.joined, "in_flight": self.inflight()}
+
+
+COALESCER = RequestCoalescer(COALESCE_WINDOW)
+
+
+def _with_fresh_ids(response: GenerateResponse) -> GenerateResponse:
+    """Copie propre à un appelant : nouvelles questions (ids neufs), le résultat partagé n'est jamais modifié."""
+    return GenerateResponse(name=response.name, items=[it.model_copy(update={"id": str(uuid.uuid4())}) for it in response.items])
+
+
+async def _generate_response(skills: List[str], count: int, name: Optional[str], difficulty: str,
+                             split: Optional[str] = None, chunk_size: Optional[int] = None) -> GenerateResponse:
+    """Génère un QCM complet ; les demandes identiques simultanées sont coalescées (COALESCE_ENABLED)."""
+    if not COALESCE_ENABLED:
+        return await _generate_response_uncoalesced(skills, count, name, difficulty, split, chunk_size)
+    key = (tuple(sorted(s.strip().casefold() for s in skills)), count, name, difficulty.casefold(), split, chunk_size)
+    response, _shared = await COALESCER.run(
+        key, lambda: _generate_response_uncoalesced(skills, count, name, difficulty, split, chunk_size)
+    )
+    return _with_fresh_ids(response)
+
+
+async def _generate_response_uncoalesced(skills: List[str], count: int, name: Optional[str], difficulty: str,
+                                         split: Optional[str] = None, chunk_size: Optional[int] = None) -> GenerateResponse:
+    """Génère un QCM complet, en un appel ou en fan-out selon split / FANOUT_AUTO_MIN_COUNT."""
+    if split is None and FANOUT_AUTO_MIN_COUNT and count >= FANOUT_AUTO_MIN_COUNT:
+        split = "chunk"
+    if split:
+        batches = _plan_batches(skills, count, split, chunk_size)
+        if len(batches) > 1:
+            return await _generate_fanout(batches, name, difficulty)
+    return await _run_llm(_generate_via_langchain, skills, count, name, difficulty)
+
+
+async def _generate_with_bank(user_id: str, skills: List[str], count: int, name: Optional[str], difficulty: str,
+                              split: Optional[str] = None, chunk_size: Optional[int] = None,
+                              fresh_only: bool = False, coalesce: bool = True) -> GenerateResponse:
+    """Sert la demande depuis la banque de questions quand c'est possible ; seul le manque est demandé au LLM.
+
+    coalesce=False : appel propre à l'appelant (lots d'une même tâche, de clés de coalescence identiques).
+    """
+    generate = _generate_response if coalesce else _generate_response_uncoalesced
+    bank = None if fresh_only else _question_bank()
+    if bank is None:
+        return await generate(skills, count, name, difficulty, split, chunk_size)
+    served = await run_in_threadpool(bank.sample, user_id, skills, difficulty, GEMINI_MODEL, count)
+    if DEV_MODE:
+        print("[AutoQCM][DEBUG] Question bank served", len(served), "/", count, "items")
+    if len(served) >= count:
+        return GenerateResponse(name=name, items=served[:count])
+    generated = await generate(skills, count - len(served), name, difficulty, split, chunk_size)
+    try:
+        await run_in_threadpool(bank.add, user_id, generated.items, skills, difficulty, GEMINI_MODEL)
+    except Exception as e:
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] Failed to store items in question bank:", repr(e))
+    return _merge_responses([GenerateResponse(name=name, items=served), generated], name or generated.name)
+
+
+def _filter_near_duplicates(items: List[QcmItem], user_index: Optional[NearDuplicateIndex],
+                            local: NearDuplicateIndex) -> Tuple[List[QcmItem], int]:
+    """Écarte les questions paraphrasant une question déjà vue (dans la réponse ou dans l'historique)."""
+    kept: List[QcmItem] = []
+    dropped = 0
+    for item in items:
+        sig = local.signature(item.question)
+        if local.find(sig=sig) is not None or (user_index is not None and user_index.find(sig=sig) is not None):
+            dropped += 1
+            continue
+        local.add(item.id, sig=sig)
+        kept.append(item)
+    return kept, dropped
+
+
+async def _dedupe_response(user_id: str, response: GenerateResponse, skills: List[str], count: int,
+                           difficulty: str) -> GenerateResponse:
+    """Supprime les quasi-doublons d'une génération et, si DEDUP_REPLACE, redemande une fois le nombre manquant."""
+    # Historique indisponible : on écarte au moins les doublons internes à la réponse
+    user_index = await _user_dedup_index(user_id) or NearDuplicateIndex(threshold=DEDUP_THRESHOLD)
+    local = NearDuplicateIndex(threshold=DEDUP_THRESHOLD)
+    kept, dropped = _filter_near_duplicates(response.items, user_index, local)
+    if dropped and DEV_MODE:
+        print("[AutoQCM][DEBUG] Dropped", dropped, "near-duplicate questions")
+    if dropped and DEDUP_REPLACE:
+        try:
+            extra = await _generate_response(skills, count - len(kept), response.name, difficulty)
+            more, _ = _filter_near_duplicates(extra.items, user_index, local)
+            kept = _merge_responses([GenerateResponse(items=kept), GenerateResponse(items=more)], None).items
+        except Exception as e:
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Replacement generation failed:", repr(e))
+    return GenerateResponse(name=response.name, items=kept[:count])
+
+
+def _normalize_generate_request(req: GenerateRequest) -> Tuple[List[str], int, str]:
+    skills = req.skills or []
+    count = max(1, min(50, req.count or 10))
+    difficulty = (req.difficulty or "entretien").strip() or "entretien"
+    return skills, count, difficulty
+
+
+def _encode_cursor(created_at: str, record_id: str) -> str:
+    raw = json.dumps([created_at, record_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    """Curseur opaque de /history -> clé (created_at, id) de la dernière ligne déjà servie ; 400 s'il est invalide."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, record_id = json.loads(raw)
+        # Le curseur est réinjecté dans un filtre PostgREST : on n'accepte que des valeurs bien formées
+        datetime.fromisoformat(str(created_at).replace("Z", "+00:00"))
+        uuid.UUID(str(record_id))
+        return str(created_at), str(record_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def _history_bound(value: Optional[datetime], aware: bool) -> Optional[str]:
+    """Borne de date au format de created_at : ISO avec fuseau pour Supabase, UTC naïf pour le store mémoire."""
+    if value is None:
+        return None
+    if value.tzinfo is not None and not aware:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value.isoformat()
+
+
+# ---------- Generation jobs ----------
+class GenerationJob(TypedDict):
+    id: str
+    user_id: str
+    role: str
+    # queued | running | succeeded | failed
+    status: str
+    request: GenerateJobRequest
+    created_at: str
+    started_at: Optional[str]
+    finished_at: Optional[str]
+    # Échéance (time.monotonic) de conservation ; 0 tant que la tâche n'est pas terminée
+    expires: float
+    name: Optional[str]
+    # Questions déjà produites : partielles pendant l'exécution, définitives une fois la tâche réussie
+    items: List[QcmItem]
+    model: Optional[str]
+    saved_id: Optional[str]
+    save_error: Optional[str]
+    error: Optional[str]
+
+
+class GenerationJobStore:
+    """Tâches de génération en mémoire (par processus) : file FIFO, pool borné de workers, TTL des tâches terminées.
+
+    Les workers sont des tâches asyncio démarrées à la demande sur la boucle courante (au plus `workers`) ;
+    chacun vide la file puis s'arrête.
+    """
+
+    def __init__(self, workers: int, queue_max: int, max_per_user: int, ttl: float, max_finished: int) -> None:
+        self.workers = workers
+        self.queue_max = queue_max
+        self.max_per_user = max_per_user
+        self.ttl = ttl
+        self.max_finished = max_finished
+        self._jobs: "OrderedDict[str, GenerationJob]" = OrderedDict()
+        self._pending: "deque[GenerationJob]" = deque()
+        self._workers: set = set()
+        self.submitted = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.rejected = 0
+        self.expired = 0
+        self.duration_avg: Optional[float] = None
+
+    def _purge(self) -> None:
+        """Oublie les tâches terminées expirées, puis les plus anciennes au-delà de max_finished."""
+        now = time.monotonic()
+        finished = [job for job in self._jobs.values() if job["expires"]]
+        drop = {job["id"] for job in finished if job["expires"] < now}
+        excess = len(finished) - len(drop) - self.max_finished
+        if excess > 0:
+            survivors = sorted((job for job in finished if job["id"] not in drop), key=lambda job: job["expires"])
+            drop.update(job["id"] for job in survivors[:excess])
+        for job_id in drop:
+            del self._jobs[job_id]
+        self.expired += len(drop)
+
+    def active(self, user_id: str) -> int:
+        """Tâches de l'utilisateur en attente ou en cours (générations acceptées, pas encore comptées)."""
+        return sum(1 for job in self._jobs.values() if job["user_id"] == user_id and not job["expires"])
+
+    def get(self, job_id: str) -> Optional[GenerationJob]:
+        job = self._jobs.get(job_id)
+        if job is not None and job["expires"] and job["expires"] < time.monotonic():
+            del self._jobs[job_id]
+            self.expired += 1
+            return None
+        return job
+
+    def depth(self) -> int:
+        """Tâches en attente d'un worker."""
+        return len(self._pending)
+
+    def retry_after(self) -> int:
+        duration = self.duration_avg if self.duration_avg is not None else 30.0
+        return max(1, math.ceil(duration * (len(self._pending) + 1) / self.workers))
+
+    def submit(self, user_id: str, role: str, req: GenerateJobRequest) -> GenerationJob:
+        """Met une tâche en file ; 429 (avec Retry-After) si la file ou le quota de tâches de l'utilisateur est plein."""
+        self._purge()
+        if len(self._pending) >= self.queue_max or self.active(user_id) >= self.max_per_user:
+            self.rejected += 1
+            GENERATION_FAILURES.inc(("jobs_rejected",))
+            raise HTTPException(status_code=429, detail="Trop de tâches de génération en attente. Veuillez réessayer plus tard.",
+                                headers={"Retry-After": str(self.retry_after())})
+        job = GenerationJob(
+            id=str(uuid.uuid4()), user_id=user_id, role=role, status="queued", request=req,
+            created_at=datetime.utcnow().isoformat(), started_at=None, finished_at=None, expires=0.0,
+            name=req.name, items=[], model=None, saved_id=None, save_error=None, error=None,
+        )
+        self._jobs[job["id"]] = job
+        self._pending.append(job)
+        self.submitted += 1
+        self._ensure_workers()
+        return job
+
+    def finish(self, job: GenerationJob, error: Optional[str] = None) -> None:
+        job["status"] = "failed" if error else "succeeded"
+        job["error"] = error
+        job["finished_at"] = datetime.utcnow().isoformat()
+        job["expires"] = time.monotonic() + self.ttl
+        if error:
+            self.failed += 1
+        else:
+            self.succeeded += 1
+        if job["started_at"]:
+            duration = (datetime.fromisoformat(job["finished_at"]) - datetime.fromisoformat(job["started_at"])).total_seconds()
+            self.duration_avg = duration if self.duration_avg is None else 0.8 * self.duration_avg + 0.2 * duration
+
+    def _ensure_workers(self) -> None:
+        loop = asyncio.get_running_loop()
+        self._workers = {t for t in self._workers if not t.done() and t.get_loop() is loop}
+        if len(self._workers) < self.workers:
+            self._workers.add(loop.create_task(self._work()))
+
+    async def _work(self) -> None:
+        while self._pending:
+            job = self._pending.popleft()
+            try:
+                await _run_generation_job(job)
+            except asyncio.CancelledError:
+                self.finish(job, error="Tâche interrompue (arrêt du serveur). Veuillez la relancer.")
+                raise
+            except Exception as e:  # pragma: no cover - _run_generation_job gère ses erreurs
+                if DEV_MODE:
+                    print("[AutoQCM][DEBUG] Generation job crashed:", repr(e))
+                if not job["expires"]:
+                    self.finish(job, error="Service de génération de QCM indisponible ou en erreur. Veuillez réessayer plus tard.")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.workers,
+            "busy_workers": sum(1 for t in self._workers if not t.done()),
+            "queue_depth": self.depth(),
+            "running": sum(1 for job in self._jobs.values() if job["status"] == "running"),
+            "submitted": self.submitted,
+            "succeeded": self.succeeded,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "expired": self.expired,
+            "duration_ms_avg": None if self.duration_avg is None else round(self.duration_avg * 1000, 1),
+        }
+
+
+JOBS = GenerationJobStore(JOBS_WORKERS, JOBS_QUEUE_MAX, JOBS_MAX_PER_USER, JOBS_TTL, JOBS_MAX_FINISHED)
+
+
+async def _generate_job_batches(job: GenerationJob, skills: List[str], count: int, difficulty: str) -> GenerateResponse:
+    """Génère par lots (chunk_size / FANOUT_CHUNK_SIZE) ; chaque lot terminé rejoint les résultats partiels de la tâche."""
+    req = job["request"]
+    batches = _plan_batches(skills, count, req.split, req.chunk_size)
+    results: List[Optional[GenerateResponse]] = [None] * len(batches)
+    semaphore = asyncio.Semaphore(FANOUT_MAX_CONCURRENCY)
+
+    async def run_batch(index: int, b_skills: List[str], b_count: int) -> None:
+        async with semaphore:
+            for attempt in range(FANOUT_RETRIES + 1):
+                try:
+                    # Hors coalescence : les lots d'une tâche ont la même clé et partageraient un seul appel
+                    response = await _generate_with_bank(job["user_id"], b_skills, b_count, req.name, difficulty,
+                                                         fresh_only=req.fresh_only, coalesce=False)
+                    break
+                except Exception as e:
+                    if attempt == FANOUT_RETRIES:
+                        raise
+                    if DEV_MODE:
+                        print("[AutoQCM][DEBUG] Job batch failed (attempt", attempt + 1, "):", repr(e))
+        # Ids neufs : stables d'une lecture à l'autre et uniques entre lots
+        results[index] = _with_fresh_ids(response)
+        job["items"] = [it for r in results if r is not None for it in r.items]
+
+    await asyncio.gather(*[run_batch(i, b_skills, b_count) for i, (b_skills, b_count) in enumerate(batches)])
+    return _merge_responses([r for r in results if r is not None], req.name)
+
+
+async def _run_generation_job(job: GenerationJob) -> None:
+    """Exécute une tâche comme /generate_qcm : admission, génération, dédoublonnage, quota compté une fois, sauvegarde."""
+    req = job["request"]
+    user_id = job["user_id"]
+    skills, count, difficulty = _normalize_generate_request(req)
+    job["status"] = "running"
+    job["started_at"] = datetime.utcnow().isoformat()
+    trace: List[LlmCall] = []
+    trace_token = _LLM_TRACE.set(trace)
+    started = time.perf_counter()
+    response: Optional[GenerateResponse] = None
+    if DEDUP_ENABLED:
+        _prefetch_dedup_index(user_id)
+    try:
+        # Une tâche de fond attend sa place au lieu d'être refusée
+        async with ADMISSION.slot(user_id, job["role"], patient=True):
+            response = await _generate_job_batches(job, skills, count, difficulty)
+            if DEDUP_ENABLED:
+                response = await _dedupe_response(user_id, response, skills, count, difficulty)
+    except Exception as e:
+        GENERATION_FAILURES.inc((_failure_cause(e),))
+        if DEV_MODE:
+            print("[AutoQCM][DEBUG] Generation job failed:", repr(e))
+    finally:
+        _LLM_TRACE.reset(trace_token)
+        TELEMETRY.record(user_id, GEMINI_MODEL, difficulty, count, len(response.items) if response else 0, trace,
+                         (time.perf_counter() - started) * 1000)
+        _count_generation("generate_qcm_jobs", count, len(response.items) if response else 0)
+    if response is None:
+        JOBS.finish(job, error="Service de génération de QCM indisponible ou en erreur. Veuillez réessayer plus tard.")
+        return
+
+    job["name"] = response.name
+    job["items"] = response.items
+    job["model"] = GEMINI_MODEL
+    await _record_generation_usage(_storage(), user_id, GEMINI_MODEL)
+    if req.auto_save:
+        try:
+            job["saved_id"] = await _persist_qcm(SaveRequest(user_id=user_id, qcm=response))
+        except Exception as e:
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Generation job auto-save failed:", repr(e))
+            job["save_error"] = e.detail if isinstance(e, HTTPException) else str(e)
+    JOBS.finish(job)
+
+
+def _job_view(job: GenerationJob) -> Dict[str, Any]:
+    return {
+        "id": job["id"],
+        "status": job["status"],
+        "requested": job["request"].count,
+        "completed": len(job["items"]),
+        "name": job["name"],
+        "items": [it.model_dump() for it in job["items"]],
+        "model": job["model"],
+        "saved_id": job["saved_id"],
+        "save_error": job["save_error"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "finished_at": job["finished_at"],
+    }
+
+
+# ---------- Pre-generation warmer ----------
+def _warm_key(skills: List[str], difficulty: str) -> Tuple[Tuple[str, ...], str]:
+    """Clé (compétences, difficulté) sans tenir compte de la casse ni de l'ordre des compétences."""
+    return tuple(sorted(s.strip().casefold() for s in skills)), difficulty.strip().casefold()
+
+
+class PregenerationWarmer:
+    """Réserve de questions pré-générées pour les combinaisons (compétences, difficulté) les plus demandées.
+
+    Le trafic récent de /generate_qcm désigne les combinaisons populaires ; en l'absence de charge, tick() les
+    complète (un appel LLM au plus par pas, dans la limite d'appels par heure). take() sert la réserve : chaque
+    question n'est servie qu'une fois.
+    """
+
+    USER_ID = "__warmer__"
+
+    def __init__(self, window: float, min_requests: int, top_keys: int, pool_size: int, batch_size: int,
+                 max_calls_per_hour: int, idle_seconds: float, pool_ttl: float) -> None:
+        self.window = window
+        self.min_requests = min_requests
+        self.top_keys = top_keys
+        self.pool_size = pool_size
+        self.batch_size = batch_size
+        self.max_calls_per_hour = max_calls_per_hour
+        self.idle_seconds = idle_seconds
+        self.pool_ttl = pool_ttl
+        self._traffic: "deque[Tuple[float, Any]]" = deque()
+        self._counts: Dict[Any, int] = {}
+        # Compétences telles que demandées (dernière forme vue), pour les prompts de pré-génération
+        self._skills: Dict[Any, List[str]] = {}
+        self._pool: Dict[Any, "deque[Tuple[float, QcmItem]]"] = {}
+        self._calls: "deque[float]" = deque()
+        self.last_live = float("-inf")
+        self._task: Optional["asyncio.Task[None]"] = None
+        self.lookups = 0
+        self.hits = 0
+        self.partial_hits = 0
+        self.items_served = 0
+        self.items_generated = 0
+        self.items_expired = 0
+        self.paused = 0
+        self.budget_exhausted = 0
+        self.errors = 0
+
+    def _prune(self, now: float) -> None:
+        while self._traffic and self._traffic[0][0] < now - self.window:
+            _, key = self._traffic.popleft()
+            self._counts[key] -= 1
+            if not self._counts[key]:
+                del self._counts[key]
+                del self._skills[key]
+        while self._calls and self._calls[0] < now - 3600:
+            self._calls.popleft()
+        for key in list(self._pool):
+            pool = self._pool[key]
+            while pool and pool[0][0] < now - self.pool_ttl:
+                pool.popleft()
+                self.items_expired += 1
+            if not pool and key not in self._counts:
+                del self._pool[key]
+
+    def observe(self, skills: List[str], difficulty: str) -> None:
+        """Enregistre une demande de génération en direct (popularité et horodatage de la dernière charge)."""
+        now = time.monotonic()
+        self.last_live = now
+        key = _warm_key(skills, difficulty)
+        self._traffic.append((now, key))
+        self._counts[key] = self._counts.get(key, 0) + 1
+        self._skills[key] = list(skills)
+        self._prune(now)
+
+    def popular(self) -> List[Any]:
+        """Combinaisons vues au moins min_requests fois dans la fenêtre, les plus fréquentes d'abord."""
+        ranked = sorted(((n, key) for key, n in self._counts.items() if n >= self.min_requests), key=lambda e: -e[0])
+        return [key for _, key in ranked[:self.top_keys]]
+
+    def available(self, skills: List[str], difficulty: str) -> int:
+        return len(self._pool.get(_warm_key(skills, difficulty), ()))
+
+    def take(self, skills: List[str], difficulty: str, count: int) -> List[QcmItem]:
+        """Retire jusqu'à count questions prêtes pour cette combinaison."""
+        self._prune(time.monotonic())
+        self.lookups += 1
+        pool = self._pool.get(_warm_key(skills, difficulty))
+        items = [pool.popleft()[1] for _ in range(min(count, len(pool)))] if pool else []
+        if len(items) >= count:
+            self.hits += 1
+        elif items:
+            self.partial_hits += 1
+        self.items_served += len(items)
+        return items
+
+    def _busy(self, now: float) -> bool:
+        return ADMISSION.running > 0 or now - self.last_live < self.idle_seconds
+
+    async def tick(self) -> int:
+        """Un pas de pré-génération (au plus un appel LLM) ; renvoie le nombre de questions ajoutées à la réserve."""
+        now = time.monotonic()
+        self._prune(now)
+        if self._busy(now):
+            self.paused += 1
+            return 0
+        for key in self.popular():
+            missing = self.pool_size - len(self._pool.get(key, ()))
+            if missing <= 0:
+                continue
+            if len(self._calls) >= self.max_calls_per_hour:
+                self.budget_exhausted += 1
+                return 0
+            self._calls.append(now)
+            skills, difficulty = self._skills[key], key[1]
+            count = min(missing, self.batch_size)
+            trace: List[LlmCall] = []
+            trace_token = _LLM_TRACE.set(trace)
+            started = time.perf_counter()
+            items: List[QcmItem] = []
+            try:
+                async with ADMISSION.slot(self.USER_ID, DEFAULT_ROLE):
+                    # Hors coalescence : rejoindre l'appel d'un utilisateur mettrait ses questions dans la réserve
+                    items = _with_fresh_ids(await _generate_response_uncoalesced(skills, count, None, difficulty)).items
+            except Exception as e:
+                self.errors += 1
+                if DEV_MODE:
+                    print("[AutoQCM][DEBUG] Pre-generation failed:", repr(e))
+            finally:
+                _LLM_TRACE.reset(trace_token)
+                TELEMETRY.record(self.USER_ID, GEMINI_MODEL, difficulty, count, len(items), trace, (time.perf_counter() - started) * 1000)
+            added = time.monotonic()
+            self._pool.setdefault(key, deque()).extend((added, item) for item in items)
+            self.items_generated += len(items)
+            return len(items)
+        return 0
+
+    def ensure_started(self) -> None:
+        """Démarre (ou redémarre sur la boucle courante) la tâche de pré-génération périodique."""
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._task.get_loop() is loop:
+            return
+        self._task = loop.create_task(self._loop())
+
+    async def _loop(self) -> None:
+        while True:
+            await asyncio.sleep(WARMER_INTERVAL)
+            await self.tick()
+
+    def stats(self) -> Dict[str, Any]:
+        self._prune(time.monotonic())
+        return {
+            "enabled": WARMER_ENABLED,
+            "lookups": self.lookups,
+            "hits": self.hits,
+            "partial_hits": self.partial_hits,
+            "hit_rate": round(self.hits / self.lookups, 3) if self.lookups else None,
+            "items_served": self.items_served,
+            "items_generated": self.items_generated,
+            "items_expired": self.items_expired,
+            "llm_calls_last_hour": len(self._calls),
+            "max_calls_per_hour": self.max_calls_per_hour,
+            "paused": self.paused,
+            "budget_exhausted": self.budget_exhausted,
+            "errors": self.errors,
+            "pool": [{"skills": list(key[0]), "difficulty": key[1], "ready": len(pool), "requests": self._counts.get(key, 0)}
+                     for key, pool in self._pool.items()],
+        }
+
+
+WARMER = PregenerationWarmer(WARMER_WINDOW, WARMER_MIN_REQUESTS, WARMER_TOP_KEYS, WARMER_POOL_SIZE, WARMER_BATCH_SIZE,
+                             WARMER_MAX_CALLS_PER_HOUR, WARMER_IDLE_SECONDS, WARMER_POOL_TTL)
+
+
+async def _generate_with_ready_pool(user_id: str, skills: List[str], count: int, difficulty: str,
+                                    req: GenerateRequest) -> GenerateResponse:
+    """Sert d'abord la réserve pré-générée (WARMER_ENABLED), puis la banque de questions et le LLM pour le reste."""
+    ready = WARMER.take(skills, difficulty, count) if WARMER_ENABLED and not req.fresh_only else []
+    if len(ready) >= count:
+        return GenerateResponse(name=req.name, items=ready)
+    generated = await _generate_with_bank(user_id, skills, count - len(ready), req.name, difficulty, req.split, req.chunk_size, req.fresh_only)
+    if not ready:
+        return generated
+    return _merge_responses([GenerateResponse(name=req.name, items=ready), generated], req.name or generated.name)
+
+
+# ---------- Lifecycle ----------
+async def _on_startup() -> None:
+    if LLM_WARMUP:
+        await _run_llm(_warmup_llm_clients)
+    if WARMER_ENABLED:
+        WARMER.ensure_started()
+    jwks = _jwks_cache() if JWT_VERIFY and jwt else None
+    if jwks:
+        try:
+            await run_in_threadpool(jwks.refresh, True)
+            jwks.ensure_refresher()
+        except Exception as e:
+            print("[AutoQCM] JWKS prefetch failed:", e)
+    if STORE_SNAPSHOT_PATH:
+        try:
+            loaded = await run_in_threadpool(STORE.load_snapshot, STORE_SNAPSHOT_PATH)
+            print("[AutoQCM] Loaded", loaded, "QCM from", STORE_SNAPSHOT_PATH)
+        except Exception as e:
+            print("[AutoQCM] Store snapshot load failed:", repr(e))
+        if STORE_SNAPSHOT_INTERVAL > 0:
+            asyncio.get_running_loop().create_task(_snapshot_loop())
+
+
+async def _on_shutdown() -> None:
+    await _flush_usage_buffer()
+    await _snapshot_store()
+    if SUPABASE_CLIENT is not None:
+        await SUPABASE_CLIENT.aclose()
+
+
+# ---------- Endpoints ----------
+@app.post("/generate_qcm", response_model=GenerateResponse)
+async def generate_qcm(req: GenerateRequest, user_id: str = Depends(_verify_and_get_user_id)):
+    skills, count, difficulty = _normalize_generate_request(req)
+    supa, role = await _check_generation_quota(user_id)
+
+    if WARMER_ENABLED:
+        WARMER.observe(skills, difficulty)
+    if DEDUP_ENABLED:
+        _prefetch_dedup_index(user_id)
+    # Demande couverte par la réserve pré-générée : aucun appel LLM, donc pas de place d'admission à attendre
+    warm = WARMER_ENABLED and not req.fresh_only and WARMER.available(skills, difficulty) >= count
+    model_name = GEMINI_MODEL
+    # Admission hors du try : 429 / 503 de file d'attente renvoyés tels quels, sans télémétrie ni quota
+    async with (_no_slot() if warm else ADMISSION.slot(user_id, role)):
+        trace: List[LlmCall] = []
+        trace_token = _LLM_TRACE.set(trace)
+        started = time.perf_counter()
+        items = 0
+        try:
+            # Le fournisseur LLM est vérifié par _get_llm() : réserve et banque de questions restent servies s'il est absent
+            response = await _generate_with_ready_pool(user_id, skills, count, difficulty, req)
+            if DEDUP_ENABLED:
+                response = await _dedupe_response(user_id, response, skills, count, difficulty)
+            model_name = GEMINI_MODEL
+            items = len(response.items)
+        except Exception as e:
+            GENERATION_FAILURES.inc((_failure_cause(e),))
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Gemini generation failed:", repr(e))
+            # Plus de QCM fallback : on renvoie une erreur explicite au client
+            raise HTTPException(status_code=503, detail="Service de génération de QCM indisponible ou en erreur. Veuillez réessayer plus tard.")
+        finally:
+            _LLM_TRACE.reset(trace_token)
+            # Les appels en échec consomment aussi des tokens : la requête est comptée dans tous les cas
+            TELEMETRY.record(user_id, model_name, difficulty, count, items, trace, (time.perf_counter() - started) * 1000)
+            _count_generation("generate_qcm", count, items)
+
+    await _record_generation_usage(supa, user_id, model_name)
+    return response
+
+
+@app.post("/generate_qcm/stream")
+async def generate_qcm_stream(req: GenerateRequest, user_id: str = Depends(_verify_and_get_user_id)):
+    """Variante streaming (NDJSON) de /generate_qcm : une ligne JSON par question dès qu'elle est complète."""
+    skills, count, difficulty = _normalize_generate_request(req)
+    supa, role = await _check_generation_quota(user_id)
+    if not ChatGoogleGenerativeAI:
+        raise HTTPException(status_code=503, detail="Service de génération de QCM indisponible ou en erreur. Veuillez réessayer plus tard.")
+
+    # La place d'admission est prise au premier événement et tenue jusqu'à la fin (ou l'abandon) du flux
+    events = _admitted_events(user_id, role, _stream_qcm_events(supa, user_id, skills, count, req.name, difficulty))
+    # Le premier événement est attendu avant d'ouvrir le flux, pour pouvoir encore répondre 429 / 503
+    first = await events.__anext__()
+    if first.get("type") == "error":
+        await events.aclose()
+        raise HTTPException(status_code=503, detail=first["detail"])
+
+    async def ndjson():
+        try:
+            yield _json_dumps(first) + b"\n"
+            async for event in events:
+                yield _json_dumps(event) + b"\n"
+        finally:
+            # Déconnexion du client : fermer tout de suite la chaîne (place d'admission, thread LLM)
+            await events.aclose()
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+
+@app.post("/generate_qcm/jobs", status_code=202)
+async def create_generation_job(req: GenerateJobRequest, response: Response, user_id: str = Depends(_verify_and_get_user_id)):
+    """Variante asynchrone de /generate_qcm : renvoie aussitôt l'id d'une tâche exécutée en arrière-plan."""
+    # Les tâches acceptées mais pas encore comptées réservent leur part du quota
+    _, role = await _check_generation_quota(user_id, reserved=JOBS.active(user_id))
+    job = JOBS.submit(user_id, role, req)
+    response.headers["Location"] = f"/generate_qcm/jobs/{job['id']}"
+    return _job_view(job)
+
+
+@app.get("/generate_qcm/jobs/{job_id}")
+async def get_generation_job(job_id: str, user_id: str = Depends(_verify_and_get_user_id)):
+    """État d'une tâche et questions déjà produites (partielles tant qu'elle est en cours)."""
+    job = JOBS.get(job_id)
+    if job is None or (job["user_id"] != user_id and not DEV_MODE):
+        raise HTTPException(status_code=404, detail="Not found")
+    return _job_view(job)
+
+
+async def _persist_qcm(req: SaveRequest) -> str:
+    """Enregistre un QCM (stockage configuré, sinon store mémoire) et renvoie son id ; partagé avec les tâches de génération."""
+    supa = _storage()
+    record_id = str(uuid.uuid4())
+    now = datetime.utcnow().isoformat()
+
     if supa:
         try:
-            res = supa.table("qcm_tests").select("id,user_id,name,score,created_at").eq("user_id", user_id).order("created_at", desc=True).execute()
-            data = res.data or []  # type: ignore
-            return [
-                HistoryItem(
-                    id=it["id"], user_id=it["user_id"], name=it.get("name"), score=it.get("score"), created_at=datetime.fromisoformat(it["created_at"].replace("Z", "+00:00"))
-                ) for it in data
-            ]
+            payload = {
+                "id": record_id,
+                "user_id": req.user_id,
+                "name": req.qcm.name,
+                "qcm": _saved_qcm_document(req),
+                "score": req.score,
+                "created_at": now,
+            }
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Saving QCM to Supabase with payload id=", record_id)
+            res = await _insert_qcm_test(supa, payload)
+            if getattr(res, "error", None):  # type: ignore
+                if DEV_MODE:
+                    print("[AutoQCM][DEBUG] Supabase insert error:", res.error)  # type: ignore
+                raise HTTPException(status_code=500, detail=str(res.error))  # type: ignore
+            _remember_saved_questions(req.user_id, req.qcm)
+            return record_id
         except Exception as e:
+            if DEV_MODE:
+                print("[AutoQCM][DEBUG] Exception while saving to Supabase:", repr(e))
             raise HTTPException(status_code=500, detail=str(e))
     # Fallback in-memory
-    items = [it for it in STORE.values() if it.get("user_id") == user_id]
-    items.sort(key=lambda x: x.get("created_at", ""), reverse=True)
+    if DEV_MODE:
+        print("[AutoQCM][DEBUG] Saving QCM to in-memory STORE (Supabase client unavailable)")
+    STORE.put(record_id, req.user_id, req.qcm.name, _qcm_to_json_bytes(req), req.score, now)
+    _remember_saved_questions(req.user_id, req.qcm)
+    return record_id
+
+
+@app.post("/save_qcm")
+async def save_qcm(req: SaveRequest, user_id: str = Depends(_verify_and_get_user_id)):
+    if user_id != req.user_id and not DEV_MODE:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    return {"id": await _persist_qcm(req)}
+
+
+@app.post("/save_qcm/batch")
+async def save_qcm_batch(req: SaveBatchRequest, user_id: str = Depends(_verify_and_get_user_id)):
+    """Sauvegarde plusieurs QCM en une seule insertion ; résultat par élément (created / forbidden)."""
+    supa = _storage()
+    start = datetime.utcnow()
+    results: List[Dict[str, Any]] = []
+    accepted: List[Tuple[str, SaveRequest, str]] = []
+    for i, item in enumerate(req.items):
+        if item.user_id != user_id and not DEV_MODE:
+            results.append({"index": i, "status": "forbidden"})
+            continue
+        record_id = str(uuid.uuid4())
+        # Horodatages croissants : l'ordre du lot est conservé dans l'historique
+        accepted.append((record_id, item, (start + timedelta(microseconds=i)).isoformat()))
+        results.append({"index": i, "id": record_id, "status": "created"})
+
+    if accepted:
+        if supa:
+            rows: List[QcmTestRow] = [
+                {"id": rid, "user_id": it.user_id, "name": it.qcm.name, "qcm": _saved_qcm_document(it), "score": it.score, "created_at": created_at}
+                for rid, it, created_at in accepted
+            ]
+            try:
+                await _insert_qcm_tests(supa, rows)
+            except Exception as e:
+                if DEV_MODE:
+                    print("[AutoQCM][DEBUG] Exception while batch saving:", repr(e))
+                raise HTTPException(status_code=500, detail=str(e))
+        else:
+            for rid, it, created_at in accepted:
+                STORE.put(rid, it.user_id, it.qcm.name, _qcm_to_json_bytes(it), it.score, created_at)
+        for _, it, _ in accepted:
+            _remember_saved_questions(it.user_id, it.qcm)
+    return {"created": len(accepted), "results": results}
+
+
+@app.post("/qcm/batch_delete")
+async def delete_qcm_batch(req: DeleteBatchRequest, current_user_id: str = Depends(_verify_and_get_user_id)):
+    """Supprime en une requête les QCM de l'utilisateur donnés par ids et/ou par plage de dates.
+
+    Seuls les QCM appartenant à l'utilisateur sont supprimés : un id d'un autre utilisateur est
+    rapporté not_found, comme un id inexistant.
+    """
+    if req.ids is None and req.since is None and req.until is None:
+        raise HTTPException(status_code=400, detail="ids, since ou until requis")
+    owner = req.user_id or current_user_id
+    if owner != current_user_id and not DEV_MODE:
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+    supa = _storage()
+    aware = bool(supa) and supa.aware_timestamps
+    since, until = _history_bound(req.since, aware), _history_bound(req.until, aware)
+    if supa:
+        try:
+            deleted = await _delete_qcm_tests(supa, owner, req.ids, since, until)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        deleted = STORE.delete_where(owner, req.ids, since, until)
+    for qid in deleted:
+        QCM_CACHE.pop(qid)
+
+    response: Dict[str, Any] = {"deleted": len(deleted)}
+    if req.ids is not None:
+        done = set(deleted)
+        response["results"] = [{"id": qid, "status": "deleted" if qid in done else "not_found"} for qid in req.ids]
+    else:
+        response["ids"] = deleted
+    return response
+
+
+@app.get("/history/{user_id}", response_model=List[HistoryItem])
+async def history(
+    user_id: str,
+    response: Response,
+    limit: Optional[int] = Query(None, ge=1),
+    cursor: Optional[str] = None,
+    since: Optional[datetime] = None,
+    until: Optional[datetime] = None,
+    _current: str = Depends(_verify_and_get_user_id),
+):
+    """Historique paginé par clé (created_at desc, id) ; le curseur de la page suivante est renvoyé dans X-Next-Cursor."""
+    if limit is None and (cursor or HISTORY_DEFAULT_LIMIT):
+        limit = HISTORY_DEFAULT_LIMIT or HISTORY_MAX_LIMIT
+    if limit is not None:
+        limit = min(limit, HISTORY_MAX_LIMIT)
+    after = _decode_cursor(cursor) if cursor else None
+    fetch = limit + 1 if limit is not None else None
+
+    supa = _storage()
+    if supa:
+        try:
+            aware = supa.aware_timestamps
+            data = await _list_qcm_tests(supa, user_id, fetch, after, _history_bound(since, aware), _history_bound(until, aware))
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+    else:
+        # Fallback in-memory
+        data = STORE.page(user_id, fetch, after, _history_bound(since, False), _history_bound(until, False))
+
+    if limit is not None and len(data) > limit:
+        data = data[:limit]
+        response.headers["X-Next-Cursor"] = _encode_cursor(data[-1]["created_at"], data[-1]["id"])
     return [
         HistoryItem(
-            id=it["id"], user_id=it["user_id"], name=it.get("name"), score=it.get("score"), created_at=datetime.fromisoformat(it["created_at"])  # type: ignore
-        ) for it in items
+            id=it["id"], user_id=it["user_id"], name=it.get("name"), score=it.get("score"), created_at=datetime.fromisoformat(it["created_at"].replace("Z", "+00:00"))
+        ) for it in data
     ]
 
 
 @app.get("/usage_stats")
 async def usage_stats(current_user_id: str = Depends(_verify_and_get_user_id)):
-    supa = _supabase_client()
+    supa = _storage()
+    telemetry = TELEMETRY.user_stats(current_user_id)
     if not supa:
-        return {"role": "dev", "limit": None, "total": 0, "per_model": []}
+        return {"role": "dev", "limit": None, "total": 0, "per_model": [],
+                "telemetry": {**telemetry, "profile": TELEMETRY.profile(), "coalescing": COALESCER.stats(),
+                              "admission": ADMISSION.stats(), "jobs": JOBS.stats(), "warmer": WARMER.stats()}}
     try:
-        role = _get_user_role(supa, current_user_id)
+        role = await _cached_user_role(supa, current_user_id)
         limit = ROLE_LIMITS.get(role, ROLE_LIMITS.get(DEFAULT_ROLE))
-        per_model, total = _get_usage(supa, current_user_id)
-        return {"role": role, "limit": limit, "total": total, "per_model": per_model}
+        counts, total = await _cached_usage(supa, current_user_id)
+        per_model = [{"model": m, "count": n} for m, n in counts.items()]
+        if role == "admin":
+            # Profil global latence / tokens par (modèle, difficulté, nombre de questions), coalescence, admission, tâches et réserve
+            telemetry["profile"] = TELEMETRY.profile()
+            telemetry["coalescing"] = COALESCER.stats()
+            telemetry["admission"] = ADMISSION.stats()
+            telemetry["jobs"] = JOBS.stats()
+            telemetry["warmer"] = WARMER.stats()
+        return {"role": role, "limit": limit, "total": total, "per_model": per_model, "telemetry": telemetry}
     except Exception as e:
         if DEV_MODE:
             print("[AutoQCM][DEBUG] Failed to retrieve usage stats:", repr(e))
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@app.get("/qcm/{qid}")
-async def get_qcm(qid: str, _current: str = Depends(_verify_and_get_user_id)):
-    supa = _supabase_client()
+@app.post("/admin/cache/invalidate")
+async def invalidate_cache(user_id: Optional[str] = None, current_user_id: str = Depends(_verify_and_get_user_id)):
+    """Invalide le rôle / l'usage en cache (d'un utilisateur, ou de tous), après une modification de user_roles."""
+    supa = _storage()
+    if supa:
+        role = await _get_user_role(supa, current_user_id)
+        if role != "admin":
+            raise HTTPException(status_code=403, detail="Forbidden")
+    elif not DEV_MODE:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    _invalidate_user_cache(user_id)
+    return {"status": "ok"}
+
+
+@app.get("/question_bank/stats")
+async def question_bank_stats(_current: str = Depends(_verify_and_get_user_id)):
+    bank = _question_bank()
+    if bank is None:
+        return {"enabled": False}
+    return {"enabled": True, **await run_in_threadpool(bank.stats)}
+
+
+async def _load_qcm(qid: str) -> CachedQcm:
+    cached = QCM_CACHE.get(qid)
+    if cached is not None:
+        return cached
+    supa = _storage()
     if supa:
         try:
-            res = supa.table("qcm_tests").select("*").eq("id", qid).limit(1).execute()
-            rows = res.data or []  # type: ignore
-            if not rows:
-                raise HTTPException(status_code=404, detail="Not found")
-            row = rows[0]
-            return {
-                "id": row["id"],
-                "user_id": row["user_id"],
-                "name": row.get("name"),
-                "qcm": row.get("qcm"),
-                "score": row.get("score"),
-                "created_at": row.get("created_at"),
-            }
-        except HTTPException:
-            raise
+            row = await _get_qcm_test(supa, qid)
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
-    # Fallback
-    if qid not in STORE:
-        raise HTTPException(status_code=404, detail="Not found")
-    return STORE[qid]
+        if row is None:
+            raise HTTPException(status_code=404, detail="Not found")
+        record = {
+            "id": row["id"],
+            "user_id": row["user_id"],
+            "name": row.get("name"),
+            "qcm": row.get("qcm"),
+            "score": row.get("score"),
+            "created_at": row.get("created_at"),
+        }
+    else:
+        # Fallback
+        record = STORE.get(qid)
+        if record is None:
+            raise HTTPException(status_code=404, detail="Not found")
+    entry = _cached_qcm_entry(record)
+    QCM_CACHE.set(qid, entry)
+    return entry
+
+
+@app.get("/qcm/{qid}")
+async def get_qcm(
+    qid: str,
+    fields: Optional[str] = Query(None, description="Projection, ex. name,score,qcm.items.question"),
+    if_none_match: Optional[str] = Header(None),
+    if_modified_since: Optional[str] = Header(None),
+    _current: str = Depends(_verify_and_get_user_id),
+):
+    entry = await _load_qcm(qid)
+    tree = _parse_fields(fields) if fields else None
+    etag = entry["etag"]
+    if tree is not None:
+        # Une représentation (donc un ETag) par projection
+        spec = json.dumps(tree, sort_keys=True, separators=(",", ":")).encode("utf-8")
+        etag = '%s-%s"' % (etag[:-1], hashlib.sha256(spec).hexdigest()[:8])
+    # ETag faible : le même corps est servi en gzip, brotli ou identité par CompressionMiddleware
+    headers = {"ETag": "W/" + etag, "Cache-Control": "private, no-cache"}
+    if entry["last_modified"]:
+        headers["Last-Modified"] = entry["last_modified"]
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, etag)
+    else:
+        not_modified = if_modified_since is not None and _not_modified_since(if_modified_since, entry["last_modified"])
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    if tree is None:
+        body = entry["body"]
+    else:
+        body = _json_dumps(_project(entry["record"], tree))
+    return Response(content=body, media_type="application/json", headers=headers)
 
 
 @app.delete("/qcm/{qid}")
 async def delete_qcm(qid: str, _current: str = Depends(_verify_and_get_user_id)):
-    supa = _supabase_client()
+    QCM_CACHE.pop(qid)
+    supa = _storage()
     if supa:
         try:
-            supa.table("qcm_tests").delete().eq("id", qid).execute()
+            await _delete_qcm_test(supa, qid)
             return {"status": "ok"}
         except Exception as e:
             raise HTTPException(status_code=500, detail=str(e))
     # Fallback
-    STORE.pop(qid, None)
+    STORE.remove(qid)
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+async def metrics(authorization: Optional[str] = Header(default=None)):
+    """Métriques au format texte Prometheus (compteurs, histogrammes de latence par route et par étape, jauges)."""
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Not found")
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=401, detail="Invalid token")
+    return Response(content=_render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 @app.get("/")
 async def root():
     return {"status": "ok", "name": "Auto QCM API", "version": "0.1.0"}
@@ -0,0 +1,73 @@
+import sys
+import time
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+# Délai maximal d'attente d'une synchronisation : atteint seulement si les appels sont sérialisés
+SYNC_TIMEOUT = 5.0
+
+
+class SlowLlm:
+    """Remplace _generate_via_langchain : lent, compte ses appels, peut échouer ; bloqué tant que `release` (si défini) n'est pas levé."""
+
+    delay = 0.3
+
+    def __init__(self):
+        self.calls = 0
+        self.fail = False
+        self.release = None
+        self.charged = []
+        self.lock = threading.Lock()
+
+    def __call__(self, skills, count, name, difficulty, **kwargs):
+        with self.lock:
+            self.calls += 1
+        if self.release is not None and not self.release.wait(SYNC_TIMEOUT):
+            raise RuntimeError("LLM jamais libéré")
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("provider down")
+        return main._generate_fallback(skills, count, name, difficulty)
+
+
+@pytest.fixture(autouse=True)
+def _reset_quota_caches():
+    """Les rôles / usages en cache ne doivent pas fuir d'un test à l'autre (Supabase est mocké par test)."""
+    main._invalidate_user_cache()
+    yield
+    main._invalidate_user_cache()
+
+
+@pytest.fixture
+def offline_app(monkeypatch):
+    """Application en mode dev sans Supabase ni Gemini : dédoublonnage et coalescence coupés, exécuteur LLM propre au test.
+
+    Le test (ou sa fixture) pose ensuite son LLM factice et réactive ce qu'il vérifie."""
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "ChatGoogleGenerativeAI", object, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "COALESCE_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "LLM_EXECUTOR", ThreadPoolExecutor(max_workers=8), raising=False)
+
+
+@pytest.fixture
+def slow_llm(monkeypatch, offline_app):
+    """SlowLlm branché sur offline_app ; l'usage compté par génération est relevé dans `charged` au lieu d'être écrit."""
+    fake = SlowLlm()
+
+    async def record_usage(supa, user_id, model_name):
+        fake.charged.append(user_id)
+
+    monkeypatch.setattr(main, "_generate_via_langchain", fake, raising=False)
+    monkeypatch.setattr(main, "_record_generation_usage", record_usage, raising=False)
+    return fake
@@ -0,0 +1,135 @@
+import sys
+import asyncio
+import pathlib
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+LLM_DELAY = 0.4
+
+
+@pytest.fixture
+def admission(monkeypatch, slow_llm):
+    slow_llm.delay = LLM_DELAY
+    monkeypatch.setattr(main, "ADMISSION_ENABLED", True, raising=False)
+
+    def use(controller):
+        monkeypatch.setattr(main, "ADMISSION", controller, raising=False)
+        return controller
+    return use
+
+
+def _burst(n):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            payloads = [{"skills": ["python"], "count": 2, "name": f"Admission {i}"} for i in range(n)]
+            return await asyncio.gather(*[ac.post("/generate_qcm", json=p) for p in payloads])
+    return asyncio.run(scenario())
+
+
+def test_queue_served_by_role_priority_and_per_user_cap():
+    """B-ADM-001: places libérées accordées admin > user_plus > user (ROLE_LIMITS), en sautant l'utilisateur à son plafond."""
+
+    assert main._role_priority("admin") < main._role_priority("user_plus") < main._role_priority("user")
+    adm = main.AdmissionController(max_concurrency=2, max_per_user=1, queue_max=10, queue_timeout=5)
+    order = []
+
+    async def request(user_id, role):
+        await adm.acquire(user_id, role)
+        order.append(user_id)
+
+    async def settle():
+        for _ in range(10):
+            await asyncio.sleep(0)
+
+    async def scenario():
+        await adm.acquire("busy", "user")
+        await adm.acquire("other", "user")
+        assert adm.running == 2
+        tasks = []
+        for user_id, role in [("u1", "user"), ("busy", "admin"), ("plus", "user_plus"), ("boss", "admin")]:
+            tasks.append(asyncio.ensure_future(request(user_id, role)))
+            await asyncio.sleep(0)
+        assert adm.stats()["queue_depth"] == 4
+        adm.release("other", 0.1)
+        await settle()
+        # "busy" (admin) est en tête mais déjà à son plafond : "boss" passe
+        assert order == ["boss"]
+        adm.release("boss", 0.1)
+        await settle()
+        assert order == ["boss", "plus"]
+        adm.release("busy", 0.1)
+        await settle()
+        assert order == ["boss", "plus", "busy"]
+        adm.release("plus", 0.1)
+        await asyncio.gather(*tasks)
+        assert order == ["boss", "plus", "busy", "u1"]
+
+    asyncio.run(scenario())
+    assert adm.running == 2 and adm.stats()["queue_depth"] == 0
+
+
+def test_full_queue_fast_rejects_with_retry_after(admission):
+    """B-ADM-002: file pleine = 429 immédiat avec Retry-After ; la demande en file est servie après la première."""
+
+    adm = admission(main.AdmissionController(max_concurrency=1, max_per_user=0, queue_max=1, queue_timeout=30))
+    responses = _burst(3)
+
+    codes = sorted(r.status_code for r in responses)
+    assert codes == [200, 200, 429]
+    rejected = next(r for r in responses if r.status_code == 429)
+    assert int(rejected.headers["Retry-After"]) >= 1
+    stats = adm.stats()
+    assert (stats["admitted"], stats["rejected"], stats["running"], stats["queue_depth"]) == (2, 1, 0, 0)
+    assert stats["wait_ms_max"] >= LLM_DELAY * 1000 * 0.8
+
+
+def test_queue_deadline_returns_503_and_stats_exposed(admission):
+    """B-ADM-003: attente au-delà de ADMISSION_QUEUE_TIMEOUT = 503 + Retry-After ; /usage_stats expose la file."""
+
+    adm = admission(main.AdmissionController(max_concurrency=1, max_per_user=0, queue_max=4, queue_timeout=0.1))
+    responses = _burst(2)
+
+    assert sorted(r.status_code for r in responses) == [200, 503]
+    late = next(r for r in responses if r.status_code == 503)
+    assert "Retry-After" in late.headers
+
+    async def stats():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return (await ac.get("/usage_stats")).json()
+    admission = asyncio.run(stats())["telemetry"]["admission"]
+    assert admission["timed_out"] == 1 and admission["queue_depth"] == 0 and admission["running"] == 0
+    assert admission["max_concurrency"] == 1
+    assert adm.stats()["timed_out"] == admission["timed_out"]
+
+
+def test_cancelled_waiter_leaves_queue():
+    """B-ADM-004: une demande abandonnée en file (client déconnecté) libère sa position sans fuite de place."""
+
+    adm = main.AdmissionController(max_concurrency=1, max_per_user=0, queue_max=1, queue_timeout=5)
+
+    async def scenario():
+        await adm.acquire("a", "user")
+        waiter = asyncio.ensure_future(adm.acquire("b", "user"))
+        await asyncio.sleep(0)
+        with pytest.raises(HTTPException) as exc:
+            await adm.acquire("c", "user")
+        assert exc.value.status_code == 429
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert adm.stats()["queue_depth"] == 0
+        adm.release("a", 0.2)
+        await adm.acquire("c", "user")
+
+    asyncio.run(scenario())
+    assert adm.running == 1 and adm._per_user == {"c": 1}
@@ -0,0 +1,138 @@
+import sys
+import json
+import pathlib
+import asyncio
+import threading
+
+import httpx
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+# Délai maximal d'attente d'une synchronisation : atteint seulement si les appels sont sérialisés
+SYNC_TIMEOUT = 5.0
+
+
+def _setup_fake_llm(monkeypatch, fake_llm):
+    monkeypatch.setattr(main, "_generate_via_langchain", fake_llm, raising=False)
+    # Toutes les requêtes viennent du même utilisateur DEV : pas de plafond d'admission par utilisateur ici
+    monkeypatch.setattr(main, "ADMISSION", main.AdmissionController(8, 0, 64, 30), raising=False)
+
+
+def _run(coro):
+    return asyncio.run(coro)
+
+
+def test_parallel_generate_qcm_not_serialized(monkeypatch, offline_app):
+    """B-PERF-001: N appels /generate_qcm parallèles sont en cours en même temps (chaque faux LLM attend les N-1 autres)."""
+
+    n = 5
+    barrier = threading.Barrier(n, timeout=SYNC_TIMEOUT)
+    met = []
+
+    def blocking_llm(skills, count, name, difficulty, **kwargs):
+        """Appel bloquant qui ne se termine normalement que si les N appels sont simultanés."""
+        try:
+            barrier.wait()
+            met.append(True)
+        except threading.BrokenBarrierError:
+            met.append(False)
+        return main._generate_fallback(skills, count, name, difficulty)
+
+    _setup_fake_llm(monkeypatch, blocking_llm)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            payloads = [{"skills": ["python"], "count": 3, "name": f"Concurrence {i}"} for i in range(n)]
+            return await asyncio.gather(*[ac.post("/generate_qcm", json=p) for p in payloads])
+
+    responses = _run(scenario())
+
+    assert all(r.status_code == 200 for r in responses)
+    assert all(len(r.json()["items"]) == 3 for r in responses)
+    # Sérialisés, le premier appel aurait attendu seul à la barrière jusqu'à l'expiration
+    assert met == [True] * n
+
+
+def test_health_check_responsive_during_generation(monkeypatch, offline_app):
+    """B-PERF-002: GET / répond pendant qu'une génération bloquante est en cours (le LLM n'est libéré qu'après)."""
+
+    started = threading.Event()
+    release = threading.Event()
+    released = []
+
+    def blocking_llm(skills, count, name, difficulty, **kwargs):
+        started.set()
+        released.append(release.wait(SYNC_TIMEOUT))
+        return main._generate_fallback(skills, count, name, difficulty)
+
+    _setup_fake_llm(monkeypatch, blocking_llm)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            gen_task = asyncio.create_task(ac.post("/generate_qcm", json={"skills": ["sql"], "count": 2}))
+            while not started.is_set():
+                await asyncio.sleep(0.01)
+            root = await ac.get("/")
+            # La génération est toujours bloquée dans le LLM quand GET / a répondu
+            still_running = not gen_task.done()
+            release.set()
+            gen = await gen_task
+            return root, still_running, gen
+
+    root, still_running, gen = _run(scenario())
+
+    assert root.status_code == 200
+    assert gen.status_code == 200
+    assert still_running and released == [True]
+
+
+def test_llm_calls_capped_across_requests(monkeypatch, offline_app):
+    """B-PERF-003: LLM_MAX_CONCURRENT_CALLS borne les appels Gemini de toutes les requêtes, lots en parallèle compris."""
+
+    release = threading.Event()
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    class GatedLlm:
+        def invoke(self, prompt, **kwargs):
+            with lock:
+                running.append(prompt)
+                peak.append(len(running))
+            release.wait(SYNC_TIMEOUT)
+            with lock:
+                running.remove(prompt)
+            n = int(prompt.split("Nombre de questions: ")[1].split(".")[0])
+            items = [{"id": str(i), "question": f"Q{i} {prompt[-30:]}?", "choices": ["A", "B", "C", "D"], "answer_index": 0}
+                     for i in range(n)]
+            return json.dumps({"items": items})
+
+    _setup_fake_llm(monkeypatch, main._generate_via_langchain)
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: GatedLlm(), raising=False)
+    monkeypatch.setattr(main, "LLM_CALLS", main.LlmCallLimiter(2), raising=False)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            fanout = ac.post("/generate_qcm", json={"skills": ["a", "b", "c"], "count": 3, "split": "skill"})
+            single = ac.post("/generate_qcm", json={"skills": ["sql"], "count": 2})
+            tasks = [asyncio.create_task(fanout), asyncio.create_task(single)]
+            # Quatre appels demandés : deux en cours, deux en attente d'une place
+            deadline = asyncio.get_running_loop().time() + SYNC_TIMEOUT
+            while (main.LLM_CALLS.inflight(), main.LLM_CALLS.waiting()) != (2, 2):
+                assert asyncio.get_running_loop().time() < deadline
+                await asyncio.sleep(0.01)
+            release.set()
+            return await asyncio.gather(*tasks)
+
+    responses = _run(scenario())
+
+    assert [r.status_code for r in responses] == [200, 200]
+    assert len(peak) == 4 and max(peak) == 2
+    assert main.LLM_CALLS.inflight() == 0 and main.LLM_CALLS.waiting() == 0
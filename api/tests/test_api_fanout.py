@@ -0,0 +1,89 @@
+import sys
+import pathlib
+import threading
+import uuid
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+SYNC_TIMEOUT = 5.0
+
+
+def _fake_batch(skills, count, name, difficulty):
+    """LLM factice : ids '1'..'n' (donc en collision entre lots) et questions tracées par compétence et par lot."""
+    label = "+".join(skills) or "none"
+    batch = uuid.uuid4().hex[:8]
+    return main.GenerateResponse(name="Nom LLM", items=[
+        main.QcmItem(id=str(i + 1), question=f"{label} #{i + 1} {batch}", choices=["A", "B", "C", "D"], answer_index=0, skill=label)
+        for i in range(count)
+    ])
+
+
+@pytest.fixture
+def client(monkeypatch, offline_app):
+    monkeypatch.setattr(main, "FANOUT_MAX_CONCURRENCY", 8, raising=False)
+    return TestClient(main.app)
+
+
+def test_plan_batches_per_skill_and_chunk():
+    """B-FANOUT-001: _plan_batches() répartit par compétence ou par lots fixes, dans l'ordre."""
+
+    assert main._plan_batches(["a", "b", "c"], 7, "skill", 10) == [(["a"], 3), (["b"], 2), (["c"], 2)]
+    assert main._plan_batches(["a", "b"], 9, "skill", 3) == [(["a"], 3), (["a"], 2), (["b"], 3), (["b"], 1)]
+    assert [n for _, n in main._plan_batches(["a"], 25, "chunk", 10)] == [10, 10, 5]
+
+
+def test_fanout_generate_parallel_merge(monkeypatch, client: TestClient):
+    """B-FANOUT-002: split=chunk génère les lots en parallèle et fusionne dans l'ordre avec des ids uniques."""
+
+    # 4 lots de 10 : chaque appel LLM attend les 3 autres, ce qui n'aboutit que s'ils sont en vol ensemble
+    barrier = threading.Barrier(4, timeout=SYNC_TIMEOUT)
+
+    def parallel_batch(skills, count, name, difficulty):
+        barrier.wait()
+        return _fake_batch(skills, count, name, difficulty)
+
+    monkeypatch.setattr(main, "_generate_via_langchain", parallel_batch, raising=False)
+
+    resp = client.post("/generate_qcm", json={"skills": ["python", "sql"], "count": 40, "split": "skill", "chunk_size": 10, "name": "Gros QCM"})
+
+    assert resp.status_code == 200
+    data = resp.json()
+    assert data["name"] == "Gros QCM"
+    assert len(data["items"]) == 40
+    assert len({it["id"] for it in data["items"]}) == 40
+    assert [it["skill"] for it in data["items"]] == ["python"] * 20 + ["sql"] * 20
+    assert data["items"][0]["question"].startswith("python #1 ")
+    assert not barrier.broken
+
+
+def test_fanout_retries_failed_batch_only(monkeypatch, client: TestClient):
+    """B-FANOUT-003: un lot en échec est relancé seul, les autres ne sont pas régénérés."""
+
+    calls = []
+    lock = threading.Lock()
+    failed_once = {"sql": False}
+
+    def flaky(skills, count, name, difficulty):
+        with lock:
+            calls.append(tuple(skills))
+            if skills == ["sql"] and not failed_once["sql"]:
+                failed_once["sql"] = True
+                raise ValueError("JSON invalide")
+        return _fake_batch(skills, count, name, difficulty)
+
+    monkeypatch.setattr(main, "_generate_via_langchain", flaky, raising=False)
+    monkeypatch.setattr(main, "FANOUT_RETRIES", 1, raising=False)
+
+    resp = client.post("/generate_qcm", json={"skills": ["python", "sql"], "count": 6, "split": "skill"})
+
+    assert resp.status_code == 200
+    assert len(resp.json()["items"]) == 6
+    assert calls.count(("python",)) == 1
+    assert calls.count(("sql",)) == 2
@@ -35,11 +35,11 @@ def test_generate_qcm_quota_forbidden_role(monkeypatch, client: TestClient):
     monkeypatch.setattr(main, "_supabase_client", lambda: dummy_supa, raising=False)
 
     # Rôle 'forbidden' avec limite 0
-    def fake_get_user_role(supa, user_id):  # type: ignore[unused-argument]
+    async def fake_get_user_role(supa, user_id):  # type: ignore[unused-argument]
         return "forbidden"
 
     # Usage total déjà à la limite (0)
-    def fake_get_usage(supa, user_id):  # type: ignore[unused-argument]
+    async def fake_get_usage(supa, user_id):  # type: ignore[unused-argument]
         return [], 0
 
     monkeypatch.setattr(main, "_get_user_role", fake_get_user_role, raising=False)
@@ -64,7 +64,7 @@ def test_generate_qcm_unknown_role_forbidden(monkeypatch, client: TestClient):
     monkeypatch.setattr(main, "_supabase_client", lambda: dummy_supa, raising=False)
 
     # Rôle inconnu non présent dans ROLE_LIMITS
-    def fake_get_user_role(supa, user_id):  # type: ignore[unused-argument]
+    async def fake_get_user_role(supa, user_id):  # type: ignore[unused-argument]
         return "unknown_role"
 
     monkeypatch.setattr(main, "_get_user_role", fake_get_user_role, raising=False)
@@ -0,0 +1,173 @@
+import sys
+import json
+import time
+import pathlib
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+SYNC_TIMEOUT = 5.0
+
+
+def _item_json(i: int) -> str:
+    return json.dumps({
+        "id": f"q{i}",
+        "question": f"Question {i} ? {{piège}} [crochets]",
+        "choices": ["A", "B", "C", "D"],
+        "answer_index": i % 4,
+        "skill": "python",
+    }, ensure_ascii=False)
+
+
+def _fake_chunks(n: int):
+    """Découpe une réponse markdown {"name", "items"} en petits fragments arbitraires."""
+    text = "```json\n{\"name\": \"Stream\", \"items\": [" + ", ".join(_item_json(i) for i in range(n)) + "]}\n```"
+    return [text[i:i + 7] for i in range(0, len(text), 7)]
+
+
+@pytest.fixture
+def client(offline_app):
+    return TestClient(main.app)
+
+
+def test_stream_parser_emits_items_incrementally():
+    """B-STREAM-001: QcmStreamParser renvoie chaque item dès la fermeture de son objet JSON."""
+
+    parser = main.QcmStreamParser()
+    seen = []
+    for chunk in _fake_chunks(3):
+        seen.extend(parser.feed(chunk))
+        if len(seen) == 1:
+            # Le premier item est disponible avant la fin du texte
+            assert not parser.text.rstrip().endswith("```")
+
+    assert [it["id"] for it in seen] == ["q0", "q1", "q2"]
+    assert seen[0]["question"].endswith("{piège} [crochets]")
+
+
+def test_stream_endpoint_ndjson_and_usage(monkeypatch, client: TestClient):
+    """B-STREAM-002: /generate_qcm/stream émet un événement par item puis 'done', et compte l'usage une fois."""
+
+    monkeypatch.setattr(main, "_stream_via_langchain", lambda skills, count, difficulty: iter(_fake_chunks(5)), raising=False)
+
+    class DummySupa:
+        pass
+
+    usage_calls = []
+
+    async def fake_quota(supa, user_id):
+        return "user", 10, 0
+
+    async def fake_increment(supa, user_id, model):
+        usage_calls.append((user_id, model))
+
+    monkeypatch.setattr(main, "_supabase_client", lambda: DummySupa(), raising=False)
+    monkeypatch.setattr(main, "_compute_quota", fake_quota, raising=False)
+    monkeypatch.setattr(main, "_increment_usage", fake_increment, raising=False)
+
+    resp = client.post("/generate_qcm/stream", json={"skills": ["python"], "count": 4, "name": "Req"})
+    assert resp.status_code == 200
+    assert resp.headers["content-type"].startswith("application/x-ndjson")
+
+    events = [json.loads(line) for line in resp.text.splitlines() if line.strip()]
+    items = [e for e in events if e["type"] == "item"]
+    assert [e["item"]["id"] for e in items] == ["q0", "q1", "q2", "q3"]
+    assert events[-1] == {"type": "done", "name": "Stream", "count": 4, "model": main.GEMINI_MODEL}
+    assert usage_calls == [(main.DEV_USER_ID, main.GEMINI_MODEL)]
+
+
+def test_stream_time_to_first_item(monkeypatch):
+    """B-STREAM-003: le premier item est émis alors que le flux LLM est encore suspendu avant le reste de la génération."""
+
+    chunks = _fake_chunks(10)
+    parser = main.QcmStreamParser()
+    first_chunk = next(i for i, c in enumerate(chunks) if parser.feed(c))
+    release = threading.Event()
+    order = []
+
+    def held_stream(skills, count, difficulty):
+        yield from chunks[:first_chunk + 1]
+        # la suite n'est produite qu'après réception du premier item par le consommateur
+        if not release.wait(SYNC_TIMEOUT):
+            raise RuntimeError("premier item jamais reçu")
+        order.append("rest")
+        yield from chunks[first_chunk + 1:]
+
+    monkeypatch.setattr(main, "_stream_via_langchain", held_stream, raising=False)
+    monkeypatch.setattr(main, "LLM_EXECUTOR", ThreadPoolExecutor(max_workers=2), raising=False)
+
+    async def scenario():
+        items = 0
+        async for event in main._stream_qcm_events(None, "u1", ["python"], 10, None, "entretien"):
+            if event["type"] == "item":
+                items += 1
+                if items == 1:
+                    order.append("first_item")
+                    release.set()
+        return items
+
+    assert asyncio.run(scenario()) == 10
+    assert order == ["first_item", "rest"]
+
+
+def test_stream_provider_error_returns_503(monkeypatch, client: TestClient):
+    """B-STREAM-004: si le flux LLM échoue avant le premier item, l'endpoint répond 503 sans compter l'usage."""
+
+    def broken_stream(skills, count, difficulty):
+        raise RuntimeError("boom")
+        yield  # pragma: no cover
+
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "_stream_via_langchain", broken_stream, raising=False)
+
+    resp = client.post("/generate_qcm/stream", json={"skills": ["python"], "count": 2})
+    assert resp.status_code == 503
+    assert "indisponible" in resp.json()["detail"].lower()
+
+
+def test_stream_abandoned_stops_upstream_and_counts_usage(monkeypatch):
+    """B-STREAM-005: si le consommateur s'arrête après un item, le flux Gemini est fermé, le worker rendu et l'usage compté."""
+
+    closed = threading.Event()
+    charged = []
+
+    def endless_stream(skills, count, difficulty):
+        try:
+            for c in _fake_chunks(3):
+                yield c
+            while True:  # le modèle « continue » : seule la fermeture par le consommateur l'arrête
+                time.sleep(0.001)
+                yield " "
+        finally:
+            closed.set()
+
+    async def record_usage(supa, user_id, model_name):
+        charged.append(user_id)
+
+    monkeypatch.setattr(main, "_stream_via_langchain", endless_stream, raising=False)
+    monkeypatch.setattr(main, "_record_generation_usage", record_usage, raising=False)
+    monkeypatch.setattr(main, "LLM_EXECUTOR", ThreadPoolExecutor(max_workers=1), raising=False)
+
+    async def scenario():
+        events = main._stream_qcm_events(None, "u1", ["python"], 10, None, "entretien")
+        async for event in events:
+            if event["type"] == "item":
+                break
+        await events.aclose()
+        stopped = await asyncio.get_running_loop().run_in_executor(None, closed.wait, 5)
+        await asyncio.gather(*main._DETACHED_TASKS)
+        return stopped
+
+    assert asyncio.run(scenario())
+    # L'unique worker est libre : un nouvel appel passe aussitôt
+    assert main.LLM_EXECUTOR.submit(lambda: "free").result(timeout=5) == "free"
+    assert charged == ["u1"]
@@ -0,0 +1,112 @@
+import sys
+import uuid
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+QCM = {"name": "QCM lot", "items": [{"id": "1", "question": "Q?", "choices": ["A", "B", "C", "D"], "answer_index": 0}]}
+
+
+@pytest.fixture
+def as_user(monkeypatch):
+    """Authentifie les requêtes sous l'utilisateur donné, hors DEV_MODE (contrôle de propriété actif)."""
+
+    monkeypatch.setattr(main, "DEV_MODE", False, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+
+    def login(user_id):
+        async def current_user(authorization=None):
+            return user_id
+        main.app.dependency_overrides[main._verify_and_get_user_id] = current_user
+        return TestClient(main.app)
+
+    yield login
+    main.app.dependency_overrides.pop(main._verify_and_get_user_id, None)
+
+
+def test_save_batch_memory_per_item_results(monkeypatch, as_user):
+    """B-BATCH-001: /save_qcm/batch sauvegarde les éléments de l'utilisateur, refuse les autres, et garde l'ordre du lot."""
+
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "STORE", main.MemoryQcmStore(), raising=False)
+    client = as_user("owner")
+
+    items = [{"user_id": "owner", "qcm": {**QCM, "name": f"QCM {i}"}, "score": i} for i in range(3)]
+    items.insert(1, {"user_id": "someone-else", "qcm": QCM})
+    resp = client.post("/save_qcm/batch", json={"items": items})
+
+    assert resp.status_code == 200
+    body = resp.json()
+    assert body["created"] == 3
+    assert [r["status"] for r in body["results"]] == ["created", "forbidden", "created", "created"]
+    names = [it["name"] for it in client.get("/history/owner").json()]
+    assert names == ["QCM 2", "QCM 1", "QCM 0"]
+    assert main.STORE.count("someone-else") == 0
+
+
+def test_batch_endpoints_single_supabase_round_trip(monkeypatch, as_user):
+    """B-BATCH-002: un lot de 100 QCM = une requête d'insertion ; la suppression par ids = un DELETE filtré sur user_id."""
+
+    calls = []
+
+    async def fake_request(self, method, path, params=None, body=None, headers=None):
+        calls.append((method, path, dict(params or []), body))
+        if method == "DELETE":
+            return [{"id": "a"}, {"id": "c"}]
+        return body
+
+    supa = main.SupabaseRest("http://supabase.invalid", "key")
+    monkeypatch.setattr(main.SupabaseRest, "request", fake_request)
+    monkeypatch.setattr(main, "_supabase_client", lambda: supa, raising=False)
+    client = as_user("owner")
+
+    resp = client.post("/save_qcm/batch", json={"items": [{"user_id": "owner", "qcm": QCM, "score": i} for i in range(100)]})
+    assert resp.status_code == 200 and resp.json()["created"] == 100
+    assert len(calls) == 1
+    method, path, _, body = calls[0]
+    assert (method, path) == ("POST", "/qcm_tests") and len(body) == 100
+
+    resp = client.post("/qcm/batch_delete", json={"ids": ["a", "b", "c"]})
+    assert len(calls) == 2
+    method, path, params, _ = calls[1]
+    assert method == "DELETE" and params["user_id"] == "eq.owner"
+    assert params["id"] == 'in.("a","b","c")' and params["select"] == "id"
+    assert resp.json() == {"deleted": 2, "results": [
+        {"id": "a", "status": "deleted"}, {"id": "b", "status": "not_found"}, {"id": "c", "status": "deleted"},
+    ]}
+
+
+def test_batch_delete_by_range_enforces_ownership(monkeypatch, tmp_path, as_user):
+    """B-BATCH-003: la suppression par plage de dates ne touche que les QCM de l'utilisateur (backend SQLite)."""
+
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "sqlite", raising=False)
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "batch.sqlite3"), raising=False)
+    monkeypatch.setattr(main, "SQLITE_STORAGE", None, raising=False)
+    storage = main._storage()
+    rows = [
+        {"id": str(uuid.uuid4()), "user_id": user, "name": None, "qcm": QCM, "score": None, "created_at": f"2025-04-{day:02d}T09:00:00"}
+        for user in ("owner", "other") for day in (1, 5, 9)
+    ]
+    storage.db.insert_qcm_tests(rows)
+    client = as_user("owner")
+
+    resp = client.post("/qcm/batch_delete", json={"since": "2025-04-02T00:00:00", "until": "2025-04-10T00:00:00"})
+    assert resp.status_code == 200
+    assert sorted(resp.json()["ids"]) == sorted(r["id"] for r in rows[1:3])
+    assert [r["id"] for r in storage.db.list_qcm_tests("owner")] == [rows[0]["id"]]
+    assert len(storage.db.list_qcm_tests("other")) == 3
+
+    # Ids d'un autre utilisateur : rapportés not_found, rien n'est supprimé
+    resp = client.post("/qcm/batch_delete", json={"ids": [rows[3]["id"]]})
+    assert resp.json()["results"] == [{"id": rows[3]["id"], "status": "not_found"}]
+    assert len(storage.db.list_qcm_tests("other")) == 3
+
+    assert client.post("/qcm/batch_delete", json={}).status_code == 400
+    assert client.post("/qcm/batch_delete", json={"user_id": "other", "since": "2025-01-01T00:00:00"}).status_code == 403
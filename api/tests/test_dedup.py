@@ -0,0 +1,140 @@
+import sys
+import json
+import random
+import asyncio
+import pathlib
+
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+def _item(i, question):
+    return main.QcmItem(id=str(i), question=question, choices=["A", "B", "C", "D"], answer_index=0, skill="python")
+
+
+def test_index_detects_paraphrase_not_unrelated():
+    """B-DEDUP-001: NearDuplicateIndex repère une paraphrase (casse, accents, mots vides) mais pas une autre question."""
+
+    index = main.NearDuplicateIndex(threshold=0.7)
+    index.add("q1", "Quelle est la complexité d'une recherche dans un dictionnaire Python ?")
+    index.add("q2", "Que fait le mot-clé yield dans une fonction Python ?")
+
+    assert index.find("quelle est la COMPLEXITE de la recherche dans un dictionnaire en python") == "q1"
+    assert index.find("Que fait le mot clé yield dans une fonction python ?") == "q2"
+    assert index.find("Comment déclarer une classe abstraite en Python ?") is None
+    assert len(index) == 2
+
+
+def test_generate_qcm_drops_duplicates_and_replaces(monkeypatch, offline_app):
+    """B-DEDUP-002: /generate_qcm écarte les quasi-doublons (réponse et QCM sauvegardés) et redemande le manque."""
+
+    user_id = "dedup-user"
+    calls = []
+
+    def fake_llm(skills, count, name, difficulty):
+        calls.append(count)
+        if len(calls) == 1:
+            return main.GenerateResponse(items=[
+                _item(1, "Que fait le mot-clé yield en Python ?"),
+                _item(2, "En Python, que fait le mot clé yield ?"),
+                _item(3, "Quelle est la complexité d'un accès à une liste Python ?"),
+                _item(4, "Comment fonctionne le GIL de CPython ?"),
+            ])
+        return main.GenerateResponse(items=[_item(10 + i, f"Question de remplacement numéro {i} sur asyncio") for i in range(count)])
+
+    monkeypatch.setattr(main, "_generate_via_langchain", fake_llm, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", True, raising=False)
+    monkeypatch.setattr(main, "DEDUP_REPLACE", True, raising=False)
+    main.DEDUP_INDEXES.pop(user_id, None)
+
+    async def fake_user(authorization=None):
+        return user_id
+
+    main.app.dependency_overrides[main._verify_and_get_user_id] = fake_user
+    try:
+        client = TestClient(main.app)
+        saved = {"name": "Ancien", "items": [{"id": "x", "question": "Comment fonctionne le GIL de CPython", "choices": ["A", "B", "C", "D"], "answer_index": 0}]}
+        assert client.post("/save_qcm", json={"user_id": user_id, "qcm": saved}).status_code == 200
+
+        resp = client.post("/generate_qcm", json={"skills": ["python"], "count": 4})
+    finally:
+        main.app.dependency_overrides.pop(main._verify_and_get_user_id, None)
+
+    assert resp.status_code == 200
+    questions = [it["question"] for it in resp.json()["items"]]
+    assert len(questions) == 4
+    assert "En Python, que fait le mot clé yield ?" not in questions
+    assert "Comment fonctionne le GIL de CPython ?" not in questions
+    assert calls == [4, 2]
+
+
+def test_index_lookup_compares_few_candidates(monkeypatch):
+    """B-DEDUP-003: sur 20k questions, la recherche ne compare que les candidats des bandes LSH (une poignée), jamais tout l'index."""
+
+    rng = random.Random(7)
+    vocab = ["".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(6)) for _ in range(5000)]
+    index = main.NearDuplicateIndex()
+    texts = [" ".join(rng.choice(vocab) for _ in range(10)) for _ in range(20000)]
+    for i, text in enumerate(texts):
+        index.add(i, text)
+
+    # Comparaisons de signatures comptées via operator.eq (num_perm appels par candidat)
+    compared = []
+
+    class CountingOperator:
+        @staticmethod
+        def eq(a, b):
+            compared.append(1)
+            return a == b
+
+    monkeypatch.setattr(main, "operator", CountingOperator, raising=False)
+    queries = [" ".join(rng.choice(vocab) for _ in range(10)) for _ in range(500)]
+    assert [index.find(q) for q in queries].count(None) == len(queries)
+    candidates = len(compared) / index.num_perm
+    assert candidates / len(queries) < 5
+
+    compared.clear()
+    assert index.find(texts[1234]) == 1234
+    assert len(compared) / index.num_perm < 5
+
+
+def test_index_load_failure_not_cached_and_history_capped(monkeypatch):
+    """B-DEDUP-004: un échec de chargement n'est pas mis en cache (nouvel essai ensuite) ; seuls les DEDUP_HISTORY_LIMIT derniers QCM sont lus."""
+
+    user_id = "dedup-retry"
+    store = main.MemoryQcmStore()
+    for i in range(5):
+        qcm = {"items": [{"question": f"Question numéro {i} sur les générateurs"}]}
+        store.put(f"t{i}", user_id, None, json.dumps(qcm).encode("utf-8"), None, f"2026-01-0{i + 1}T00:00:00")
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "STORE", store, raising=False)
+    monkeypatch.setattr(main, "DEDUP_HISTORY_LIMIT", 2, raising=False)
+    main.DEDUP_INDEXES.pop(user_id, None)
+    loads = []
+    real_load = main._load_user_questions
+
+    async def flaky_load(uid):
+        loads.append(uid)
+        if len(loads) == 1:
+            raise RuntimeError("storage down")
+        return await real_load(uid)
+
+    monkeypatch.setattr(main, "_load_user_questions", flaky_load, raising=False)
+
+    async def scenario():
+        first = await main._user_dedup_index(user_id)
+        cached_after_failure = user_id in main.DEDUP_INDEXES
+        second = await main._user_dedup_index(user_id)
+        return first, cached_after_failure, second
+
+    first, cached_after_failure, second = asyncio.run(scenario())
+
+    assert first is None and not cached_after_failure
+    assert second is not None and main.DEDUP_INDEXES[user_id] is second
+    assert len(second) == 2 and loads == [user_id, user_id]
+    assert [d["items"][0]["question"] for d in store.qcm_payloads(user_id, 2)] == \
+        ["Question numéro 4 sur les générateurs", "Question numéro 3 sur les générateurs"]
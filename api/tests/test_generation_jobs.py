@@ -0,0 +1,213 @@
+import sys
+import time
+import asyncio
+import pathlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+@pytest.fixture
+def jobs(monkeypatch, slow_llm):
+    monkeypatch.setattr(main, "STORE", main.MemoryQcmStore(), raising=False)
+    monkeypatch.setattr(main, "QUESTION_BANK_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "FANOUT_MAX_CONCURRENCY", 1, raising=False)
+    monkeypatch.setattr(main, "LLM_EXECUTOR", ThreadPoolExecutor(max_workers=4), raising=False)
+    monkeypatch.setattr(main, "ADMISSION", main.AdmissionController(8, 0, 64, 30), raising=False)
+    monkeypatch.setattr(main, "JOBS", main.GenerationJobStore(workers=2, queue_max=10, max_per_user=5, ttl=60, max_finished=100), raising=False)
+    return slow_llm
+
+
+def _client():
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://test")
+
+
+async def _poll(ac, url, until=("succeeded", "failed"), timeout=5.0):
+    seen = []
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        body = (await ac.get(url)).json()
+        seen.append((body["status"], body["completed"]))
+        if body["status"] in until:
+            return body, seen
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"job not finished: {seen[-3:]}")
+
+
+def test_job_returns_immediately_and_exposes_partial_results(jobs):
+    """B-JOB-001: POST /generate_qcm/jobs répond 202 aussitôt ; le suivi montre les lots terminés puis le QCM complet, compté une fois."""
+
+    # le LLM reste bloqué jusqu'après la réponse : un 202 prouve que le POST n'attend aucun lot
+    jobs.release = threading.Event()
+
+    async def scenario():
+        async with _client() as ac:
+            resp = await ac.post("/generate_qcm/jobs", json={"skills": ["python"], "count": 20, "chunk_size": 10, "name": "Tâche"})
+            pending = (await ac.get(resp.headers["Location"])).json()
+            jobs.release.set()
+            body, seen = await _poll(ac, resp.headers["Location"])
+            return resp, pending, body, seen
+
+    resp, pending, body, seen = asyncio.run(scenario())
+
+    assert resp.status_code == 202
+    assert pending["status"] in ("queued", "running") and pending["completed"] == 0
+    assert resp.json()["status"] == "queued" and resp.headers["Location"] == f"/generate_qcm/jobs/{resp.json()['id']}"
+    assert ("running", 10) in seen
+    assert body["status"] == "succeeded" and body["completed"] == 20 and body["requested"] == 20
+    assert len({it["id"] for it in body["items"]}) == 20
+    assert jobs.calls == 2 and jobs.charged == [main.DEV_USER_ID]
+
+
+def test_job_auto_save_and_ownership(monkeypatch, jobs):
+    """B-JOB-002: auto_save enregistre le QCM terminé comme /save_qcm ; la tâche reste invisible aux autres utilisateurs."""
+
+    monkeypatch.setattr(main, "DEV_MODE", False, raising=False)
+    current = {"user": "owner"}
+
+    async def current_user(authorization=None):
+        return current["user"]
+    main.app.dependency_overrides[main._verify_and_get_user_id] = current_user
+
+    async def scenario():
+        async with _client() as ac:
+            resp = await ac.post("/generate_qcm/jobs", json={"skills": ["sql"], "count": 3, "auto_save": True})
+            url = resp.headers["Location"]
+            current["user"] = "intruder"
+            hidden = (await ac.get(url)).status_code
+            current["user"] = "owner"
+            body, _ = await _poll(ac, url)
+            saved = (await ac.get(f"/qcm/{body['saved_id']}")).json()
+            history = (await ac.get("/history/owner")).json()
+            return hidden, body, saved, history
+
+    try:
+        hidden, body, saved, history = asyncio.run(scenario())
+    finally:
+        main.app.dependency_overrides.pop(main._verify_and_get_user_id, None)
+
+    assert hidden == 404
+    assert body["status"] == "succeeded" and body["saved_id"] and body["save_error"] is None
+    assert [it["question"] for it in saved["qcm"]["items"]] == [it["question"] for it in body["items"]]
+    assert [row["id"] for row in history] == [body["saved_id"]]
+
+
+def test_failed_job_not_charged_and_limits(jobs):
+    """B-JOB-003: une tâche en échec passe en failed sans compter de quota ; au-delà de JOBS_MAX_PER_USER tâches actives, 429 + Retry-After."""
+
+    jobs.fail = True
+
+    async def failing():
+        async with _client() as ac:
+            resp = await ac.post("/generate_qcm/jobs", json={"skills": ["go"], "count": 2})
+            body, _ = await _poll(ac, resp.headers["Location"])
+            return body
+
+    body = asyncio.run(failing())
+    assert body["status"] == "failed" and body["error"] and body["items"] == []
+    assert jobs.charged == []
+
+    jobs.fail = False
+    main.JOBS.max_per_user = 2
+
+    async def burst():
+        async with _client() as ac:
+            responses = [await ac.post("/generate_qcm/jobs", json={"skills": ["go"], "count": 1}) for _ in range(3)]
+            for r in responses[:2]:
+                await _poll(ac, r.headers["Location"])
+            return responses
+
+    responses = asyncio.run(burst())
+    assert [r.status_code for r in responses] == [202, 202, 429]
+    assert int(responses[2].headers["Retry-After"]) >= 1
+    assert len(jobs.charged) == 2
+
+
+def test_pending_jobs_reserve_quota(monkeypatch, tmp_path, jobs):
+    """B-JOB-004: les tâches en attente réservent le quota ; une tâche de plus que la limite du rôle est refusée (403)."""
+
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "sqlite", raising=False)
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "jobs.sqlite3"), raising=False)
+    monkeypatch.setattr(main, "SQLITE_STORAGE", None, raising=False)
+    storage = main._storage()
+    storage.db.set_user_role(main.DEV_USER_ID, "user")
+    storage.db.increment_usage([(main.DEV_USER_ID, main.GEMINI_MODEL, main.ROLE_LIMITS["user"] - 2)])
+
+    async def scenario():
+        async with _client() as ac:
+            codes = [(await ac.post("/generate_qcm/jobs", json={"count": 1})).status_code for _ in range(3)]
+            for _ in range(100):
+                if main.JOBS.stats()["succeeded"] == 2:
+                    break
+                await asyncio.sleep(0.05)
+            return codes
+
+    assert asyncio.run(scenario()) == [202, 202, 403]
+
+
+def test_finished_jobs_expire():
+    """B-JOB-005: les tâches terminées sont oubliées après JOBS_TTL et au-delà de JOBS_MAX_FINISHED ; les tâches actives restent."""
+
+    store = main.GenerationJobStore(workers=1, queue_max=10, max_per_user=10, ttl=60, max_finished=2)
+    req = main.GenerateJobRequest(count=1)
+    created = []
+    for i in range(4):
+        job = main.GenerationJob(id=f"j{i}", user_id="u", role="user", status="queued", request=req, created_at="",
+                                 started_at=None, finished_at=None, expires=0.0, name=None, items=[], model=None,
+                                 saved_id=None, save_error=None, error=None)
+        store._jobs[job["id"]] = job
+        created.append(job)
+    for job in created[:3]:
+        store.finish(job)
+    store._purge()
+    assert list(store._jobs) == ["j1", "j2", "j3"] and store.expired == 1
+
+    created[1]["expires"] = time.monotonic() - 1
+    assert store.get("j1") is None and store.get("j3") is not None
+    assert store.active("u") == 1
+
+
+def test_job_batches_not_coalesced(monkeypatch, jobs):
+    """B-JOB-006: avec la coalescence active, les lots simultanés d'une tâche font chacun leur appel LLM et renvoient des questions distinctes."""
+
+    batches = 4
+    barrier = threading.Barrier(batches, timeout=5.0)
+    met = []
+
+    def distinct_llm(skills, count, name, difficulty, **kwargs):
+        try:
+            barrier.wait()
+            met.append(True)
+        except threading.BrokenBarrierError:
+            met.append(False)
+        with jobs.lock:
+            jobs.calls += 1
+            call = jobs.calls
+        response = main._generate_fallback(skills, count, name, difficulty)
+        return main.GenerateResponse(name=response.name, items=[
+            it.model_copy(update={"question": f"[appel {call}] {it.question}"}) for it in response.items])
+
+    monkeypatch.setattr(main, "COALESCE_ENABLED", True, raising=False)
+    monkeypatch.setattr(main, "COALESCER", main.RequestCoalescer(10), raising=False)
+    monkeypatch.setattr(main, "FANOUT_MAX_CONCURRENCY", batches, raising=False)
+    monkeypatch.setattr(main, "_generate_via_langchain", distinct_llm, raising=False)
+
+    async def scenario():
+        async with _client() as ac:
+            resp = await ac.post("/generate_qcm/jobs", json={"skills": ["python"], "count": 10 * batches, "chunk_size": 10})
+            body, _ = await _poll(ac, resp.headers["Location"])
+            return body
+
+    body = asyncio.run(scenario())
+
+    assert body["status"] == "succeeded" and body["completed"] == 10 * batches
+    assert jobs.calls == batches and met == [True] * batches
+    assert len({it["question"] for it in body["items"]}) == 10 * batches
+    assert main.COALESCER.stats()["saved_calls"] == 0
@@ -0,0 +1,149 @@
+import sys
+import json
+import pathlib
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+class FakeMessage:
+    """Réponse LangChain minimale : texte, usage_metadata et response_metadata."""
+
+    def __init__(self, content, input_tokens=0, output_tokens=0, finish_reason="STOP"):
+        self.content = content
+        self.usage_metadata = {"input_tokens": input_tokens, "output_tokens": output_tokens}
+        self.response_metadata = {"finish_reason": finish_reason}
+
+
+class CountingLlm:
+    """Renvoie le nombre de questions demandé ; 40 tokens d'entrée et 150 tokens de sortie par question."""
+
+    def __init__(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def invoke(self, prompt, **kwargs):
+        n = int(prompt.split("Nombre de questions: ")[1].split(".")[0])
+        with self.lock:
+            self.calls.append({"prompt": prompt, **kwargs})
+        items = [{"id": str(i), "question": f"Q{i} {prompt[-20:]}?", "choices": ["A", "B", "C", "D"], "answer_index": 0} for i in range(n)]
+        return FakeMessage(json.dumps({"items": items}), input_tokens=40, output_tokens=150 * n)
+
+
+@pytest.fixture
+def llm(monkeypatch, offline_app):
+    fake = CountingLlm()
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: fake, raising=False)
+    monkeypatch.setattr(main, "TELEMETRY", main.GenerationTelemetry(100, 5), raising=False)
+    monkeypatch.setattr(main, "TOKEN_BUDGET", main.TokenBudget(200, 512, 1.5, 1024, 16384), raising=False)
+    monkeypatch.setattr(main, "LLM_ADAPTIVE_MAX_TOKENS", True, raising=False)
+    return fake
+
+
+def test_llm_usage_extraction():
+    """B-TELE-001: _llm_usage lit usage_metadata (LangChain) ou response_metadata (Gemini) et détecte la troncature."""
+
+    assert main._llm_usage(FakeMessage("x", 12, 34)) == (12, 34, False)
+    assert main._llm_usage(FakeMessage("x", 1, 2, finish_reason="MAX_TOKENS"))[2] is True
+
+    class RawGemini:
+        response_metadata = {"usage_metadata": {"prompt_token_count": 7, "candidates_token_count": 9}, "finish_reason": "FinishReason.MAX_TOKENS"}
+
+    assert main._llm_usage(RawGemini()) == (7, 9, True)
+    assert main._llm_usage("texte brut") == (0, 0, False)
+
+
+def test_token_budget_adapts():
+    """B-TELE-002: max_output_tokens suit la taille demandée, apprend des usages observés et augmente après troncature."""
+
+    budget = main.TokenBudget(per_item=200, overhead=512, margin=1.5, floor=1024, ceiling=16384)
+    assert budget.max_tokens("m", "facile", 1) == int((512 + 200) * 1.5)
+    assert main.TokenBudget(200, 0, 1.5, 1024, 16384).max_tokens("m", "facile", 1) == 1024
+    assert budget.max_tokens("m", "facile", 10) == int((512 + 2000) * 1.5)
+    assert budget.max_tokens("m", "facile", 200) == 16384
+
+    for _ in range(30):
+        budget.observe("m", "facile", items=10, output_tokens=800, truncated=False)
+    assert 80 <= budget.estimate("m", "facile") < 90
+    assert budget.estimate("m", "expert") == 200
+    before = budget.estimate("m", "facile")
+    budget.observe("m", "facile", items=3, output_tokens=5000, truncated=True)
+    assert budget.estimate("m", "facile") == pytest.approx(before * 1.25)
+
+
+def test_usage_stats_exposes_generation_telemetry(llm):
+    """B-TELE-003: /generate_qcm enregistre tokens, latence et questions par utilisateur et modèle ; /usage_stats les expose."""
+
+    client = TestClient(main.app)
+    assert client.post("/generate_qcm", json={"skills": ["sql"], "count": 4}).status_code == 200
+    assert client.post("/generate_qcm", json={"skills": ["sql"], "count": 20}).status_code == 200
+
+    small, large = llm.calls
+    assert small["generation_config"]["max_output_tokens"] == int((512 + 4 * 200) * 1.5)
+    assert large["generation_config"]["max_output_tokens"] > small["generation_config"]["max_output_tokens"]
+    assert len(small["prompt"]) < len(large["prompt"])
+
+    telemetry = client.get("/usage_stats").json()["telemetry"]
+    per_model = telemetry["per_model"][0]
+    assert per_model["model"] == main.GEMINI_MODEL
+    assert (per_model["requests"], per_model["llm_calls"], per_model["items"]) == (2, 2, 24)
+    assert per_model["input_tokens"] == 80 and per_model["output_tokens"] == 150 * 24
+    assert [r["count"] for r in telemetry["recent"]] == [4, 20]
+    assert {(p["count"], p["requests"]) for p in telemetry["profile"]} == {(4, 1), (20, 1)}
+
+
+def test_fanout_calls_traced_from_worker_threads(llm):
+    """B-TELE-004: les appels LLM des lots en parallèle (threads de LLM_EXECUTOR) sont rattachés à la requête."""
+
+    client = TestClient(main.app)
+    resp = client.post("/generate_qcm", json={"skills": ["a", "b", "c"], "count": 6, "split": "skill"})
+    assert resp.status_code == 200 and len(resp.json()["items"]) == 6
+
+    recent = client.get("/usage_stats").json()["telemetry"]["recent"]
+    assert recent[-1]["llm_calls"] == 3 and recent[-1]["output_tokens"] == 150 * 6
+
+
+def test_thinking_budget_added_to_output_cap(monkeypatch):
+    """B-TELE-005: LLM_THINKING_BUDGET est transmis au client et ajouté au max_output_tokens ; la réflexion n'entre pas dans l'estimation par question."""
+
+    built = []
+
+    class Model:
+        def __init__(self, **kwargs):
+            built.append(kwargs)
+
+    monkeypatch.setenv("GEMINI_API_KEY", "key")
+    monkeypatch.setattr(main, "ChatGoogleGenerativeAI", Model, raising=False)
+    monkeypatch.setattr(main, "LLM_THINKING_BUDGET", 0, raising=False)
+    main._reset_llm_clients()
+    main._get_llm()
+    main._reset_llm_clients()
+    assert built[0]["thinking_budget"] == 0
+
+    budget = main.TokenBudget(200, 512, 1.5, 1024, 16384, thinking=2048)
+    assert budget.max_tokens("m", "facile", 4) == int((512 + 4 * 200) * 1.5) + 2048
+    assert budget.max_tokens("m", "facile", 200) == 16384 + 2048
+
+    calls = []
+    reply = FakeMessage(json.dumps({"items": [{"id": "1", "question": "Q ?", "choices": ["A", "B", "C", "D"], "answer_index": 0}]}),
+                        input_tokens=40, output_tokens=1100)
+    reply.usage_metadata["output_token_details"] = {"reasoning": 1000}
+
+    class ThinkingLlm:
+        def invoke(self, prompt, **kwargs):
+            calls.append(kwargs)
+            return reply
+
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: ThinkingLlm(), raising=False)
+    monkeypatch.setattr(main, "TOKEN_BUDGET", budget, raising=False)
+    monkeypatch.setattr(main, "LLM_ADAPTIVE_MAX_TOKENS", True, raising=False)
+    main._generate_via_langchain(["python"], 1, None, "facile")
+    assert calls[0]["generation_config"]["max_output_tokens"] == int((512 + 200) * 1.5) + 2048
+    # 1100 tokens de sortie dont 1000 de réflexion : 100 tokens pour la question
+    assert budget.estimate(main.GEMINI_MODEL, "facile") == pytest.approx(200 + 0.2 * (100 - 200))
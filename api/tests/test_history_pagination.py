@@ -0,0 +1,125 @@
+import sys
+import uuid
+import pathlib
+from collections import OrderedDict
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+def _record(user_id, created_at, name=None):
+    """Arguments de MemoryQcmStore.put : (id, user_id, name, qcm JSON, score, created_at)."""
+    return str(uuid.uuid4()), user_id, name, b'{"items":[]}', None, created_at
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    return TestClient(main.app)
+
+
+def test_history_memory_pages_follow_cursor(client: TestClient):
+    """B-HIST-001: /history pagine le store mémoire par (created_at desc, id) et suit X-Next-Cursor jusqu'au bout."""
+
+    user_id = "hist-user-1"
+    qcm = {"name": "QCM", "items": [{"id": "1", "question": "Q?", "choices": ["A", "B", "C", "D"], "answer_index": 0}]}
+    ids = [client.post("/save_qcm", json={"user_id": user_id, "qcm": qcm}).json()["id"] for _ in range(25)]
+    client.delete(f"/qcm/{ids[3]}")
+
+    seen, cursor, pages = [], None, 0
+    while True:
+        params = {"limit": 10, **({"cursor": cursor} if cursor else {})}
+        resp = client.get(f"/history/{user_id}", params=params)
+        assert resp.status_code == 200
+        seen += [(it["created_at"], it["id"]) for it in resp.json()]
+        pages += 1
+        cursor = resp.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+
+    assert pages == 3
+    assert len(seen) == 24 and ids[3] not in {i for _, i in seen}
+    assert seen == sorted(seen, reverse=True)
+    # Sans limit : historique complet (contrat historique)
+    assert len(client.get(f"/history/{user_id}").json()) == 24
+
+
+def test_history_memory_date_range(client: TestClient):
+    """B-HIST-002: since (inclus) et until (exclu) bornent created_at, y compris avec un fuseau horaire."""
+
+    user_id = "hist-user-2"
+    for day in range(1, 11):
+        main.STORE.put(*_record(user_id, f"2025-03-{day:02d}T10:00:00"))
+
+    resp = client.get(f"/history/{user_id}", params={"since": "2025-03-03T10:00:00", "until": "2025-03-06T13:00:00+02:00", "limit": 2})
+    first = [it["created_at"][:10] for it in resp.json()]
+    assert first == ["2025-03-06", "2025-03-05"]
+    resp = client.get(f"/history/{user_id}", params={"since": "2025-03-03T10:00:00", "until": "2025-03-06T13:00:00+02:00", "limit": 2, "cursor": resp.headers["X-Next-Cursor"]})
+    assert [it["created_at"][:10] for it in resp.json()] == ["2025-03-04", "2025-03-03"]
+    assert "X-Next-Cursor" not in resp.headers
+
+    assert client.get(f"/history/{user_id}", params={"cursor": "pas-un-curseur"}).status_code == 400
+
+
+def test_history_supabase_keyset_query(monkeypatch, client: TestClient):
+    """B-HIST-003: avec Supabase, la page suivante est demandée par filtre de clé (or created_at/id) et limit+1."""
+
+    calls = []
+    rows = [
+        {"id": str(uuid.UUID(int=9 - i)), "user_id": "u", "name": None, "score": None, "created_at": f"2025-01-0{9 - i}T00:00:00+00:00"}
+        for i in range(3)
+    ]
+
+    async def fake_request(self, method, path, params=None, body=None, headers=None):
+        calls.append(dict(params))
+        return rows
+
+    supa = main.SupabaseRest("http://supabase.invalid", "key")
+    monkeypatch.setattr(main.SupabaseRest, "request", fake_request)
+    monkeypatch.setattr(main, "_supabase_client", lambda: supa, raising=False)
+
+    resp = client.get("/history/u", params={"limit": 2})
+    assert [it["id"] for it in resp.json()] == [rows[0]["id"], rows[1]["id"]]
+    assert calls[0]["limit"] == "3"
+    assert calls[0]["order"] == "created_at.desc,id.desc"
+
+    client.get("/history/u", params={"limit": 2, "cursor": resp.headers["X-Next-Cursor"]})
+    created_at, last_id = rows[1]["created_at"], rows[1]["id"]
+    assert calls[1]["or"] == f'(created_at.lt."{created_at}",and(created_at.eq."{created_at}",id.lt.{last_id}))'
+
+
+def test_store_page_reads_one_page_of_rows():
+    """B-HIST-004: une page du store mémoire ne lit que ses lignes (O(taille de page)), même au fond d'un historique de 20k QCM."""
+
+    user_id = "hist-user-big"
+    records = [_record(user_id, f"2024-01-01T00:00:{i // 1000:02d}.{i % 1000:06d}") for i in range(20000)]
+    store = main.MemoryQcmStore()
+    for record in records:
+        store.put(*record)
+
+    class CountingRecords(OrderedDict):
+        reads = 0
+
+        def __getitem__(self, key):
+            CountingRecords.reads += 1
+            return super().__getitem__(key)
+
+    store._records = CountingRecords(store._records)
+    # Seules les lignes de la page sont lues, au fond comme en tête de l'historique
+    for position in (100, 19990):
+        CountingRecords.reads = 0
+        after = (records[position][5], records[position][0])
+        page = store.page(user_id, 21, after)
+        assert [r["id"] for r in page] == [r[0] for r in reversed(records[position - 21:position])]
+        assert CountingRecords.reads == 21
+
+    for record in records:
+        store.remove(record[0])
+    assert store.count(user_id) == 0 and len(store) == 0 and store.nbytes == 0
@@ -0,0 +1,115 @@
+import sys
+import json
+import re
+import pathlib
+
+import pytest
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+def _item(i, **overrides):
+    return {"id": str(i), "question": f"Question {i} ?", "choices": ["A", "B", "C", "D"], "answer_index": 1, **overrides}
+
+
+class ScriptedLlm:
+    """LLM factice : renvoie les réponses prévues dans l'ordre et garde le nombre de questions demandé à chaque appel."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requested = []
+
+    def invoke(self, prompt, **kwargs):
+        self.requested.append(int(re.search(r"Nombre de questions: (\d+)", prompt).group(1)))
+        response = self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+        if isinstance(response, Exception):
+            raise response
+        return response if isinstance(response, str) else json.dumps(response)
+
+
+@pytest.fixture
+def llm(monkeypatch):
+    monkeypatch.setattr(main, "DEV_MODE", False, raising=False)
+    monkeypatch.setattr(main, "LLM_TOPUP_ATTEMPTS", 2, raising=False)
+    monkeypatch.setattr(main, "LLM_TOPUP_BUDGET", 30.0, raising=False)
+
+    def install(*responses):
+        fake = ScriptedLlm(*responses)
+        monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: fake, raising=False)
+        return fake
+
+    return install
+
+
+def test_item_validation_repairs_or_rejects():
+    """B-SALV-001: _item_from_raw répare les réponses en lettre, chaîne ou texte et les choix en trop, et rejette le reste."""
+
+    assert main._item_from_raw(_item(1, answer_index="C")).answer_index == 2
+    assert main._item_from_raw(_item(1, answer_index="3")).answer_index == 3
+    repaired = main._item_from_raw({"question": "Q ?", "choices": ["a", "b", "c", "d", "e"], "answer": "b"})
+    assert repaired.answer_index == 1 and repaired.choices == ["a", "b", "c", "d"] and repaired.id
+
+    for bad in (
+        _item(1, question=""),
+        _item(1, choices=["A", "B", "C"]),
+        _item(1, answer_index=5),
+        {k: v for k, v in _item(1).items() if k != "answer_index"},
+        "pas un objet",
+    ):
+        with pytest.raises(ValueError):
+            main._item_from_raw(bad)
+
+
+def test_only_shortfall_is_regenerated(llm):
+    """B-SALV-002: les questions valides sont gardées et un seul appel complémentaire demande le manque."""
+
+    first = {"name": "QCM", "items": [_item(i) for i in range(8)] + [_item(8, answer_index=9), _item(9, choices=[])]}
+    fake = llm(first, {"items": [_item(1, question="Complément 1 ?"), _item(2, question="Complément 2 ?")]})
+
+    resp = main._generate_via_langchain(["python"], 10, None, "entretien")
+
+    assert fake.requested == [10, 2]
+    assert len(resp.items) == 10 and resp.name == "QCM"
+    assert len({it.id for it in resp.items}) == 10
+    assert [it.question for it in resp.items[-2:]] == ["Complément 1 ?", "Complément 2 ?"]
+
+
+def test_topup_bounded_by_attempts_and_budget(monkeypatch, llm):
+    """B-SALV-003: les compléments s'arrêtent après LLM_TOPUP_ATTEMPTS appels ou LLM_TOPUP_BUDGET secondes ; le QCM partiel est renvoyé."""
+
+    responses = iter(range(100))
+
+    class OneAtATime(ScriptedLlm):
+        def invoke(self, prompt, **kwargs):
+            super().invoke(prompt, **kwargs)
+            return json.dumps({"items": [_item(next(responses))]})
+
+    fake = OneAtATime("")
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: fake, raising=False)
+    resp = main._generate_via_langchain([], 5, "Nom", "entretien")
+    assert fake.requested == [5, 4, 3] and len(resp.items) == 3
+
+    fake = OneAtATime("")
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: fake, raising=False)
+    monkeypatch.setattr(main, "LLM_TOPUP_BUDGET", 0.0, raising=False)
+    assert len(main._generate_via_langchain([], 5, None, "entretien").items) == 1
+    assert fake.requested == [5]
+
+
+def test_topup_failure_keeps_items_first_failure_raises(llm):
+    """B-SALV-004: l'échec d'un complément garde l'acquis ; l'échec du premier appel (ou aucune question valide) est levé."""
+
+    fake = llm({"items": [_item(1), _item(2)]}, RuntimeError("quota"))
+    assert len(main._generate_via_langchain([], 4, None, "entretien").items) == 2
+    assert fake.requested == [4, 2, 2]
+
+    llm(RuntimeError("provider down"))
+    with pytest.raises(RuntimeError):
+        main._generate_via_langchain([], 4, None, "entretien")
+
+    llm({"items": [_item(1, answer_index=None)]})
+    with pytest.raises(ValueError):
+        main._generate_via_langchain([], 1, None, "entretien")
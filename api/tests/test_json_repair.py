@@ -0,0 +1,100 @@
+import sys
+import json
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+FIXTURES = pathlib.Path(__file__).parent / "fixtures" / "llm_outputs"
+MANIFEST = json.loads((FIXTURES / "manifest.json").read_text(encoding="utf-8"))
+
+
+def _items(data):
+    return data["items"] if isinstance(data, dict) else data
+
+
+def _success_rate(parse):
+    ok = 0
+    for name, expected in MANIFEST.items():
+        try:
+            ok += expected is not None and len(_items(parse((FIXTURES / name).read_text(encoding="utf-8")))) == expected
+        except ValueError:
+            pass
+    return ok / sum(1 for e in MANIFEST.values() if e is not None)
+
+
+@pytest.mark.parametrize("name", sorted(MANIFEST))
+def test_repair_corpus(name):
+    """B-JSON-001: chaque sortie du corpus est réparée avec le nombre d'éléments complets attendu, ou rejetée (ValueError)."""
+
+    text = (FIXTURES / name).read_text(encoding="utf-8")
+    expected = MANIFEST[name]
+    if expected is None:
+        with pytest.raises(ValueError):
+            main._extract_json(text)
+        return
+    items = _items(main._extract_json(text))
+    assert len(items) == expected
+    assert all(isinstance(it["question"], str) and len(it["choices"]) == 4 for it in items)
+
+
+def test_repair_success_rate():
+    """B-JSON-002: taux de parse sur le corpus : 100 % des sorties récupérables avec réparation, contre le parse strict."""
+
+    strict = _success_rate(main._extract_json_strict)
+    tolerant = _success_rate(main._extract_json)
+    assert tolerant == 1.0
+    assert strict <= 0.3
+
+
+def test_generate_salvages_malformed_completion(monkeypatch, offline_app):
+    """B-JSON-003: une complétion tronquée n'est plus une 503 : les questions complètes sont renvoyées."""
+
+    text = (FIXTURES / "truncated_mid_item.txt").read_text(encoding="utf-8")
+
+    class FakeLlm:
+        def invoke(self, prompt, **kwargs):
+            return text
+
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: FakeLlm(), raising=False)
+
+    resp = TestClient(main.app).post("/generate_qcm", json={"skills": ["git"], "count": 4})
+    assert resp.status_code == 200
+    assert [f"commit n°{i} " in it["question"] for i, it in enumerate(resp.json()["items"], 1)] == [True] * 4
+
+
+def test_structured_output_client(monkeypatch):
+    """B-JSON-004: le client LLM reçoit le schéma QcmItem au format Gemini ; LLM_STRUCTURED_OUTPUT=false n'envoie aucun schéma."""
+
+    built = []
+
+    class StructuredModel:
+        def __init__(self, **kwargs):
+            built.append(kwargs)
+
+    monkeypatch.setenv("GEMINI_API_KEY", "key")
+    monkeypatch.setattr(main, "DEV_MODE", False, raising=False)
+    monkeypatch.setattr(main, "LLM_STRUCTURED_OUTPUT", True, raising=False)
+    monkeypatch.setattr(main, "ChatGoogleGenerativeAI", StructuredModel, raising=False)
+    main._reset_llm_clients()
+    main._get_llm()
+    schema = built[0]["response_schema"]
+    assert built[0]["response_mime_type"] == "application/json"
+    item = schema["properties"]["items"]["items"]
+    assert set(item["required"]) == {"id", "question", "choices", "answer_index"}
+    assert item["properties"]["skill"] == {"type": "string", "nullable": True}
+    assert item["properties"]["choices"]["minItems"] == 4
+    assert "$ref" not in json.dumps(schema) and "title" not in json.dumps(schema)
+
+    built.clear()
+    monkeypatch.setattr(main, "LLM_STRUCTURED_OUTPUT", False, raising=False)
+    main._reset_llm_clients()
+    assert isinstance(main._get_llm(), StructuredModel)
+    assert "response_schema" not in built[0] and "response_mime_type" not in built[0]
+    main._reset_llm_clients()
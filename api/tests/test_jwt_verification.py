@@ -0,0 +1,182 @@
+import sys
+import json
+import time
+import base64
+import asyncio
+import pathlib
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+import pytest
+from fastapi import HTTPException
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+def _oct_jwk(kid, secret):
+    k = base64.urlsafe_b64encode(secret).rstrip(b"=").decode()
+    return {"kty": "oct", "kid": kid, "alg": "HS256", "k": k}
+
+
+class KeyServer:
+    """Serveur JWKS local remplaçant l'endpoint /auth/v1/.well-known/jwks.json de Supabase."""
+
+    def __init__(self):
+        self.keys = []
+        self.hits = 0
+        # Nombre de prochaines requêtes servies en erreur 503 (panne passagère du JWKS)
+        self.failing = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.hits += 1
+                if server.failing:
+                    server.failing -= 1
+                    self.send_response(503)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                body = json.dumps({"keys": server.keys}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}/auth/v1/.well-known/jwks.json"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _token(secret, kid=None, sub="user-1", exp_in=3600, aud="authenticated"):
+    headers = {"kid": kid} if kid else None
+    payload = {"sub": sub, "aud": aud, "exp": int(time.time()) + exp_in}
+    return jwt.encode(payload, secret, algorithm="HS256", headers=headers)
+
+
+def _auth(token):
+    return asyncio.run(main._verify_and_get_user_id(f"Bearer {token}"))
+
+
+@pytest.fixture
+def key_server(monkeypatch):
+    server = KeyServer()
+    monkeypatch.setattr(main, "DEV_MODE", False, raising=False)
+    monkeypatch.setattr(main, "JWT_VERIFY", True, raising=False)
+    monkeypatch.setattr(main, "SUPABASE_JWT_SECRET", None, raising=False)
+    monkeypatch.setattr(main, "SUPABASE_JWKS_URL", server.url, raising=False)
+    monkeypatch.setattr(main, "JWKS_CACHE", None, raising=False)
+    monkeypatch.setattr(main, "TOKEN_CACHE", main.TTLCache(100, 0), raising=False)
+    yield server
+    server.close()
+
+
+def test_jwks_verified_token_and_bad_signature(key_server):
+    """B-JWT-001: un jeton signé par une clé du JWKS est accepté, une signature invalide donne 401."""
+
+    secret = b"k1-secret-" * 4
+    key_server.keys = [_oct_jwk("k1", secret)]
+
+    assert _auth(_token(secret, kid="k1")) == "user-1"
+    with pytest.raises(HTTPException) as exc:
+        _auth(_token(b"wrong-secret-" * 4, kid="k1", sub="intrus"))
+    assert exc.value.status_code == 401
+    with pytest.raises(HTTPException):
+        _auth(_token(secret, kid="k1", aud="anon"))
+    # Le JWKS n'a été récupéré qu'une fois
+    assert key_server.hits == 1
+
+
+def test_jwks_key_rotation_refreshes_rate_limited(monkeypatch, key_server):
+    """B-JWT-002: un kid inconnu déclenche un rechargement du JWKS, limité à un par min_refresh_interval."""
+
+    old, new = b"old-secret-" * 4, b"new-secret-" * 4
+    key_server.keys = [_oct_jwk("old", old)]
+    assert _auth(_token(old, kid="old")) == "user-1"
+
+    monkeypatch.setattr(main, "JWKS_MIN_REFRESH_INTERVAL", 0, raising=False)
+    main.JWKS_CACHE.min_refresh_interval = 0
+    key_server.keys = [_oct_jwk("old", old), _oct_jwk("new", new)]
+    assert _auth(_token(new, kid="new", sub="user-2")) == "user-2"
+    assert key_server.hits == 2
+
+    # Rafale de kids inconnus : pas plus d'un rechargement par intervalle
+    main.JWKS_CACHE.min_refresh_interval = 60
+    for i in range(5):
+        with pytest.raises(HTTPException):
+            _auth(_token(new, kid=f"unknown-{i}", sub=f"u{i}"))
+    assert key_server.hits == 2
+
+
+def test_token_cache_until_exp_and_shared_secret(monkeypatch, key_server):
+    """B-JWT-003: un jeton vérifié est servi depuis le cache jusqu'à son exp ; le secret partagé HS256 est supporté."""
+
+    secret = b"shared-secret-" * 3
+    monkeypatch.setattr(main, "SUPABASE_JWT_SECRET", secret.decode(), raising=False)
+    monkeypatch.setattr(main, "SUPABASE_JWKS_URL", None, raising=False)
+    monkeypatch.setattr(main, "JWT_LEEWAY", 0, raising=False)
+
+    token = _token(secret, sub="user-3", exp_in=2)
+    assert _auth(token) == "user-3"
+    assert len(main.TOKEN_CACHE) == 1
+
+    calls = []
+    real_decode = jwt.decode
+    monkeypatch.setattr(main.jwt, "decode", lambda *a, **k: calls.append(1) or real_decode(*a, **k))
+    assert _auth(token) == "user-3"
+    assert calls == []
+
+    time.sleep(2.1)
+    with pytest.raises(HTTPException):
+        _auth(token)
+    assert key_server.hits == 0
+
+
+def test_warm_cache_overhead_microseconds(key_server):
+    """B-JWT-004: à chaud, la vérification d'un jeton déjà vu coûte quelques microsecondes."""
+
+    secret = b"k1-secret-" * 4
+    key_server.keys = [_oct_jwk("k1", secret)]
+    header = f"Bearer {_token(secret, kid='k1')}"
+
+    async def run(n):
+        await main._verify_and_get_user_id(header)
+        start = time.perf_counter()
+        for _ in range(n):
+            await main._verify_and_get_user_id(header)
+        return (time.perf_counter() - start) / n
+
+    avg = asyncio.run(run(2000))
+    assert avg < 50e-6
+
+
+def test_failed_jwks_fetch_does_not_block_rotation(key_server):
+    """B-JWT-005: un échec de chargement du JWKS n'ouvre pas la fenêtre min_refresh_interval ; seul un court délai failure_backoff s'applique."""
+
+    old, new = b"old-secret-" * 4, b"new-secret-" * 4
+    key_server.keys = [_oct_jwk("old", old), _oct_jwk("new", new)]
+    key_server.failing = 1
+    main.JWKS_CACHE = main.JwksCache(key_server.url, min_refresh_interval=60, failure_backoff=60)
+
+    with pytest.raises(HTTPException):
+        _auth(_token(new, kid="new"))
+    # Pendant le délai après échec, pas de nouvel appel au JWKS
+    with pytest.raises(HTTPException):
+        _auth(_token(new, kid="new"))
+    assert key_server.hits == 1 and main.JWKS_CACHE.failures == 1
+
+    main.JWKS_CACHE.failure_backoff = 0
+    assert _auth(_token(new, kid="new", sub="user-2")) == "user-2"
+    assert key_server.hits == 2
@@ -0,0 +1,87 @@
+import sys
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+class FakeChatModel:
+    """Remplace ChatGoogleGenerativeAI : compte les instanciations."""
+
+    instances = []
+
+    def __init__(self, model, google_api_key, temperature, callbacks=None, **options):
+        self.model = model
+        self.google_api_key = google_api_key
+        self.temperature = temperature
+        self.options = options
+        self.pings = 0
+        FakeChatModel.instances.append(self)
+
+    def invoke(self, msg):
+        self.pings += 1
+        return "pong"
+
+
+@pytest.fixture(autouse=True)
+def fake_llm(monkeypatch):
+    FakeChatModel.instances = []
+    monkeypatch.setattr(main, "ChatGoogleGenerativeAI", FakeChatModel, raising=False)
+    monkeypatch.setattr(main, "DEV_MODE", False, raising=False)
+    monkeypatch.setenv("GEMINI_API_KEY", "key-1")
+    main._reset_llm_clients()
+    yield
+    main._reset_llm_clients()
+
+
+def test_llm_client_reused_for_same_config():
+    """B-LLM-001: _get_llm() renvoie la même instance pour une configuration identique."""
+
+    first = main._get_llm()
+    second = main._get_llm()
+
+    assert first is second
+    assert len(FakeChatModel.instances) == 1
+
+
+def test_llm_client_keyed_by_model_and_temperature():
+    """B-LLM-002: le registre distingue les clients par modèle et température."""
+
+    default = main._get_llm()
+    colder = main._get_llm(temperature=0.1)
+    other_model = main._get_llm(model="gemini-other")
+
+    assert len({id(default), id(colder), id(other_model)}) == 3
+    assert colder.temperature == 0.1
+    assert other_model.model == "gemini-other"
+
+
+def test_llm_client_rebuilt_on_api_key_change(monkeypatch):
+    """B-LLM-003: un changement de GEMINI_API_KEY reconstruit le client avec la nouvelle clé."""
+
+    old = main._get_llm()
+    monkeypatch.setenv("GEMINI_API_KEY", "key-2")
+    new = main._get_llm()
+
+    assert new is not old
+    assert new.google_api_key == "key-2"
+    assert main._get_llm() is new
+
+
+def test_llm_warmup_on_startup(monkeypatch):
+    """B-LLM-004: le démarrage de l'app pré-construit le client LLM (et le ping si LLM_WARMUP_PING)."""
+
+    monkeypatch.setattr(main, "LLM_WARMUP", True, raising=False)
+    monkeypatch.setattr(main, "LLM_WARMUP_PING", True, raising=False)
+
+    with TestClient(main.app):
+        pass
+
+    assert len(FakeChatModel.instances) == 1
+    assert FakeChatModel.instances[0].pings == 1
+    assert main._get_llm() is FakeChatModel.instances[0]
@@ -0,0 +1,89 @@
+import sys
+import json
+import pathlib
+
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+QCM_JSON = b'{"name":"QCM","items":[{"id":"1","question":"Q?","choices":["A","B","C","D"],"answer_index":0}]}'
+
+
+def test_store_lru_eviction_keeps_index_consistent():
+    """B-MEM-001: au-delà de max_entries, le QCM le moins récemment utilisé est évincé, index par utilisateur compris."""
+
+    store = main.MemoryQcmStore(max_entries=3)
+    for i in range(3):
+        store.put(f"q{i}", "u1" if i < 2 else "u2", f"QCM {i}", QCM_JSON, None, f"2025-01-0{i + 1}T00:00:00")
+    assert store.get("q0")["qcm"]["items"][0]["question"] == "Q?"  # q0 redevient le plus récent
+
+    store.put("q3", "u1", "QCM 3", QCM_JSON, 5, "2025-01-04T00:00:00")
+
+    assert len(store) == 3 and store.evictions == 1
+    assert "q1" not in store and store.get("q1") is None
+    assert [r["id"] for r in store.page("u1")] == ["q3", "q0"]
+    assert store.count("u2") == 1
+    assert store.remove("q3") is True and store.remove("q3") is False
+    assert [r["id"] for r in store.page("u1")] == ["q0"]
+
+
+def test_store_byte_cap_and_compact_records():
+    """B-MEM-002: le plafond en octets borne la mémoire estimée ; les QCM sont gardés en JSON compact, sans dict."""
+
+    store = main.MemoryQcmStore(max_bytes=10 * (main.MemoryQcmStore.RECORD_OVERHEAD + 200))
+    for i in range(100):
+        store.put(f"id-{i:03d}", "u", None, QCM_JSON, None, f"2025-01-01T00:00:{i:02d}")
+
+    assert store.nbytes <= store.max_bytes
+    assert 0 < len(store) < 100
+    assert store.count("u") == len(store)
+    rec = store._records[f"id-{99:03d}"]
+    assert isinstance(rec, tuple) and isinstance(rec[4], bytes)
+
+
+def test_store_snapshot_roundtrip(tmp_path):
+    """B-MEM-003: l'instantané disque restaure les QCM, l'index par utilisateur et l'ordre LRU."""
+
+    path = str(tmp_path / "store.jsonl")
+    store = main.MemoryQcmStore()
+    for i in range(5):
+        store.put(f"q{i}", "u", f"QCM {i}", QCM_JSON, i, f"2025-02-0{i + 1}T08:00:00")
+    store.get("q0")
+    assert store.save_snapshot(path) == 5
+
+    restored = main.MemoryQcmStore(max_entries=5)
+    assert restored.load_snapshot(path) == 5
+    assert restored.page("u") == store.page("u")
+    assert restored.get("q2") == store.get("q2")
+    # q1 est le moins récemment utilisé : premier évincé
+    restored.put("q5", "u", None, QCM_JSON, None, "2025-02-06T08:00:00")
+    assert "q1" not in restored and "q0" in restored
+    assert restored.load_snapshot(str(tmp_path / "absent.jsonl")) == 0
+
+
+def test_endpoints_use_memory_store(monkeypatch):
+    """B-MEM-004: save_qcm, history, get_qcm et delete_qcm passent par le store mémoire quand Supabase est absent."""
+
+    store = main.MemoryQcmStore(max_entries=100)
+    monkeypatch.setattr(main, "STORE", store, raising=False)
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    client = TestClient(main.app)
+
+    qcm = json.loads(QCM_JSON)
+    qid = client.post("/save_qcm", json={"user_id": "mem-user", "qcm": qcm, "score": 3}).json()["id"]
+    assert qid in store
+
+    record = client.get(f"/qcm/{qid}").json()
+    assert record["qcm"]["items"][0]["choices"] == ["A", "B", "C", "D"]
+    assert record["score"] == 3
+    assert [it["id"] for it in client.get("/history/mem-user").json()] == [qid]
+
+    assert client.delete(f"/qcm/{qid}").status_code == 200
+    assert client.get(f"/qcm/{qid}").status_code == 404
+    assert client.get("/history/mem-user").json() == []
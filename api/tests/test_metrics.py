@@ -0,0 +1,182 @@
+import sys
+import json
+import asyncio
+import pathlib
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+class FakeLlm:
+    """Client LLM factice pour _generate_via_langchain : renvoie toujours le même texte."""
+
+    def __init__(self, text):
+        self.text = text
+
+    def invoke(self, prompt, **kwargs):
+        return self.text
+
+
+def _items(n):
+    return {"items": [{"id": str(i), "question": f"Question {i} ?", "choices": ["A", "B", "C", "D"], "answer_index": 0}
+                      for i in range(n)]}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "STORE", main.MemoryQcmStore(), raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "COALESCE_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "METRICS_ENABLED", True, raising=False)
+    monkeypatch.setattr(main, "METRICS_TOKEN", None, raising=False)
+    return TestClient(main.app)
+
+
+def _sample(text, name, **labels):
+    """Valeur d'un échantillon de l'exposition texte (None s'il est absent)."""
+    wanted = "{" + ",".join(f'{k}="{v}"' for k, v in labels.items()) + "}" if labels else ""
+    for line in text.splitlines():
+        if line.startswith(name + wanted + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+
+def test_metrics_exposition_per_route_and_status(client):
+    """B-MET-001: /metrics expose compteurs et histogrammes par (méthode, modèle de route, statut) au format Prometheus."""
+
+    before = client.get("/metrics").text
+    labels = {"method": "GET", "route": "/qcm/{qid}", "status": "404"}
+    base = _sample(before, "autoqcm_http_requests_total", **labels) or 0
+    for _ in range(3):
+        assert client.get("/qcm/does-not-exist").status_code == 404
+    assert client.get("/no/such/path").status_code == 404
+
+    resp = client.get("/metrics")
+    text = resp.text
+    assert resp.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE autoqcm_http_request_duration_seconds histogram" in text
+    assert _sample(text, "autoqcm_http_requests_total", **labels) == base + 3
+    assert _sample(text, "autoqcm_http_request_duration_seconds_bucket", **labels, le="+Inf") == base + 3
+    assert _sample(text, "autoqcm_http_request_duration_seconds_count", **labels) == base + 3
+    assert _sample(text, "autoqcm_http_requests_total", method="GET", route="unmatched", status="404") >= 1
+    assert "/qcm/does-not-exist" not in text
+    assert _sample(text, "autoqcm_admission_queue_depth") == 0
+
+
+def test_stage_histograms_cover_generation_pipeline(monkeypatch, tmp_path, client):
+    """B-MET-002: une génération alimente les étapes auth, quota, llm, extract et usage_write ; Supabase est chronométré par table."""
+
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "sqlite", raising=False)
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "metrics.sqlite3"), raising=False)
+    monkeypatch.setattr(main, "SQLITE_STORAGE", None, raising=False)
+    monkeypatch.setattr(main, "USAGE_WRITE_BEHIND", False, raising=False)
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: FakeLlm(json.dumps(_items(4))), raising=False)
+    stages = ("auth", "quota", "llm", "extract", "usage_write")
+    before = {stage: main.STAGE_LATENCY.count((stage,)) for stage in stages}
+    requested = main.ITEMS_REQUESTED.value(("generate_qcm",))
+    returned = main.ITEMS_RETURNED.value(("generate_qcm",))
+
+    assert len(client.post("/generate_qcm", json={"skills": ["python"], "count": 5}).json()["items"]) == 4
+
+    assert all(main.STAGE_LATENCY.count((stage,)) > before[stage] for stage in stages)
+    assert main.ITEMS_REQUESTED.value(("generate_qcm",)) - requested == 5
+    assert main.ITEMS_RETURNED.value(("generate_qcm",)) - returned == 4
+
+    supa = main.SupabaseRest("http://supabase.invalid", "key")
+
+    async def scenario():
+        supa._http = httpx.AsyncClient(base_url="http://supabase.invalid", transport=httpx.MockTransport(lambda r: httpx.Response(200, json=[])))
+        supa._loop = asyncio.get_running_loop()
+        await supa.request("GET", "/qcm_tests")
+        await supa.request("POST", "/rpc/increment_qcm_usage", body={})
+        await supa.aclose()
+
+    counts = main.SUPABASE_LATENCY.count(("qcm_tests", "GET")), main.SUPABASE_LATENCY.count(("rpc/increment_qcm_usage", "POST"))
+    asyncio.run(scenario())
+    assert main.SUPABASE_LATENCY.count(("qcm_tests", "GET")) == counts[0] + 1
+    assert main.SUPABASE_LATENCY.count(("rpc/increment_qcm_usage", "POST")) == counts[1] + 1
+
+
+def test_generation_failures_counted_by_cause(monkeypatch, client):
+    """B-MET-003: échecs comptés par cause (fournisseur absent, sortie invalide) ; METRICS_TOKEN protège la collecte."""
+
+    def failures(cause):
+        return main.GENERATION_FAILURES.value((cause,))
+
+    base = {cause: failures(cause) for cause in ("unavailable", "invalid_output")}
+    monkeypatch.setattr(main, "ChatGoogleGenerativeAI", None, raising=False)
+    assert client.post("/generate_qcm", json={"count": 2}).status_code == 503
+    assert failures("unavailable") == base["unavailable"] + 1
+
+    monkeypatch.setattr(main, "_get_llm", lambda *a, **kw: FakeLlm("Désolé, je ne peux pas."), raising=False)
+    assert client.post("/generate_qcm", json={"count": 2}).status_code == 503
+    assert failures("invalid_output") == base["invalid_output"] + 1
+    text = client.get("/metrics").text
+    assert _sample(text, "autoqcm_generation_failures_total", cause="invalid_output") == failures("invalid_output")
+
+    monkeypatch.setattr(main, "METRICS_TOKEN", "scrape-secret", raising=False)
+    assert client.get("/metrics").status_code == 401
+    assert client.get("/metrics", headers={"Authorization": "Bearer scrape-secret"}).status_code == 200
+
+
+def test_instrumentation_overhead_negligible(monkeypatch):
+    """B-MET-004: l'instrumentation reste en O(1) par mesure : une ligne d'histogramme mise à jour, deux lectures d'horloge et une
+    observation par requête, messages ASGI relayés tels quels et aucune mesure hors HTTP."""
+
+    hist = main.MetricHistogram("bench_stage_seconds", "bench", ("stage",), buckets=(0.01, 0.1))
+    for value in (0.005, 0.05, 0.05, 5.0):
+        hist.observe(("llm",), value)
+    text = "\n".join(hist.render())
+    assert [_sample(text, "bench_stage_seconds_bucket", stage="llm", le=le) for le in ("0.01", "0.1", "+Inf")] == [1, 3, 4]
+    assert _sample(text, "bench_stage_seconds_sum", stage="llm") == pytest.approx(5.105)
+    assert hist.count(("llm",)) == 4
+
+    clock = {"calls": 0}
+
+    def perf_counter():
+        clock["calls"] += 1
+        return float(clock["calls"])
+
+    monkeypatch.setattr(main, "time", type("FakeTime", (), {"perf_counter": staticmethod(perf_counter)}), raising=False)
+    monkeypatch.setattr(main, "STAGE_LATENCY", main.MetricHistogram("bench_timer_seconds", "bench", ("stage",)), raising=False)
+    monkeypatch.setattr(main, "HTTP_REQUESTS", main.MetricCounter("bench_requests_total", "bench", ("method", "route", "status")), raising=False)
+    monkeypatch.setattr(main, "HTTP_LATENCY", main.MetricHistogram("bench_request_seconds", "bench", ("method", "route", "status")), raising=False)
+
+    with pytest.raises(RuntimeError):
+        with main._stage("bench"):
+            raise RuntimeError("boom")
+    assert main.STAGE_LATENCY.count(("bench",)) == 1 and clock["calls"] == 2
+
+    sent = []
+
+    async def app(scope, receive, send):
+        await send({"type": "http.response.start", "status": 201, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    async def send(message):
+        sent.append(message)
+
+    async def receive():
+        return {"type": "http.request"}
+
+    async def scenario(rounds):
+        middleware = main.MetricsMiddleware(app)
+        for _ in range(rounds):
+            await middleware({"type": "http", "method": "GET", "path": "/"}, receive, send)
+        await middleware({"type": "lifespan"}, receive, send)
+
+    clock["calls"] = 0
+    asyncio.run(scenario(100))
+    labels = ("GET", "unmatched", "201")
+    assert clock["calls"] == 2 * 100
+    assert main.HTTP_REQUESTS.value(labels) == 100 and main.HTTP_LATENCY.count(labels) == 100
+    assert sent[:2] == [{"type": "http.response.start", "status": 201, "headers": []}, {"type": "http.response.body", "body": b"ok"}]
+    assert len(sent) == 2 * 101
@@ -0,0 +1,159 @@
+import sys
+import asyncio
+import pathlib
+import threading
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+class CountingLlm:
+    """Remplace _generate_via_langchain : compte les appels et les questions demandées."""
+
+    def __init__(self):
+        self.requested = []
+        self.lock = threading.Lock()
+
+    def __call__(self, skills, count, name, difficulty, **kwargs):
+        with self.lock:
+            self.requested.append(count)
+        return main._generate_fallback(skills, count, name, difficulty)
+
+
+def _warmer(**overrides):
+    params = dict(window=3600, min_requests=3, top_keys=5, pool_size=20, batch_size=10,
+                  max_calls_per_hour=20, idle_seconds=0, pool_ttl=3600)
+    params.update(overrides)
+    return main.PregenerationWarmer(**params)
+
+
+@pytest.fixture
+def llm(monkeypatch, offline_app):
+    fake = CountingLlm()
+    monkeypatch.setattr(main, "QUESTION_BANK_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "_generate_via_langchain", fake, raising=False)
+    monkeypatch.setattr(main, "ADMISSION", main.AdmissionController(8, 0, 64, 30), raising=False)
+    monkeypatch.setattr(main, "WARMER_ENABLED", True, raising=False)
+    return fake
+
+
+def test_learns_popular_combinations_and_fills_pool(llm):
+    """B-WARM-001: seules les combinaisons assez demandées (casse et ordre ignorés) sont pré-générées, par lots, jusqu'à la taille de réserve."""
+
+    warmer = _warmer()
+    for skills in (["Python", "SQL"], ["sql", "python"], ["python", "sql "]):
+        warmer.observe(skills, "entretien")
+    warmer.observe(["rust"], "entretien")
+    assert warmer.popular() == [(("python", "sql"), "entretien")]
+
+    added = [asyncio.run(warmer.tick()) for _ in range(3)]
+
+    assert added == [10, 10, 0]
+    assert llm.requested == [10, 10]
+    assert warmer.available(["SQL", "Python"], "Entretien") == 20
+    assert warmer.available(["rust"], "entretien") == 0
+
+
+def test_pauses_under_live_load_and_respects_budget(llm):
+    """B-WARM-002: pas de pré-génération pendant une génération ou juste après une demande ; limite d'appels LLM par heure."""
+
+    warmer = _warmer(idle_seconds=60, max_calls_per_hour=1)
+    for _ in range(3):
+        warmer.observe(["go"], "entretien")
+    assert asyncio.run(warmer.tick()) == 0 and warmer.paused == 1
+
+    warmer.idle_seconds = 0
+    main.ADMISSION.running = 1
+    assert asyncio.run(warmer.tick()) == 0 and warmer.paused == 2
+    main.ADMISSION.running = 0
+
+    assert asyncio.run(warmer.tick()) == 10
+    assert asyncio.run(warmer.tick()) == 0
+    assert warmer.budget_exhausted == 1 and llm.requested == [10]
+
+
+def test_matching_requests_served_from_pool(monkeypatch, llm):
+    """B-WARM-003: une demande couverte par la réserve est servie sans appel LLM ; le manque d'une réserve partielle est généré."""
+
+    warmer = _warmer(pool_size=12)
+    monkeypatch.setattr(main, "WARMER", warmer, raising=False)
+    client = TestClient(main.app)
+    payload = {"skills": ["docker"], "count": 5}
+    for _ in range(3):
+        assert client.post("/generate_qcm", json=payload).status_code == 200
+    assert asyncio.run(warmer.tick()) == 10 and asyncio.run(warmer.tick()) == 2
+    llm.requested.clear()
+
+    first = client.post("/generate_qcm", json=payload).json()
+    second = client.post("/generate_qcm", json=payload).json()
+    assert llm.requested == [] and len(first["items"]) == len(second["items"]) == 5
+    assert not {it["id"] for it in first["items"]} & {it["id"] for it in second["items"]}
+
+    third = client.post("/generate_qcm", json=payload).json()
+    assert llm.requested == [3] and len(third["items"]) == 5
+    client.post("/generate_qcm", json={**payload, "fresh_only": True})
+    assert llm.requested == [3, 5]
+
+    stats = client.get("/usage_stats").json()["telemetry"]["warmer"]
+    assert (stats["hits"], stats["partial_hits"], stats["items_served"]) == (2, 1, 12)
+    assert stats["hit_rate"] == round(2 / 6, 3)
+    assert stats["pool"] == [{"skills": ["docker"], "difficulty": "entretien", "ready": 0, "requests": 7}]
+
+
+def test_stale_pool_items_expire(llm):
+    """B-WARM-004: les questions prêtes plus vieilles que WARMER_POOL_TTL sont jetées et jamais servies."""
+
+    warmer = _warmer(pool_ttl=0.0)
+    for _ in range(3):
+        warmer.observe(["java"], "entretien")
+    assert asyncio.run(warmer.tick()) == 10
+
+    assert warmer.take(["java"], "entretien", 5) == []
+    assert warmer.items_expired == 10 and warmer.lookups == 1 and warmer.hits == 0
+
+
+def test_refill_does_not_join_live_call(monkeypatch, llm):
+    """B-WARM-005: une pré-génération simultanée à l'appel d'un utilisateur (même clé de coalescence) fait son propre appel LLM :
+    les questions servies à l'utilisateur n'entrent pas dans la réserve."""
+
+    barrier = threading.Barrier(2, timeout=5.0)
+    met = []
+
+    def tagged_llm(skills, count, name, difficulty, **kwargs):
+        try:
+            barrier.wait()
+            met.append(True)
+        except threading.BrokenBarrierError:
+            met.append(False)
+        with llm.lock:
+            llm.requested.append(count)
+            call = len(llm.requested)
+        response = main._generate_fallback(skills, count, name, difficulty)
+        return main.GenerateResponse(name=response.name, items=[
+            it.model_copy(update={"question": f"[appel {call}] {it.question}"}) for it in response.items])
+
+    monkeypatch.setattr(main, "COALESCE_ENABLED", True, raising=False)
+    monkeypatch.setattr(main, "COALESCER", main.RequestCoalescer(10), raising=False)
+    monkeypatch.setattr(main, "_generate_via_langchain", tagged_llm, raising=False)
+    warmer = _warmer()
+    for _ in range(3):
+        warmer.observe(["kotlin"], "entretien")
+
+    async def scenario():
+        # Appel d'un utilisateur en cours (hors admission, comme un appel partagé dont le demandeur est parti)
+        live = asyncio.create_task(main._generate_response(["kotlin"], 10, None, "entretien"))
+        await asyncio.sleep(0)
+        added = await warmer.tick()
+        return (await live), added
+
+    live, added = asyncio.run(scenario())
+
+    assert added == 10 and met == [True, True] and llm.requested == [10, 10]
+    pooled = {it.question for it in warmer.take(["kotlin"], "entretien", 10)}
+    assert len(pooled) == 10 and not pooled & {it.question for it in live.items}
+    assert main.COALESCER.stats()["saved_calls"] == 0
@@ -0,0 +1,101 @@
+import sys
+import uuid
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+QCM = {"name": "QCM révision", "items": [
+    {"id": str(i), "question": f"Question {i} ?", "choices": ["A", "B", "C", "D"], "answer_index": 1, "explanation": "Longue explication. " * 20}
+    for i in range(5)
+]}
+
+
+@pytest.fixture
+def client(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "sqlite", raising=False)
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "conditional.sqlite3"), raising=False)
+    monkeypatch.setattr(main, "SQLITE_STORAGE", None, raising=False)
+    monkeypatch.setattr(main, "QCM_CACHE", main.TTLCache(100, 300), raising=False)
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    return TestClient(main.app)
+
+
+def test_repeat_views_hit_cache_and_revalidate(monkeypatch, client: TestClient):
+    """B-QGET-001: /qcm/{qid} renvoie ETag et Last-Modified ; les vues suivantes ne lisent plus la base et If-None-Match donne 304."""
+
+    qid = client.post("/save_qcm", json={"user_id": "u", "qcm": QCM, "score": 4}).json()["id"]
+    reads = []
+    original = main._get_qcm_test
+
+    async def counting(supa, qid):
+        reads.append(qid)
+        return await original(supa, qid)
+
+    monkeypatch.setattr(main, "_get_qcm_test", counting)
+
+    first = client.get(f"/qcm/{qid}")
+    assert first.status_code == 200 and first.json()["qcm"]["items"][0]["question"] == "Question 0 ?"
+    etag, last_modified = first.headers["ETag"], first.headers["Last-Modified"]
+    assert etag.startswith('W/"') and last_modified.endswith("GMT")
+
+    again = client.get(f"/qcm/{qid}", headers={"If-None-Match": etag})
+    assert again.status_code == 304 and again.content == b"" and again.headers["ETag"] == etag
+    assert client.get(f"/qcm/{qid}", headers={"If-None-Match": f'"autre", {etag[2:]}'}).status_code == 304
+    assert client.get(f"/qcm/{qid}", headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get(f"/qcm/{qid}", headers={"If-None-Match": '"perime"'}).status_code == 200
+    assert reads == [qid]
+
+
+def test_etag_is_weak_across_encodings(monkeypatch, client: TestClient):
+    """B-QGET-004: le même QCM servi en gzip, brotli ou identité porte un ETag faible identique, revalidable dans chaque encodage."""
+
+    monkeypatch.setattr(main, "COMPRESSION_MIN_SIZE", 0, raising=False)
+    qid = client.post("/save_qcm", json={"user_id": "u", "qcm": QCM, "score": 4}).json()["id"]
+    encodings = ["identity", "gzip"] + (["br"] if main.brotli is not None else [])
+    responses = {enc: client.get(f"/qcm/{qid}", headers={"Accept-Encoding": enc}) for enc in encodings}
+
+    assert responses["gzip"].headers["Content-Encoding"] == "gzip"
+    assert "Content-Encoding" not in responses["identity"].headers
+    etags = {r.headers["ETag"] for r in responses.values()}
+    assert len(etags) == 1 and etags.pop().startswith('W/"')
+    for enc, resp in responses.items():
+        assert client.get(f"/qcm/{qid}", headers={"Accept-Encoding": enc, "If-None-Match": resp.headers["ETag"]}).status_code == 304
+
+
+def test_fields_projection(client: TestClient):
+    """B-QGET-002: fields= ne renvoie que les chemins demandés (ex. énoncés sans explications), avec un ETag propre."""
+
+    qid = client.post("/save_qcm", json={"user_id": "u", "qcm": QCM, "score": 4}).json()["id"]
+    full = client.get(f"/qcm/{qid}")
+    slim = client.get(f"/qcm/{qid}", params={"fields": "name,score,qcm.items.question"})
+
+    assert slim.json() == {"name": "QCM révision", "score": 4, "qcm": {"items": [{"question": f"Question {i} ?"} for i in range(5)]}}
+    assert len(slim.content) * 5 < len(full.content)
+    assert slim.headers["ETag"] != full.headers["ETag"]
+    assert client.get(f"/qcm/{qid}", params={"fields": "name,score,qcm.items.question"}, headers={"If-None-Match": slim.headers["ETag"]}).status_code == 304
+    assert client.get(f"/qcm/{qid}", headers={"If-None-Match": slim.headers["ETag"]}).status_code == 200
+    assert client.get(f"/qcm/{qid}", params={"fields": "qcm..items"}).status_code == 400
+
+
+def test_delete_invalidates_cache(monkeypatch, client: TestClient):
+    """B-QGET-003: la suppression (unitaire ou par lot) retire le QCM du cache ; les lectures suivantes renvoient 404."""
+
+    ids = [client.post("/save_qcm", json={"user_id": main.DEV_USER_ID, "qcm": QCM}).json()["id"] for _ in range(3)]
+    for qid in ids:
+        assert client.get(f"/qcm/{qid}").status_code == 200
+    assert len(main.QCM_CACHE) == 3
+
+    client.delete(f"/qcm/{ids[0]}")
+    assert client.get(f"/qcm/{ids[0]}").status_code == 404
+
+    resp = client.post("/qcm/batch_delete", json={"ids": ids[1:] + [str(uuid.uuid4())]})
+    assert resp.json()["deleted"] == 2
+    assert all(client.get(f"/qcm/{qid}").status_code == 404 for qid in ids[1:])
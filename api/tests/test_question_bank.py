@@ -0,0 +1,92 @@
+import sys
+import time
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+def _items(prefix: str, n: int, skill: str = "Python"):
+    return [
+        main.QcmItem(id=str(i), question=f"{prefix} {i} ?", choices=["A", "B", "C", "D"], answer_index=1, skill=skill)
+        for i in range(n)
+    ]
+
+
+@pytest.fixture
+def bank(tmp_path):
+    return main.QuestionBank(str(tmp_path / "bank.sqlite3"), max_items=100, max_per_key=50, ttl_seconds=3600)
+
+
+def test_bank_samples_without_repetition_per_user(bank):
+    """B-BANK-001: la banque ne ressert jamais une question au même utilisateur, mais la propose aux autres."""
+
+    bank.add(None, _items("Q", 4), ["python"], "entretien", "m")
+
+    first = bank.sample("alice", [" PYTHON "], "Entretien", "m", 3)
+    second = bank.sample("alice", ["python"], "entretien", "m", 3)
+    other = bank.sample("bob", ["python"], "entretien", "m", 4)
+
+    assert len(first) == 3
+    assert len(second) == 1
+    assert {q.question for q in first}.isdisjoint({q.question for q in second})
+    assert len(other) == 4
+    stats = bank.stats()
+    assert stats["hits"] == 8
+    assert stats["misses"] == 2
+
+
+def test_bank_eviction_and_persistence(tmp_path):
+    """B-BANK-002: éviction LRU par clé et par TTL, et contenu conservé après réouverture du fichier."""
+
+    path = str(tmp_path / "bank.sqlite3")
+    bank = main.QuestionBank(path, max_items=100, max_per_key=3, ttl_seconds=3600)
+    bank.add(None, _items("Old", 3), ["python"], "entretien", "m")
+    bank.add(None, _items("New", 2), ["python"], "entretien", "m")
+    assert bank.stats()["size"] == 3
+
+    reopened = main.QuestionBank(path, max_items=100, max_per_key=3, ttl_seconds=3600)
+    assert reopened.stats()["size"] == 3
+    assert len(reopened.sample("carol", ["python"], "entretien", "m", 10)) == 3
+
+    expired = main.QuestionBank(path, max_items=100, max_per_key=3, ttl_seconds=0)
+    time.sleep(0.01)
+    assert expired.sample("dave", ["python"], "entretien", "m", 10) == []
+
+
+def test_generate_qcm_asks_llm_only_for_shortfall(monkeypatch, offline_app, bank):
+    """B-BANK-003: /generate_qcm sert depuis la banque et ne demande au LLM que le manque ; fresh_only la contourne."""
+
+    requested_counts = []
+
+    def fake_llm(skills, count, name, difficulty):
+        requested_counts.append(count)
+        return main.GenerateResponse(name=None, items=_items(f"Gen{len(requested_counts)}", count))
+
+    bank.add(None, _items("Bank", 3), ["python"], "entretien", main.GEMINI_MODEL)
+    monkeypatch.setattr(main, "_generate_via_langchain", fake_llm, raising=False)
+    monkeypatch.setattr(main, "QUESTION_BANK_ENABLED", True, raising=False)
+    monkeypatch.setattr(main, "QUESTION_BANK", bank, raising=False)
+    client = TestClient(main.app)
+
+    resp = client.post("/generate_qcm", json={"skills": ["python"], "count": 5})
+    assert resp.status_code == 200
+    questions = [it["question"] for it in resp.json()["items"]]
+    assert len(questions) == 5
+    assert sum(q.startswith("Bank") for q in questions) == 3
+    assert requested_counts == [2]
+    assert len({it["id"] for it in resp.json()["items"]}) == 5
+
+    fresh = client.post("/generate_qcm", json={"skills": ["python"], "count": 2, "fresh_only": True})
+    assert fresh.status_code == 200
+    assert requested_counts == [2, 2]
+
+    stats = client.get("/question_bank/stats").json()
+    assert stats["enabled"] is True
+    assert stats["hits"] == 3
+    assert stats["misses"] == 2
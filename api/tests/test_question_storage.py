@@ -0,0 +1,133 @@
+import sys
+import json
+import uuid
+import asyncio
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+def _qcm(n=10):
+    return {"name": "QCM questions", "items": [
+        {"id": str(i + 1), "question": f"Question {i} ?" + " contexte" * 20, "choices": ["A", "B", "C", "D"], "answer_index": i % 4, "explanation": "Parce que." * 10}
+        for i in range(n)
+    ]}
+
+
+@pytest.fixture
+def sqlite_client(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "sqlite", raising=False)
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "questions.sqlite3"), raising=False)
+    monkeypatch.setattr(main, "SQLITE_STORAGE", None, raising=False)
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    return TestClient(main.app), main._storage()
+
+
+def test_sqlite_questions_stored_once(sqlite_client):
+    """B-QSTORE-001: sauvegarder N fois le même QCM stocke chaque question une seule fois ; qcm_tests ne garde que les empreintes."""
+
+    client, storage = sqlite_client
+    qcm = _qcm()
+    ids = [client.post("/save_qcm", json={"user_id": "u", "qcm": qcm, "score": i}).json()["id"] for i in range(20)]
+
+    conn = storage.db._conn
+    assert conn.execute("select count(*) from questions").fetchone()[0] == 10
+    blob = conn.execute("select qcm from qcm_tests where id = ?", (ids[0],)).fetchone()[0]
+    full = json.dumps(qcm, separators=(",", ":")).encode("utf-8")
+    assert len(blob) * 3 < len(full)
+    assert [it["id"] for it in json.loads(blob)["items"]] == [str(i + 1) for i in range(10)]
+
+
+def test_sqlite_get_qcm_rehydrates_items_and_answers(sqlite_client):
+    """B-QSTORE-002: get_qcm reconstitue les questions depuis la table et renvoie les réponses de la tentative."""
+
+    client, _ = sqlite_client
+    qcm = _qcm(3)
+    answers = [0, None, 2]
+    qid = client.post("/save_qcm", json={"user_id": "u", "qcm": qcm, "score": 2, "answers": answers}).json()["id"]
+
+    record = client.get(f"/qcm/{qid}").json()
+    assert record["score"] == 2
+    assert record["qcm"]["answers"] == answers
+    items = record["qcm"]["items"]
+    assert [(it["id"], it["question"], it["answer_index"]) for it in items] == [(it["id"], it["question"], it["answer_index"]) for it in qcm["items"]]
+
+
+def test_supabase_normalized_round_trips(monkeypatch):
+    """B-QSTORE-003: avec NORMALIZED_QUESTIONS, sauvegarde = upsert questions + insert ; lecture = une seule requête de questions."""
+
+    calls, tables = [], {"questions": {}, "qcm_tests": {}}
+
+    async def fake_request(self, method, path, params=None, body=None, headers=None):
+        params = dict(params or [])
+        calls.append((method, path, params, headers))
+        if method == "POST" and path == "/questions":
+            for row in body:
+                tables["questions"].setdefault(row["hash"], row["item"])
+            return None
+        if method == "POST":
+            for row in body:
+                tables["qcm_tests"][row["id"]] = json.loads(json.dumps(row))
+            return body
+        if path == "/questions":
+            wanted = json.loads("[" + params["hash"][4:-1] + "]")
+            return [{"hash": h, "item": tables["questions"][h]} for h in wanted if h in tables["questions"]]
+        row = tables["qcm_tests"].get(params["id"][3:])
+        return [json.loads(json.dumps(row))] if row else []
+
+    supa = main.SupabaseStorage(main.SupabaseRest("http://supabase.invalid", "key"))
+    monkeypatch.setattr(main.SupabaseRest, "request", fake_request)
+    monkeypatch.setattr(main, "NORMALIZED_QUESTIONS", True, raising=False)
+    qcm = _qcm(4)
+    row = {"id": str(uuid.uuid4()), "user_id": "u", "name": "QCM", "qcm": qcm, "score": None, "created_at": "2025-01-01T00:00:00"}
+
+    async def scenario():
+        await main._insert_qcm_test(supa, row)
+        return await main._get_qcm_test(supa, row["id"])
+
+    record = asyncio.run(scenario())
+
+    upsert, insert = calls[0], calls[1]
+    assert upsert[1] == "/questions" and upsert[2]["on_conflict"] == "hash"
+    assert "resolution=ignore-duplicates" in upsert[3]["Prefer"]
+    assert insert[1] == "/qcm_tests" and all(set(it) == {"id", "h"} for it in tables["qcm_tests"][row["id"]]["qcm"]["items"])
+    assert [c[1] for c in calls[2:]] == ["/qcm_tests", "/questions"]
+    assert [it["question"] for it in record["qcm"]["items"]] == [it["question"] for it in qcm["items"]]
+
+
+def test_legacy_full_documents_still_readable(sqlite_client):
+    """B-QSTORE-004: les QCM enregistrés avant la normalisation (questions complètes) restent lisibles tels quels."""
+
+    client, storage = sqlite_client
+    qid = str(uuid.uuid4())
+    qcm = _qcm(2)
+    storage.db.insert_qcm_tests([{"id": qid, "user_id": "u", "name": None, "qcm": qcm, "score": None, "created_at": "2025-01-01T00:00:00"}])
+
+    record = client.get(f"/qcm/{qid}").json()
+    assert [it["question"] for it in record["qcm"]["items"]] == [it["question"] for it in qcm["items"]]
+    assert storage.db._conn.execute("select count(*) from questions").fetchone()[0] == 0
+
+
+def test_missing_question_reference_dropped(sqlite_client, capsys):
+    """B-QSTORE-005: une référence {id, h} absente de la table questions est retirée (avec sa réponse) et journalisée, jamais renvoyée telle quelle."""
+
+    client, storage = sqlite_client
+    qcm = _qcm(3)
+    qid = client.post("/save_qcm", json={"user_id": "u", "qcm": qcm, "score": 1, "answers": [0, 1, 2]}).json()["id"]
+    lost = json.loads(storage.db._conn.execute("select qcm from qcm_tests where id = ?", (qid,)).fetchone()[0])["items"][1]["h"]
+    storage.db._conn.execute("delete from questions where hash = ?", (lost,))
+    storage.db._conn.commit()
+
+    record = client.get(f"/qcm/{qid}").json()
+    items = record["qcm"]["items"]
+    assert [it["id"] for it in items] == ["1", "3"]
+    assert all("h" not in it and it["question"] for it in items)
+    assert record["qcm"]["answers"] == [0, 2]
+    assert "missing from the questions table" in capsys.readouterr().out
@@ -0,0 +1,137 @@
+import sys
+import time
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+class CountingSupa:
+    """Supabase factice : user_roles / qcm_usage en mémoire, chaque requête réseau est comptée."""
+
+    def __init__(self, roles, usage):
+        self.roles = roles
+        self.usage = usage
+        self.queries = 0
+
+    def table(self, name):
+        supa = self
+
+        class Query:
+            def __init__(self):
+                self.filters = {}
+
+            def select(self, *args, **kwargs):
+                return self
+
+            def eq(self, column, value):
+                self.filters[column] = value
+                return self
+
+            def limit(self, n):
+                return self
+
+            def execute(self):
+                supa.queries += 1
+                uid = self.filters.get("user_id")
+                if name == "user_roles":
+                    rows = [{"role": supa.roles[uid]}] if uid in supa.roles else []
+                else:
+                    rows = [{"model": m, "generated_count": n} for (u, m), n in supa.usage.items() if u == uid]
+                return type("Res", (), {"data": rows})()
+
+        return Query()
+
+    def rpc(self, fn, params):
+        supa = self
+
+        class Call:
+            def execute(self):
+                supa.queries += 1
+                key = (params["p_user_id"], params["p_model"])
+                supa.usage[key] = supa.usage.get(key, 0) + params["p_delta"]
+
+        return Call()
+
+
+@pytest.fixture
+def setup(monkeypatch, offline_app):
+    supa = CountingSupa(roles={main.DEV_USER_ID: "user"}, usage={(main.DEV_USER_ID, main.GEMINI_MODEL): 8})
+    monkeypatch.setattr(main, "_supabase_client", lambda: supa, raising=False)
+    monkeypatch.setattr(main, "_generate_via_langchain", main._generate_fallback, raising=False)
+    monkeypatch.setattr(main, "USAGE_WRITE_BEHIND", False, raising=False)
+    return supa, TestClient(main.app)
+
+
+def test_quota_warm_cache_no_lookup_queries(setup):
+    """B-CACHE-001: à chaud, le contrôle de quota ne fait aucune requête Supabase (seul l'incrément reste)."""
+
+    supa, client = setup
+    assert client.post("/generate_qcm", json={"skills": ["python"], "count": 1}).status_code == 200
+    cold_queries = supa.queries
+    assert cold_queries == 3  # rôle + usage + incrément RPC
+
+    # Deuxième appel : uniquement l'incrément
+    assert client.post("/generate_qcm", json={"skills": ["python"], "count": 1}).status_code == 200
+    assert supa.queries - cold_queries == 1
+
+
+def test_quota_write_through_enforces_limit(setup):
+    """B-CACHE-002: nos incréments mettent le cache à jour, la limite du rôle est appliquée sans relire Supabase."""
+
+    supa, client = setup
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 200  # 8 -> 9
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 200  # 9 -> 10
+    before = supa.queries
+    resp = client.post("/generate_qcm", json={"count": 1})
+
+    assert resp.status_code == 403
+    assert resp.json()["detail"] == "Limite de génération de QCM atteinte pour votre rôle."
+    assert supa.queries == before
+    stats = client.get("/usage_stats").json()
+    assert stats["total"] == 10
+    assert stats["per_model"] == [{"model": main.GEMINI_MODEL, "count": 10}]
+
+
+def test_ttl_cache_expiry_and_lru_eviction():
+    """B-CACHE-003: TTLCache expire les entrées après ttl et évince la moins récemment utilisée au-delà de maxsize."""
+
+    cache = main.TTLCache(maxsize=2, ttl=0.05)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert cache.get("b") is None
+    assert cache.get("a") == 1 and cache.get("c") == 3
+    assert cache.update("a", lambda v: v + 10) is True
+    assert cache.get("a") == 11
+    time.sleep(0.06)
+    assert cache.get("a") is None
+    assert cache.update("a", lambda v: v) is False
+
+
+def test_admin_invalidation_reloads_role(setup):
+    """B-CACHE-004: après /admin/cache/invalidate (par un admin), le nouveau rôle est relu depuis user_roles."""
+
+    supa, client = setup
+    supa.usage[(main.DEV_USER_ID, main.GEMINI_MODEL)] = 10
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 403
+
+    supa.roles[main.DEV_USER_ID] = "user_plus"
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 403  # rôle encore en cache
+
+    # Seul un admin peut invalider
+    assert client.post("/admin/cache/invalidate", params={"user_id": main.DEV_USER_ID}).status_code == 403
+    supa.roles["admin-id"] = "admin"
+    main.app.dependency_overrides[main._verify_and_get_user_id] = lambda: "admin-id"
+    try:
+        assert client.post("/admin/cache/invalidate", params={"user_id": main.DEV_USER_ID}).status_code == 200
+    finally:
+        main.app.dependency_overrides.pop(main._verify_and_get_user_id, None)
+
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 200
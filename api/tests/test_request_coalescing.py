@@ -0,0 +1,74 @@
+import sys
+import asyncio
+import pathlib
+
+import httpx
+import pytest
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+@pytest.fixture
+def llm(monkeypatch, slow_llm):
+    monkeypatch.setattr(main, "COALESCE_ENABLED", True, raising=False)
+    monkeypatch.setattr(main, "COALESCER", main.RequestCoalescer(10), raising=False)
+    monkeypatch.setattr(main, "ADMISSION", main.AdmissionController(16, 0, 64, 30), raising=False)
+    return slow_llm
+
+
+def _burst(payloads):
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as ac:
+            return await asyncio.gather(*[ac.post("/generate_qcm", json=p) for p in payloads])
+    return asyncio.run(scenario())
+
+
+def test_identical_concurrent_requests_share_one_call(llm):
+    """B-COAL-001: 10 demandes identiques simultanées = 1 appel LLM ; chaque appelant a ses propres ids et est compté."""
+
+    payload = {"skills": ["Python", "sql"], "count": 5, "difficulty": "entretien"}
+    variant = {"skills": ["SQL ", "python"], "count": 5, "difficulty": "Entretien"}
+    responses = _burst([payload] * 9 + [variant])
+
+    assert all(r.status_code == 200 for r in responses)
+    assert llm.calls == 1
+    assert len(llm.charged) == 10
+    ids = [it["id"] for r in responses for it in r.json()["items"]]
+    assert len(ids) == len(set(ids)) == 50
+    assert len({tuple(it["question"] for it in r.json()["items"]) for r in responses}) == 1
+    stats = main.COALESCER.stats()
+    assert (stats["calls"], stats["saved_calls"], stats["in_flight"]) == (1, 9, 0)
+
+
+def test_distinct_or_sequential_requests_not_coalesced(monkeypatch, llm):
+    """B-COAL-002: demandes différentes ou successives = appels distincts ; fenêtre nulle ou coalescence désactivée = aucun partage."""
+
+    _burst([{"skills": ["go"], "count": 3}, {"skills": ["go"], "count": 4}])
+    assert llm.calls == 2
+    _burst([{"skills": ["go"], "count": 3}])
+    assert llm.calls == 3
+
+    monkeypatch.setattr(main, "COALESCER", main.RequestCoalescer(0), raising=False)
+    _burst([{"skills": ["go"], "count": 3}] * 3)
+    assert llm.calls == 6
+
+    monkeypatch.setattr(main, "COALESCE_ENABLED", False, raising=False)
+    _burst([{"skills": ["go"], "count": 3}] * 3)
+    assert llm.calls == 9
+
+
+def test_shared_failure_reaches_all_callers(llm):
+    """B-COAL-003: l'échec de l'appel partagé est renvoyé à chacun (503) et la clé est libérée pour la demande suivante."""
+
+    llm.fail = True
+    responses = _burst([{"skills": ["rust"], "count": 2}] * 4)
+    assert [r.status_code for r in responses] == [503] * 4
+    assert llm.calls == 1 and llm.charged == []
+
+    llm.fail = False
+    assert _burst([{"skills": ["rust"], "count": 2}])[0].status_code == 200
+    assert llm.calls == 2
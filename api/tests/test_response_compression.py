@@ -0,0 +1,79 @@
+import sys
+import gzip
+import json
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "_supabase_client", lambda: None, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "STORE", main.MemoryQcmStore(), raising=False)
+    return TestClient(main.app)
+
+
+def _save_many(client, user_id, n):
+    qcm = {"name": "Révision générale", "items": [{"id": "1", "question": "Qu'est-ce qu'un élément ?", "choices": ["A", "B", "C", "D"], "answer_index": 0}]}
+    for _ in range(n):
+        client.post("/save_qcm", json={"user_id": user_id, "qcm": qcm})
+
+
+def test_default_response_class_keeps_json_contract(client: TestClient):
+    """B-COMP-001: la classe de réponse par défaut produit le même JSON que JSONResponse (UTF-8 non échappé)."""
+
+    assert main.app.router.default_response_class is main.FastJSONResponse
+    payload = {"name": "Révision", "items": [{"question": "Qu'est-ce ?", "score": 1.5, "ok": None}]}
+    assert json.loads(main._json_dumps(payload)) == payload
+    assert "Révision".encode("utf-8") in main._json_dumps(payload)
+
+    _save_many(client, "comp-user-1", 1)
+    resp = client.get("/history/comp-user-1", headers={"Accept-Encoding": "identity"})
+    assert resp.headers["content-type"] == "application/json"
+    assert resp.json()[0]["name"] == "Révision générale"
+
+
+def test_gzip_above_threshold_only(client: TestClient):
+    """B-COMP-002: gzip est appliqué au-delà du seuil (avec Vary), pas en dessous ni sans Accept-Encoding."""
+
+    _save_many(client, "comp-user-2", 60)
+    big = client.get("/history/comp-user-2", headers={"Accept-Encoding": "gzip"})
+    assert big.headers["content-encoding"] == "gzip" and "Accept-Encoding" in big.headers["vary"]
+    assert len(big.json()) == 60
+    assert int(big.headers["content-length"]) * 3 < len(main._json_dumps(big.json()))
+
+    small = client.get("/history/comp-user-2", params={"limit": 1}, headers={"Accept-Encoding": "gzip"})
+    assert "content-encoding" not in small.headers
+    plain = client.get("/history/comp-user-2", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    assert client.get("/history/comp-user-2", headers={"Accept-Encoding": "gzip;q=0"}).headers.get("content-encoding") is None
+
+
+def test_encoding_negotiation(monkeypatch):
+    """B-COMP-003: br est préféré quand brotli est installé ; sinon gzip ; q=0 et encodages inconnus sont respectés."""
+
+    monkeypatch.setattr(main, "brotli", None, raising=False)
+    assert main._accepted_encoding("gzip, deflate, br") == "gzip"
+    assert main._accepted_encoding("br") is None
+    assert main._accepted_encoding("*") == "gzip"
+    assert main._accepted_encoding("gzip;q=0, *;q=0.5") is None
+    assert main._accepted_encoding("") is None
+    assert gzip.decompress(main._compress(b"x" * 2000, "gzip")) == b"x" * 2000
+
+    class FakeBrotli:
+        @staticmethod
+        def compress(data, quality):
+            return b"br:" + data
+
+    monkeypatch.setattr(main, "brotli", FakeBrotli, raising=False)
+    assert main._accepted_encoding("gzip, deflate, br") == "br"
+    assert main._accepted_encoding("gzip, br;q=0.1") == "gzip"
+    assert main._compress(b"abc", "br") == b"br:abc"
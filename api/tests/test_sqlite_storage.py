@@ -0,0 +1,158 @@
+import sys
+import time
+import uuid
+import pathlib
+
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+QCM = {"name": "QCM SQLite", "items": [{"id": "1", "question": "Q?", "choices": ["A", "B", "C", "D"], "answer_index": 2}]}
+
+
+@pytest.fixture
+def storage(monkeypatch, tmp_path):
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "sqlite", raising=False)
+    monkeypatch.setattr(main, "SQLITE_PATH", str(tmp_path / "autoqcm.sqlite3"), raising=False)
+    monkeypatch.setattr(main, "SQLITE_STORAGE", None, raising=False)
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "USAGE_WRITE_BEHIND", False, raising=False)
+    return main._storage()
+
+
+def test_sqlite_schema_mirrors_supabase(storage):
+    """B-SQL-001: la base SQLite est en WAL et reprend les tables et l'index (user_id, created_at desc) de supabase.sql."""
+
+    conn = storage.db._conn
+    assert conn.execute("pragma journal_mode").fetchone()[0] == "wal"
+    tables = {r[0] for r in conn.execute("select name from sqlite_master where type = 'table'")}
+    assert {"qcm_tests", "user_roles", "qcm_usage"} <= tables
+    index_cols = [r[2] for r in conn.execute("pragma index_info('idx_qcm_tests_user_created')")]
+    assert index_cols == ["user_id", "created_at"]
+    plan = " ".join(str(r) for r in conn.execute(
+        "explain query plan select id from qcm_tests where user_id = ? order by created_at desc limit 10", ("u",)
+    ))
+    assert "idx_qcm_tests_user_created" in plan
+
+
+def test_sqlite_backend_serves_endpoints(storage):
+    """B-SQL-002: avec STORAGE_BACKEND=sqlite, save_qcm / history / get_qcm / delete_qcm passent par SQLite."""
+
+    client = TestClient(main.app)
+    user_id = str(uuid.uuid4())
+    ids = [client.post("/save_qcm", json={"user_id": user_id, "qcm": QCM, "score": i}).json()["id"] for i in range(5)]
+
+    blob = storage.db._conn.execute("select qcm from qcm_tests where id = ?", (ids[0],)).fetchone()[0]
+    assert isinstance(blob, bytes) and b", " not in blob
+
+    record = client.get(f"/qcm/{ids[2]}").json()
+    assert record["qcm"]["items"][0]["answer_index"] == 2 and record["score"] == 2
+
+    page = client.get(f"/history/{user_id}", params={"limit": 3})
+    assert [it["id"] for it in page.json()] == ids[::-1][:3]
+    rest = client.get(f"/history/{user_id}", params={"limit": 3, "cursor": page.headers["X-Next-Cursor"]})
+    assert [it["id"] for it in rest.json()] == ids[::-1][3:]
+
+    assert client.delete(f"/qcm/{ids[0]}").status_code == 200
+    assert client.get(f"/qcm/{ids[0]}").status_code == 404
+
+
+def test_sqlite_roles_and_usage_enforce_quota(monkeypatch, storage):
+    """B-SQL-003: rôles et usages sont lus / incrémentés dans SQLite et la limite du rôle est appliquée."""
+
+    monkeypatch.setattr(main, "_generate_via_langchain", main._generate_fallback, raising=False)
+    storage.db.set_user_role(main.DEV_USER_ID, "user")
+    storage.db.increment_usage([(main.DEV_USER_ID, main.GEMINI_MODEL, 9)])
+    client = TestClient(main.app)
+
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 200
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 403
+    stats = client.get("/usage_stats").json()
+    assert stats["role"] == "user" and stats["total"] == 10
+    assert storage.db.get_usage(main.DEV_USER_ID) == [(main.GEMINI_MODEL, 10)]
+
+
+def test_sqlite_lookup_sub_millisecond(storage):
+    """B-SQL-004: lecture d'un QCM et d'une page d'historique en moins d'une milliseconde en moyenne."""
+
+    user_id = "perf-user"
+    ids = []
+    for i in range(2000):
+        qid = str(uuid.uuid4())
+        ids.append(qid)
+        storage.db.insert_qcm_test({"id": qid, "user_id": user_id, "name": None, "qcm": QCM, "score": None, "created_at": f"2025-01-01T00:{i // 60:02d}:{i % 60:02d}"})
+
+    start = time.perf_counter()
+    for qid in ids[:500]:
+        storage.db.get_qcm_test(qid)
+        storage.db.list_qcm_tests(user_id, 20)
+    avg = (time.perf_counter() - start) / 500
+    assert avg < 0.001
+
+
+def test_storage_backend_registry(monkeypatch):
+    """B-SQL-005: un backend enregistré dans STORAGE_BACKENDS sert les points d'entrée sans modifier les fonctions de dépôt."""
+
+    class DictStorage(main.StorageBackend):
+        aware_timestamps = False
+
+        def __init__(self):
+            self.rows, self.usage = {}, {}
+
+        async def get_user_role(self, user_id):
+            return "admin"
+
+        async def get_usage(self, user_id):
+            return [(m, n) for (u, m), n in self.usage.items() if u == user_id]
+
+        async def increment_usage(self, user_id, model, delta):
+            self.usage[(user_id, model)] = self.usage.get((user_id, model), 0) + delta
+
+        async def increment_usage_batch(self, rows, batch_id):
+            for r in rows:
+                await self.increment_usage(r["user_id"], r["model"], r["delta"])
+
+        async def fetch_questions(self, hashes):
+            return {}
+
+        async def insert_qcm_tests(self, rows, questions):
+            self.rows.update({r["id"]: r for r in rows})
+
+        async def list_qcm_tests(self, user_id, limit, after, since, until):
+            rows = sorted((r for r in self.rows.values() if r["user_id"] == user_id), key=lambda r: (r["created_at"], r["id"]), reverse=True)
+            return rows[:limit] if limit is not None else rows
+
+        async def list_qcm_payloads(self, user_id, limit):
+            return [r["qcm"] for r in await self.list_qcm_tests(user_id, limit, None, None, None)]
+
+        async def get_qcm_test(self, qid):
+            return self.rows.get(qid)
+
+        async def delete_qcm_tests(self, user_id, ids, since, until):
+            return [self.rows.pop(qid)["id"] for qid in list(ids or []) if self.rows.get(qid, {}).get("user_id") == user_id]
+
+        async def delete_qcm_test(self, qid):
+            self.rows.pop(qid, None)
+
+    backend = DictStorage()
+    monkeypatch.setitem(main.STORAGE_BACKENDS, "dict", lambda: backend)
+    monkeypatch.setattr(main, "STORAGE_BACKEND", "dict", raising=False)
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+    monkeypatch.setattr(main, "DEDUP_ENABLED", False, raising=False)
+    monkeypatch.setattr(main, "USAGE_WRITE_BEHIND", False, raising=False)
+    monkeypatch.setattr(main, "ChatGoogleGenerativeAI", object, raising=False)
+    monkeypatch.setattr(main, "_generate_via_langchain", main._generate_fallback, raising=False)
+    client = TestClient(main.app)
+
+    qid = client.post("/save_qcm", json={"user_id": "u-dict", "qcm": QCM, "score": 1}).json()["id"]
+    assert [it["id"] for it in client.get("/history/u-dict").json()] == [qid]
+    assert client.get(f"/qcm/{qid}").json()["qcm"]["items"][0]["answer_index"] == 2
+    assert client.post("/generate_qcm", json={"count": 1}).status_code == 200
+    assert backend.usage == {(main.DEV_USER_ID, main.GEMINI_MODEL): 1}
+    assert client.delete(f"/qcm/{qid}").status_code == 200 and backend.rows == {}
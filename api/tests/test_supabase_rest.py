@@ -0,0 +1,173 @@
+import sys
+import json
+import time
+import asyncio
+import pathlib
+import threading
+from urllib.parse import urlsplit, parse_qsl
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import pytest
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+
+class FakePostgrest:
+    """Serveur PostgREST local : enregistre chaque requête, suit le nombre de requêtes traitées en même temps
+    et répond avec des lignes fixes après un délai (ou après la barrière `barrier` si elle est définie)."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = []
+        self.rows = []
+        self.barrier = None
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                url = urlsplit(self.path)
+                server.requests.append({
+                    "method": self.command,
+                    "path": url.path,
+                    "params": parse_qsl(url.query),
+                    "body": body,
+                    "prefer": self.headers.get("Prefer"),
+                    "apikey": self.headers.get("apikey"),
+                })
+                with server.lock:
+                    server.active += 1
+                    server.peak = max(server.peak, server.active)
+                try:
+                    if server.barrier is not None:
+                        server.barrier.wait()
+                    time.sleep(server.delay)
+                finally:
+                    with server.lock:
+                        server.active -= 1
+                out = json.dumps(server.rows).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(out)))
+                self.end_headers()
+                self.wfile.write(out)
+
+            do_GET = do_POST = do_PATCH = do_DELETE = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_port}"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def postgrest():
+    server = FakePostgrest()
+    yield server
+    server.close()
+
+
+def test_repositories_build_postgrest_requests(postgrest):
+    """B-DB-001: les fonctions de dépôt émettent les requêtes PostgREST attendues (filtres, tri, Prefer, RPC)."""
+
+    supa = main.SupabaseStorage(main.SupabaseRest(postgrest.url, "service-key", pool_size=4))
+    postgrest.rows = [{"id": "t1", "user_id": "u1", "name": "QCM", "score": 3, "created_at": "2025-01-01T00:00:00"}]
+
+    async def scenario():
+        rows = await main._list_qcm_tests(supa, "u1")
+        await main._insert_qcm_test(supa, {"id": "t2", "user_id": "u1", "qcm": {"items": []}})
+        await main._delete_qcm_test(supa, "t2")
+        await main._increment_usage(supa, "u1", "gemini", 2)
+        await supa.client.aclose()
+        return rows
+
+    rows = asyncio.run(scenario())
+    assert rows[0]["id"] == "t1"
+
+    listing, insert, delete, rpc = postgrest.requests
+    assert listing["method"] == "GET" and listing["path"] == "/rest/v1/qcm_tests"
+    assert listing["params"] == [("select", "id,user_id,name,score,created_at"), ("user_id", "eq.u1"), ("order", "created_at.desc,id.desc")]
+    assert listing["apikey"] == "service-key"
+    assert insert["method"] == "POST" and insert["body"]["id"] == "t2" and insert["prefer"] == "return=representation"
+    assert delete["method"] == "DELETE" and delete["params"] == [("id", "eq.t2")]
+    assert rpc["path"] == "/rest/v1/rpc/increment_qcm_usage"
+    assert rpc["body"] == {"p_user_id": "u1", "p_model": "gemini", "p_delta": 2}
+
+
+def test_history_concurrency_scales_with_pool_size(monkeypatch):
+    """B-DB-002: des appels /history concurrents s'exécutent en parallèle jusqu'à SUPABASE_POOL_SIZE connexions."""
+
+    n = 6
+    server = FakePostgrest(delay=0.05)
+    server.rows = [{"id": "t1", "user_id": "u1", "name": "QCM", "score": None, "created_at": "2025-01-01T00:00:00"}]
+    monkeypatch.setattr(main, "DEV_MODE", True, raising=False)
+
+    async def burst(pool_size, barrier=None):
+        server.barrier, server.peak = barrier, 0
+        supa = main.SupabaseRest(server.url, "service-key", pool_size=pool_size)
+        monkeypatch.setattr(main, "_supabase_client", lambda: supa, raising=False)
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            responses = await asyncio.gather(*(client.get("/history/u1") for _ in range(n)))
+        await supa.aclose()
+        assert all(r.status_code == 200 and r.json()[0]["id"] == "t1" for r in responses)
+        return server.peak
+
+    try:
+        # pool de n connexions : les n requêtes se rejoignent sur la barrière du serveur, donc sont en vol ensemble
+        pooled = asyncio.run(burst(n, threading.Barrier(n, timeout=5.0)))
+        single = asyncio.run(burst(1))
+    finally:
+        server.close()
+
+    assert pooled == n
+    assert single == 1
+
+
+def test_client_of_previous_loop_is_closed(postgrest):
+    """B-DB-003: quand la boucle asyncio change, le client httpx de la boucle précédente est fermé (pas de fuite de sockets)."""
+
+    supa = main.SupabaseRest(postgrest.url, "service-key", pool_size=2)
+    other = asyncio.new_event_loop()
+    thread = threading.Thread(target=other.run_forever, daemon=True)
+    thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(supa.request("GET", "/qcm_tests"), other).result(timeout=5)
+        previous = supa._http
+        assert previous is not None and not previous.is_closed
+
+        async def on_new_loop():
+            await supa.request("GET", "/qcm_tests")
+            current = supa._http
+            await supa.aclose()
+            return current
+
+        current = asyncio.run(on_new_loop())
+        deadline = time.monotonic() + 5
+        while not previous.is_closed and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        other.call_soon_threadsafe(other.stop)
+        thread.join(timeout=5)
+        other.close()
+
+    assert current is not previous
+    assert previous.is_closed and current.is_closed
+    assert len(postgrest.requests) == 2
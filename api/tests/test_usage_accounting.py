@@ -0,0 +1,177 @@
+import sys
+import asyncio
+import pathlib
+import threading
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+# Ajouter le dossier parent au path pour importer main
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+import main as main
+
+_compute_quota = main._compute_quota
+
+
+class FakeUsageDb:
+    """Supabase factice : implémente les RPC d'incrément comme le ferait Postgres (atomiquement)."""
+
+    def __init__(self):
+        self.counts = {}
+        self.rpc_calls = []
+        self.table_calls = 0
+        self.batches = set()
+        # Erreur levée par le prochain appel RPC ; after_commit=True : levée après application (réponse perdue)
+        self.fail = None
+        self.after_commit = False
+        self._lock = threading.Lock()
+
+    def rpc(self, fn, params):
+        db = self
+
+        class Call:
+            def execute(self):
+                with db._lock:
+                    db.rpc_calls.append((fn, params))
+                    fail, db.fail = db.fail, None
+                    if fail is not None and not db.after_commit:
+                        raise fail
+                    if fn == "increment_qcm_usage":
+                        key = (params["p_user_id"], params["p_model"])
+                        db.counts[key] = db.counts.get(key, 0) + params["p_delta"]
+                    elif fn == "increment_qcm_usage_batch" and params["p_batch_id"] not in db.batches:
+                        db.batches.add(params["p_batch_id"])
+                        for row in params["p_rows"]:
+                            key = (row["user_id"], row["model"])
+                            db.counts[key] = db.counts.get(key, 0) + row["delta"]
+                    if fail is not None:
+                        raise fail
+                return type("Res", (), {"data": None})()
+
+        return Call()
+
+    def table(self, name):
+        self.table_calls += 1
+        raise AssertionError("aucun accès table attendu sur le chemin d'usage")
+
+
+async def _admin_quota(supa, user_id):
+    return "admin", None, 0
+
+
+@pytest.fixture
+def client(monkeypatch, offline_app):
+    db = FakeUsageDb()
+    monkeypatch.setattr(main, "_supabase_client", lambda: db, raising=False)
+    monkeypatch.setattr(main, "_compute_quota", _admin_quota, raising=False)
+    monkeypatch.setattr(main, "_generate_via_langchain", main._generate_fallback, raising=False)
+    monkeypatch.setattr(main, "USAGE_BUFFER", main.UsageWriteBuffer(), raising=False)
+    c = TestClient(main.app)
+    c.db = db
+    return c
+
+
+def test_usage_increment_single_rpc_per_generation(monkeypatch, client: TestClient):
+    """B-USAGE-001: chaque génération fait exactement un appel RPC atomique, sans lecture préalable."""
+
+    monkeypatch.setattr(main, "USAGE_WRITE_BEHIND", False, raising=False)
+
+    for _ in range(3):
+        assert client.post("/generate_qcm", json={"skills": ["python"], "count": 1}).status_code == 200
+
+    db = client.db
+    assert [fn for fn, _ in db.rpc_calls] == ["increment_qcm_usage"] * 3
+    assert db.table_calls == 0
+    assert db.counts == {(main.DEV_USER_ID, main.GEMINI_MODEL): 3}
+
+
+def test_usage_concurrent_increments_not_lost(monkeypatch, client: TestClient):
+    """B-USAGE-002: des incréments concurrents pour le même utilisateur ne perdent aucune unité."""
+
+    db = client.db
+
+    async def burst():
+        await asyncio.gather(*(main._increment_usage(main.SupabaseStorage(db), "u-conc", "m") for _ in range(50)))
+
+    asyncio.run(burst())
+
+    assert db.counts[("u-conc", "m")] == 50
+    assert len(db.rpc_calls) == 50
+
+
+def test_usage_write_behind_coalesces_and_counts_pending(monkeypatch, client: TestClient):
+    """B-USAGE-003: en write-behind, les incréments sont regroupés en un lot et comptés dans le quota avant vidage."""
+
+    monkeypatch.setattr(main, "USAGE_WRITE_BEHIND", True, raising=False)
+    monkeypatch.setattr(main, "USAGE_FLUSH_INTERVAL", 3600, raising=False)
+
+    for _ in range(4):
+        assert client.post("/generate_qcm", json={"skills": ["python"], "count": 1}).status_code == 200
+
+    db = client.db
+    assert db.rpc_calls == []
+    assert main.USAGE_BUFFER.pending(main.DEV_USER_ID) == 4
+
+    # Le quota tient compte des incréments en attente
+    async def fake_role(supa, user_id):
+        return "user"
+
+    async def fake_usage(supa, user_id):
+        return [], 7
+
+    monkeypatch.setattr(main, "_get_user_role", fake_role, raising=False)
+    monkeypatch.setattr(main, "_get_usage", fake_usage, raising=False)
+    assert asyncio.run(_compute_quota(db, main.DEV_USER_ID)) == ("user", main.ROLE_LIMITS["user"], 11)
+
+    assert asyncio.run(main.USAGE_BUFFER.flush(main.SupabaseStorage(db))) == 1
+    assert [fn for fn, _ in db.rpc_calls] == ["increment_qcm_usage_batch"]
+    assert db.counts == {(main.DEV_USER_ID, main.GEMINI_MODEL): 4}
+    assert main.USAGE_BUFFER.pending(main.DEV_USER_ID) == 0
+
+
+def _postgrest_error(status, code):
+    request = httpx.Request("POST", "http://supabase.invalid/rest/v1/rpc/increment_qcm_usage")
+    response = httpx.Response(status, json={"code": code, "message": "error"}, request=request)
+    return httpx.HTTPStatusError("error", request=request, response=response)
+
+
+def test_usage_rpc_fallback_only_when_function_missing(client: TestClient):
+    """B-USAGE-004: le repli lecture/écriture ne sert que si la RPC est absente (PGRST202) ; un timeout est propagé sans repli."""
+
+    db = client.db
+    db.fail = httpx.ReadTimeout("timed out")
+    db.after_commit = True
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(main._increment_usage(main.SupabaseStorage(db), "u-amb", "m"))
+    # Appel validé avant la perte de la réponse : compté une fois, aucune relecture de la table
+    assert db.counts == {("u-amb", "m"): 1} and db.table_calls == 0
+
+    db.fail = _postgrest_error(404, "PGRST202")
+    db.after_commit = False
+    with pytest.raises(AssertionError, match="aucun accès table"):
+        asyncio.run(main._increment_usage(main.SupabaseStorage(db), "u-old", "m"))
+    assert db.table_calls == 1
+
+
+def test_usage_batch_retried_idempotently_after_ambiguous_failure(monkeypatch, client: TestClient):
+    """B-USAGE-005: un lot write-behind en échec ambigu est renvoyé avec le même identifiant et n'est compté qu'une fois."""
+
+    db = client.db
+    buffer = main.USAGE_BUFFER
+    buffer.add("u-batch", "m", 3)
+
+    db.fail = httpx.ReadTimeout("timed out")
+    db.after_commit = True
+    with pytest.raises(httpx.ReadTimeout):
+        asyncio.run(buffer.flush(main.SupabaseStorage(db)))
+    # Issue inconnue : le lot reste compté dans le quota local jusqu'à confirmation
+    assert buffer.pending("u-batch") == 3
+    buffer.add("u-batch", "m", 2)
+
+    assert asyncio.run(buffer.flush(main.SupabaseStorage(db))) == 2
+    first, retry, fresh = [params["p_batch_id"] for _, params in db.rpc_calls]
+    assert retry == first and fresh != first
+    assert db.counts == {("u-batch", "m"): 5}
+    assert buffer.pending("u-batch") == 0
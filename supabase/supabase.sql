@@ -14,6 +14,16 @@ create table if not exists public.qcm_tests (
   created_at timestamptz not null default now()
 );
 
+-- Table: questions (contenu des questions, stocké une fois par empreinte sha256 du contenu normalisé)
+-- Utilisée quand l'API tourne avec NORMALIZED_QUESTIONS=true : qcm_tests.qcm ne contient alors que
+-- {"id", "h"} par question (plus les réponses de la tentative). Accès service role uniquement.
+-- Les questions ne sont pas supprimées avec les QCM (elles peuvent être partagées).
+create table if not exists public.questions (
+  hash text primary key,
+  item jsonb not null,
+  created_at timestamptz not null default now()
+);
+
 -- Table: user_roles
 create table if not exists public.user_roles (
   user_id uuid primary key references auth.users(id) on delete cascade,
@@ -28,11 +38,66 @@ create table if not exists public.qcm_usage (
   primary key (user_id, model)
 );
 
+-- Function: increment_qcm_usage
+-- Incrément atomique de qcm_usage en un seul aller-retour (appelé via RPC par l'API)
+create or replace function public.increment_qcm_usage(p_user_id uuid, p_model text, p_delta integer default 1)
+returns integer
+language sql
+security definer
+set search_path = public
+as $$
+  insert into public.qcm_usage as u (user_id, model, generated_count)
+  values (p_user_id, p_model, p_delta)
+  on conflict (user_id, model)
+  do update set generated_count = u.generated_count + excluded.generated_count
+  returning u.generated_count;
+$$;
+
+-- Table: qcm_usage_batches
+-- Lots write-behind déjà appliqués : un lot renvoyé après une réponse perdue (timeout) n'est pas recompté
+create table if not exists public.qcm_usage_batches (
+  batch_id uuid primary key,
+  applied_at timestamptz not null default now()
+);
+
+alter table public.qcm_usage_batches enable row level security;
+
+-- Function: increment_qcm_usage_batch
+-- Variante par lot pour le tampon write-behind : p_rows = [{"user_id", "model", "delta"}, ...]
+-- Idempotente par p_batch_id : le même lot envoyé deux fois n'est appliqué qu'une fois
+-- Purge au passage les identifiants de lots appliqués il y a plus de 7 jours (un lot n'est renvoyé qu'au vidage suivant)
+drop function if exists public.increment_qcm_usage_batch(jsonb);
+create or replace function public.increment_qcm_usage_batch(p_rows jsonb, p_batch_id uuid)
+returns void
+language plpgsql
+security definer
+set search_path = public
+as $$
+begin
+  insert into public.qcm_usage_batches (batch_id) values (p_batch_id) on conflict do nothing;
+  if not found then
+    return;
+  end if;
+  delete from public.qcm_usage_batches where applied_at < now() - interval '7 days';
+  insert into public.qcm_usage as u (user_id, model, generated_count)
+  select (r->>'user_id')::uuid, r->>'model', sum((r->>'delta')::integer)::integer
+  from jsonb_array_elements(p_rows) as r
+  group by 1, 2
+  on conflict (user_id, model)
+  do update set generated_count = u.generated_count + excluded.generated_count;
+end;
+$$;
+
+revoke execute on function public.increment_qcm_usage(uuid, text, integer) from public, anon, authenticated;
+revoke execute on function public.increment_qcm_usage_batch(jsonb, uuid) from public, anon, authenticated;
+
 -- Indexes
 create index if not exists idx_qcm_tests_user_created on public.qcm_tests(user_id, created_at desc);
+create index if not exists idx_qcm_usage_batches_applied on public.qcm_usage_batches(applied_at);
 
 -- RLS
 alter table public.qcm_tests enable row level security;
+alter table public.questions enable row level security;
 
 -- Policies
 create policy "Allow insert own" on public.qcm_tests